@@ -1,205 +1,533 @@
-import torch
-import torch.nn.functional as F
-import sentencepiece as spm
-from fastapi import FastAPI
+from fastapi import FastAPI, Request, Response
 from pydantic import BaseModel
-from fastapi.responses import StreamingResponse
-import json, time
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+import asyncio
+import hashlib
+import json
+import time
+from typing import List, Optional
 
 import os
-from hf_backend import HFTextGen
+from hf_backend import HFBatchEngine, HFTextGen, SpeculativeGen
+from inference_executor import InferenceExecutor, QueueFull
+from local_batcher import LocalBatcher
+from local_model import CHECK_PROMPTS, load_tiny_model, prepare_serving_model
+from metrics import REGISTRY, REQUEST_SECONDS, REQUESTS, ServingMetrics
+from prefix_cache import PrefixStateCache
+from profiling import RequestProfiler
+from response_cache import ResponseCache
+from streaming import IncrementalDecoder
+from token_cache import TokenCache
+from token_file import sha256_file
+from tokenizer import SentencePieceTokenizer, unflatten
+from worker_pool import PooledHFEngine, PooledLocalBatcher, WorkerPool
 
 # Load tokenizer
-sp = spm.SentencePieceProcessor()
-sp.load("mymodel.model")
-
-class TinyModel(torch.nn.Module):
-    def __init__(self, vocab_size=100, dim=64, hidden_size=128):  # LSTM hidden size is 128
-        super().__init__()
-        self.embed = torch.nn.Embedding(vocab_size, dim)
-        self.lstm = torch.nn.LSTM(dim, hidden_size, batch_first=True)  # dim=64, hidden_size=128
-        self.fc = torch.nn.Linear(hidden_size, vocab_size)  # hidden_size=128 to vocab_size=100
-    
-    def forward(self, x, h=None):
-        x = self.embed(x)
-        if h is None:
-            x, (h, c) = self.lstm(x)
-        else:
-            x, (h, c) = self.lstm(x, h)
-        return self.fc(x), (h, c)
-
-# Initialize model
-model = TinyModel()
-try:
-    state = torch.load("mini_llm.pth", map_location="cpu")
-    model.load_state_dict(state, strict=False)
-    load_msg = "model loaded successfully"
-except Exception as e:
-    load_msg = f"model load warning: {e}"
-
-model.eval()
+tokenizer = SentencePieceTokenizer("mymodel.model")
+sp = tokenizer.sp
+
+# Token ids of recent prompts and their leading lines, shared by every tokenizer; 0 disables it
+TOKEN_CACHE_TOKENS = int(os.getenv("TOKEN_CACHE_TOKENS", str(1 << 20)))
+token_cache = TokenCache(TOKEN_CACHE_TOKENS) if TOKEN_CACHE_TOKENS > 0 else None
+
+def encode_prompt(text: str) -> List[int]:
+    return sp.encode(text, out_type=int)
+
+def _encode_segments(texts: List[str]) -> List[List[int]]:
+    # A prompt has only a few segments, where one sp.encode call beats encode_batch's numpy round trip
+    return sp.encode(texts, out_type=int)
+
+if token_cache is not None:
+    encode_prompt = token_cache.register(f"sp:{sha256_file('mymodel.model')}", encode_prompt, _encode_segments)
+
+# Initialize model; LOCAL_MODEL_PATH may also point at a training checkpoint
+LOCAL_MODEL_PATH = os.getenv("LOCAL_MODEL_PATH", "mini_llm.pth")
+model, load_msg = load_tiny_model(LOCAL_MODEL_PATH)
+MODEL_PARAMETERS = sum(p.numel() for p in model.parameters())
+
+# Requests for the local model are decoded together by one background thread.
+LOCAL_BATCH_WINDOW_MS = float(os.getenv("LOCAL_BATCH_WINDOW_MS", "5"))
+LOCAL_MAX_BATCH = int(os.getenv("LOCAL_MAX_BATCH", "32"))
+# LSTM states for shared prompt prefixes; PREFIX_CACHE_MB=0 disables the cache
+PREFIX_CACHE_MB = float(os.getenv("PREFIX_CACHE_MB", "64"))
+PREFIX_CACHE_BLOCK = int(os.getenv("PREFIX_CACHE_BLOCK", "16"))
 
 # ----------------------------
 # Backend selection
 # ----------------------------
 MODEL_BACKEND = os.getenv("MODEL_BACKEND", "local")  # "local" or "hf"
+# "fp32", "int8" (quantized + TorchScript), "bf16" (CPU autocast), "compile" or "bf16-compile"
+LOCAL_MODEL_MODE = os.getenv("LOCAL_MODEL_MODE", "fp32")
+# A non-fp32 mode is only used if its greedy next-token choices agree with fp32 at least this often
+LOCAL_MIN_AGREEMENT = float(os.getenv("LOCAL_MIN_AGREEMENT", os.getenv("LOCAL_INT8_MIN_AGREEMENT", "0.95")))
 HF_MODEL_NAME = os.getenv("HF_MODEL_NAME", "distilgpt2")
+# Continuous batching for the HF backend; set HF_BATCHING=0 to call model.generate per request
+HF_BATCHING = os.getenv("HF_BATCHING", "1") == "1"
+HF_MAX_BATCH = int(os.getenv("HF_MAX_BATCH", "16"))
+# Speculative decoding: a smaller HF model sharing the tokenizer drafts tokens for HF_MODEL_NAME
+HF_DRAFT_MODEL_NAME = os.getenv("HF_DRAFT_MODEL_NAME", "")
+HF_SPEC_TOKENS = int(os.getenv("HF_SPEC_TOKENS", "4"))
 
-hf = None
+model, model_mode = prepare_serving_model(
+    model,
+    LOCAL_MODEL_MODE,
+    unflatten(*tokenizer.encode_batch(CHECK_PROMPTS)),
+    min_agreement=LOCAL_MIN_AGREEMENT,
+)
+
+hf_gen = None
+hf_draft = None
 if MODEL_BACKEND == "hf":
-    hf = HFTextGen(HF_MODEL_NAME)
+    hf_gen = HFTextGen(HF_MODEL_NAME, token_cache=token_cache)
     print(f"🤖 Using HF backend: {HF_MODEL_NAME}")
+    if HF_DRAFT_MODEL_NAME:
+        hf_draft = HFTextGen(HF_DRAFT_MODEL_NAME)
+        print(f"🎯 Speculative decoding with draft {HF_DRAFT_MODEL_NAME}, {HF_SPEC_TOKENS} tokens per round")
 else:
     print("🧠 Using local tiny LSTM backend")
 
+def build_backends():
+    """Create this process's decode loops: (local batcher, HF backend or None)."""
+    prefix_cache = None
+    if PREFIX_CACHE_MB > 0:
+        prefix_cache = PrefixStateCache(int(PREFIX_CACHE_MB * 1024 * 1024), block_size=PREFIX_CACHE_BLOCK)
+    local = LocalBatcher(
+        model,
+        sp.eos_id(),
+        window_ms=LOCAL_BATCH_WINDOW_MS,
+        max_batch=LOCAL_MAX_BATCH,
+        prefix_cache=prefix_cache,
+        metrics=local_metrics,
+    )
+    gen = hf_gen
+    if gen is not None and hf_draft is not None:
+        # Speculative rounds are per request, so they replace continuous batching
+        gen = SpeculativeGen(gen, hf_draft, num_speculative=HF_SPEC_TOKENS)
+    elif gen is not None and HF_BATCHING:
+        gen = HFBatchEngine(gen, max_batch=HF_MAX_BATCH)
+    return local, gen
+
+# Exact-match cache for deterministic requests (top_k=1 or an explicit seed); 0 disables it
+RESPONSE_CACHE_MB = float(os.getenv("RESPONSE_CACHE_MB", "16"))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+# Optional SQLite file so cached responses survive restarts
+RESPONSE_CACHE_PATH = os.getenv("RESPONSE_CACHE_PATH", "")
+
+response_cache = None
+if RESPONSE_CACHE_MB > 0:
+    response_cache = ResponseCache(
+        int(RESPONSE_CACHE_MB * 1024 * 1024), ttl=RESPONSE_CACHE_TTL, path=RESPONSE_CACHE_PATH or None
+    )
+
+def _weights_digest(name: str, gen: Optional[HFTextGen] = None) -> str:
+    """
+    sha256 of a model's weights, so retrained or swapped weights get new cache keys.
+
+    Args:
+        name: Local weights file, HF model directory or HF hub model name
+        gen: The loaded HF model; hub models are identified by their downloaded revision
+
+    Returns:
+        Hex digest, or "unknown" when neither files nor a revision are available
+    """
+    if os.path.isfile(name):
+        return sha256_file(name)
+    if os.path.isdir(name):
+        digest = hashlib.sha256()
+        for entry in sorted(os.listdir(name)):
+            if entry.endswith((".safetensors", ".bin", ".pt", ".pth")):
+                digest.update(f"{entry}:{sha256_file(os.path.join(name, entry))}".encode())
+        return digest.hexdigest()
+    revision = getattr(gen.model.config, "_commit_hash", None) if gen is not None else None
+    return revision or "unknown"
+
+# Identifies the weights behind a response, so cache entries never cross models
+if hf_gen is not None:
+    MODEL_NAME = HF_MODEL_NAME + (f"+draft:{HF_DRAFT_MODEL_NAME}" if hf_draft is not None else "")
+    MODEL_ID = f"{HF_MODEL_NAME}@{_weights_digest(HF_MODEL_NAME, hf_gen)}"
+    if hf_draft is not None:
+        MODEL_ID += f"+draft:{HF_DRAFT_MODEL_NAME}@{_weights_digest(HF_DRAFT_MODEL_NAME, hf_draft)}"
+else:
+    MODEL_NAME = f"{LOCAL_MODEL_PATH}:{model_mode['mode']}"
+    MODEL_ID = f"{LOCAL_MODEL_PATH}@{_weights_digest(LOCAL_MODEL_PATH)}:{model_mode['mode']}"
+
+# Phase latencies and token counts per backend / model, served at /metrics
+local_metrics = ServingMetrics("local", f"{LOCAL_MODEL_PATH}:{model_mode['mode']}")
+serving_metrics = local_metrics
+if hf_gen is not None:
+    serving_metrics = hf_gen.metrics = ServingMetrics("hf", MODEL_NAME)
+
+# Pre-forked workers sharing one copy of the weights; 0 keeps everything in this process
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", "0"))
+
+pool = None
+if WORKER_PROCESSES > 0:
+    # Fork before any decode thread exists in this process
+    pool = WorkerPool(WORKER_PROCESSES, build_backends, shared_modules=[model, hf_gen.model if hf_gen else None, hf_draft.model if hf_draft else None])
+    batcher = PooledLocalBatcher(pool)
+    hf = PooledHFEngine(pool) if hf_gen is not None else None
+    print(f"🧩 Worker pool: {WORKER_PROCESSES} processes, cores {pool.cores}")
+else:
+    batcher, hf = build_backends()
+
+# Generation runs off Starlette's threadpool; requests beyond workers + queue get a 503
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", "2"))
+INFERENCE_QUEUE = int(os.getenv("INFERENCE_QUEUE", "64"))
+executor = InferenceExecutor(workers=INFERENCE_WORKERS, max_queue=INFERENCE_QUEUE)
+
+# Point-in-time state copied from the stats() of the executor and caches at each scrape
+IN_FLIGHT = REGISTRY.gauge("llm_inference_in_flight", "Requests admitted to the inference pool")
+REJECTED = REGISTRY.gauge("llm_inference_rejected", "Requests turned away with a 503 since start")
+CACHE_HITS = REGISTRY.gauge("llm_cache_hits", "Cache hits since start (partial hits included)", ("cache",))
+CACHE_MISSES = REGISTRY.gauge("llm_cache_misses", "Cache misses since start", ("cache",))
+CACHE_ENTRIES = REGISTRY.gauge("llm_cache_entries", "Entries held by each cache", ("cache",))
+TOKENIZE_SAVED = REGISTRY.gauge("llm_token_cache_saved_seconds", "Estimated tokenization time saved by the token cache")
+
+def _collect_gauges():
+    stats = executor.stats()
+    IN_FLIGHT.set(stats["in_flight"])
+    REJECTED.set(stats["rejected"])
+    caches = {
+        "response": response_cache,
+        "token": token_cache,
+        "prefix": batcher.prefix_cache,
+    }
+    for name, cache in caches.items():
+        if cache is None:
+            continue
+        stats = cache.stats()
+        CACHE_HITS.set(stats["hits"] + stats.get("partial_hits", 0), cache=name)
+        CACHE_MISSES.set(stats["misses"], cache=name)
+        CACHE_ENTRIES.set(stats["entries"], cache=name)
+        if name == "token":
+            TOKENIZE_SAVED.set(stats["time_saved_s"])
+
+REGISTRY.on_collect(_collect_gauges)
+
+# Requests sent with an X-Profile header or ?profile=1 run under torch.profiler (after the workers fork)
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+# At most this many profiles per minute, one at a time; 0 (the default) turns the hook off
+PROFILE_MAX_PER_MINUTE = float(os.getenv("PROFILE_MAX_PER_MINUTE", "0"))
+# Fraction of requests profiled without asking, within the same limit
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_TOP_N = int(os.getenv("PROFILE_TOP_N", "25"))
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "100"))
+profiler = RequestProfiler(PROFILE_DIR, PROFILE_MAX_PER_MINUTE, PROFILE_SAMPLE_RATE, PROFILE_TOP_N, PROFILE_KEEP)
+
 app = FastAPI(title="AI Model API", version="1.0.0")
 
 @app.get("/health")
-def health():
+async def health():
     return {
         "ok": True, 
         "tokenizer_vocab": sp.get_piece_size(), 
         "status": load_msg,
-        "model_parameters": sum(p.numel() for p in model.parameters())
+        "model_parameters": MODEL_PARAMETERS,
+        "model_mode": model_mode,
+        "prefix_cache": batcher.prefix_cache.stats() if batcher.prefix_cache is not None else None,
+        "inference": executor.stats(),
+        "speculative": hf.stats() if isinstance(hf, SpeculativeGen) else None,
+        "response_cache": response_cache.stats() if response_cache is not None else None,
+        "token_cache": token_cache.stats() if token_cache is not None else None,
+        "workers": await pool.worker_stats() if pool is not None else None,
+        "profiling": profiler.stats(),
     }
 
+@app.get("/metrics")
+async def metrics():
+    """Prometheus scrape endpoint; worker processes' counters are summed into the output."""
+    others = await pool.worker_metrics() if pool is not None else []
+    return PlainTextResponse(REGISTRY.render(others), media_type="text/plain; version=0.0.4")
+
 class GenIn(BaseModel):
     prompt: str
     max_tokens: int = 64
     temperature: float = 0.9
     top_k: int = 50
+    top_p: float = 1.0
+    repetition_penalty: float = 1.0
+    seed: Optional[int] = None
+
+def _sampling_params(req: GenIn) -> dict:
+    """Decoding parameters shared by every backend, with the endpoint defaults applied."""
+    return {
+        "max_tokens": int(req.max_tokens or 40),
+        "temperature": float(req.temperature or 0.8),
+        "top_k": int(req.top_k or 50),
+        "top_p": float(req.top_p if req.top_p is not None else 1.0),
+        "repetition_penalty": float(req.repetition_penalty or 1.0),
+        "seed": req.seed,
+    }
+
+def _cache_key(prompt: str, params: dict) -> Optional[str]:
+    """Response cache key, or None when the request is not deterministic."""
+    if response_cache is None:
+        return None
+    if params["top_k"] == 1:
+        # Greedy: temperature, top_p and the seed cannot change the argmax
+        fields = {k: params[k] for k in ("max_tokens", "top_k", "repetition_penalty")}
+    elif params["seed"] is not None:
+        fields = params
+    else:
+        return None
+    backend = "hf" if hf is not None else "local"
+    return response_cache.make_key(backend=backend, model=MODEL_ID, prompt=prompt, **fields)
+
+def _local_response(prompt: str, input_ids: List[int], generated: List[int]) -> dict:
+    generated_ids = input_ids + generated
+    return {
+        "success": True,
+        "input": prompt,
+        "generated": sp.decode(generated_ids),
+        "tokens_generated": len(generated),
+        "input_tokens": len(input_ids),
+        "total_tokens": len(generated_ids),
+        "backend": "local",
+    }
+
+def _local_continuation(input_ids: List[int], generated: List[int]) -> str:
+    """The text /generate_stream emits for `generated`, for replaying cached responses."""
+    decoder = IncrementalDecoder(sp.decode, input_ids[-4:])
+    return "".join(decoder.push(token) for token in generated) + decoder.flush()
+
+def _record_queue(fn):
+    """Wrap a call bound for the inference pool so its wait there is recorded as queue time."""
+    submitted = time.perf_counter()
+    def run(*args, **kwargs):
+        serving_metrics.queued(time.perf_counter() - submitted)
+        return fn(*args, **kwargs)
+    return run
+
+def _record_queue_iter(iterator):
+    """Same as _record_queue, for an iterator driven from the inference pool."""
+    submitted = time.perf_counter()
+    def run():
+        serving_metrics.queued(time.perf_counter() - submitted)
+        yield from iterator
+    return run()
+
+def _observe_request(endpoint: str, outcome: str, start: float):
+    labels = serving_metrics.labels
+    REQUESTS.inc(**labels, endpoint=endpoint, outcome=outcome)
+    if outcome != "busy":
+        REQUEST_SECONDS.observe(time.perf_counter() - start, **labels, endpoint=endpoint)
+
+async def _hf_generate(prompt: str, params: dict) -> str:
+    if isinstance(hf, (HFBatchEngine, PooledHFEngine)):
+        req = hf.submit(prompt, **params)
+        return await asyncio.wrap_future(req.future)
+    return await executor.run(_record_queue(hf.generate_once), prompt, **params)
+
+async def _hf_stream(prompt: str, params: dict):
+    if isinstance(hf, (HFBatchEngine, PooledHFEngine)):
+        req = hf.submit(prompt, **params, stream=True, loop=asyncio.get_running_loop())
+        try:
+            async for piece in req.stream:
+                yield piece
+        finally:
+            req.stream.cancel()
+        return
+    async for piece in executor.iterate(_record_queue_iter(hf.stream(prompt, **params))):
+        yield piece
+
+def _busy(prompt: str, e: QueueFull) -> JSONResponse:
+    return JSONResponse(status_code=503, content={"success": False, "error": str(e), "input": prompt})
+
+async def _start_profile(endpoint: str, http_request: Request):
+    """A ProfileSession when the request asks for one (or is sampled) and the rate limit allows."""
+    flag = http_request.headers.get("x-profile") or http_request.query_params.get("profile") or ""
+    requested = flag.lower() in ("1", "true", "yes", "on")
+    session = await profiler.start_async(endpoint, requested)
+    headers = {}
+    if session.active:
+        headers["X-Profile"] = session.name
+    elif requested:
+        headers["X-Profile"] = "skipped"
+    return session, headers
 
 @app.post("/generate")
-def generate_text(request: GenIn):
+async def generate_text(request: GenIn, http_request: Request, http_response: Response):
     """
     Unified generate endpoint:
     - If HF backend is enabled (hf is not None), use Hugging Face model.
     - Otherwise fall back to the local tiny LSTM + SentencePiece path.
+    Returns 503 right away when the inference queue is full.
+    Deterministic requests (top_k=1 or a seed) are served from the response cache.
+    An X-Profile header or ?profile=1 profiles the request (see profiling.py).
     """
+    start = time.perf_counter()
+    session, headers = await _start_profile("generate", http_request)
+    http_response.headers.update(headers)
     try:
         prompt = request.prompt or ""
-        max_tokens = int(request.max_tokens or 40)
-        temperature = float(request.temperature or 0.8)
-        top_k = int(request.top_k or 50)
-
-        # --- HF backend ---
-        if hf is not None:
-            text = hf.generate_once(
-                prompt,
-                max_tokens=max_tokens,
-                temperature=temperature,
-                top_k=top_k,
-            )
-            return {
-                "success": True,
-                "input": prompt,
-                "generated": text,
-                "backend": "hf",
-            }
-
-        # --- Local backend (your original logic) ---
-        input_ids = sp.encode(prompt, out_type=int)
-        input_tensor = torch.tensor([input_ids], dtype=torch.long)
-
-        with torch.no_grad():
-            hidden = None
-            generated_ids = input_ids.copy()
-
-            for _ in range(max_tokens):
-                output, hidden = model(input_tensor, hidden)
-
-                logits = output[0, -1, :] / max(temperature, 1e-6)
+        params = _sampling_params(request)
 
-                if top_k > 0:
-                    k = min(top_k, logits.size(-1))
-                    top_k_logits, top_k_indices = torch.topk(logits, k)
-                    logits = torch.full_like(logits, float("-inf"))
-                    logits[top_k_indices] = top_k_logits
+        with session.span("cache_lookup"):
+            key = _cache_key(prompt, params)
+            cached = await response_cache.get_async(key) if key is not None else None
+        if cached is not None and cached.get("response") is not None:
+            _observe_request("generate", "cached", start)
+            return {**cached["response"], "cached": True}
 
-                probs = F.softmax(logits, dim=-1)
-                next_token = torch.multinomial(probs, 1).item()
+        with executor.admit():
+            # --- HF backend ---
+            if hf is not None:
+                # Tokenization happens inside the HF backend
+                with session.span("generate"):
+                    text = await _hf_generate(prompt, params)
+                response = {
+                    "success": True,
+                    "input": prompt,
+                    "generated": text,
+                    "backend": "hf",
+                }
+                continuation = text[len(prompt):] if text.startswith(prompt) else None
+            else:
+                # --- Local backend (batched with other in-flight requests) ---
+                with session.span("tokenize"):
+                    input_ids = encode_prompt(prompt)
+                with session.span("generate"):
+                    generated = await asyncio.wrap_future(batcher.submit(input_ids, **params))
+                with session.span("detokenize"):
+                    response = _local_response(prompt, input_ids, generated)
+                    continuation = _local_continuation(input_ids, generated)
 
-                generated_ids.append(next_token)
-                input_tensor = torch.tensor([[next_token]], dtype=torch.long)
-
-                if next_token == sp.eos_id():
-                    break
-
-        generated_text = sp.decode(generated_ids)
-
-        return {
-            "success": True,
-            "input": prompt,
-            "generated": generated_text,
-            "tokens_generated": len(generated_ids) - len(input_ids),
-            "input_tokens": len(input_ids),
-            "total_tokens": len(generated_ids),
-            "backend": "local",
-        }
+        if key is not None:
+            with session.span("cache_store"):
+                response_cache.put(key, {"response": response, "continuation": continuation})
+        _observe_request("generate", "ok", start)
+        return response
 
+    except QueueFull as e:
+        _observe_request("generate", "busy", start)
+        busy = _busy(request.prompt, e)
+        busy.headers.update(headers)
+        return busy
     except Exception as e:
+        _observe_request("generate", "error", start)
         return {"success": False, "error": str(e), "input": request.prompt}
+    finally:
+        session.finish()
 @app.post("/generate_stream")
-def generate_stream(req: GenIn):
+async def generate_stream(req: GenIn, http_request: Request):
     """
     Streams output using Server-Sent Events (SSE).
-    Uses HF backend if enabled; otherwise falls back to local chunking.
+    Uses HF backend if enabled; otherwise streams from the local batcher.
+    Returns 503 right away when the inference queue is full.
+    Cached deterministic completions are replayed as a single delta.
+    An X-Profile header or ?profile=1 profiles the request (see profiling.py).
     """
+    start = time.perf_counter()
     prompt = req.prompt or ""
-    max_tokens = int(req.max_tokens or 40)
-    temperature = float(req.temperature or 0.8)
-    top_k = int(req.top_k or 50)
+    params = _sampling_params(req)
+    outcome = {"value": "ok"}
+    session, headers = await _start_profile("generate_stream", http_request)
 
-    def sse_hf():
-        # Stream token pieces directly from the HF backend
-        for piece in hf.stream(
-            prompt=prompt,
-            max_tokens=max_tokens,
-            temperature=temperature,
-            top_k=top_k,
-        ):
-            # Frontend expects {"delta": "..."} lines
-            yield f"data: {json.dumps({'delta': piece})}\n\n"
+    async def sse_cached(continuation: str):
+        # Replay a cached deterministic completion without touching the model
+        if continuation:
+            yield f"data: {json.dumps({'delta': continuation})}\n\n"
         yield "event: done\ndata: {}\n\n"
+        _observe_request("generate_stream", "cached", start)
 
-    def sse_local():
-        # Fallback: generate full text then emit in small chunks
+    async def sse_hf():
+        # Stream token pieces directly from the HF backend
         try:
-            result = generate_text(GenIn(
-                prompt=prompt,
-                max_tokens=max_tokens,
-                temperature=temperature,
-                top_k=top_k
-            ))
-            if not result.get("success"):
-                raise Exception(result.get("error", "Generation failed"))
-            full = result.get("generated", "")
+            pieces = []
+            async for piece in session.timed("wait_token", _hf_stream(prompt, params)):
+                if not piece:
+                    continue
+                pieces.append(piece)
+                # Frontend expects {"delta": "..."} lines
+                with session.span("sse_serialize"):
+                    event = f"data: {json.dumps({'delta': piece})}\n\n"
+                yield event
+            if key is not None:
+                continuation = "".join(pieces)
+                response = {"success": True, "input": prompt, "generated": prompt + continuation, "backend": "hf"}
+                response_cache.put(key, {"response": response, "continuation": continuation})
+            yield "event: done\ndata: {}\n\n"
         except Exception as e:
-            def err():
-                yield f"event: error\ndata: {json.dumps({'error': str(e)})}\n\n"
-            return StreamingResponse(err(), media_type="text/event-stream")
-
-        def chunker():
-            words = full.split(" ")
-            buf = ""
-            for i, w in enumerate(words):
-                buf = (buf + " " + w).strip()
-                if i % 3 == 2 or i == len(words) - 1:
-                    yield f"data: {json.dumps({'delta': buf})}\n\n"
-                    buf = ""
-                    time.sleep(0.03)
+            outcome["value"] = "error"
+            yield f"event: error\ndata: {json.dumps({'error': str(e)})}\n\n"
+
+    async def sse_local():
+        # Emit each piece as soon as the batcher samples it (continuation only, like HF)
+        stream = None
+        try:
+            with session.span("tokenize"):
+                input_ids = encode_prompt(prompt)
+            # A few prompt ids give the decoder context for word-boundary markers
+            decoder = IncrementalDecoder(sp.decode, input_ids[-4:])
+            stream = batcher.stream(input_ids, **params, loop=asyncio.get_running_loop())
+            generated, pieces = [], []
+            async for token in session.timed("wait_token", stream):
+                generated.append(token)
+                with session.span("detokenize"):
+                    piece = decoder.push(token)
+                if piece:
+                    pieces.append(piece)
+                    with session.span("sse_serialize"):
+                        event = f"data: {json.dumps({'delta': piece})}\n\n"
+                    yield event
+            tail = decoder.flush()
+            if tail:
+                pieces.append(tail)
+                yield f"data: {json.dumps({'delta': tail})}\n\n"
+            if key is not None:
+                response = _local_response(prompt, input_ids, generated)
+                response_cache.put(key, {"response": response, "continuation": "".join(pieces)})
             yield "event: done\ndata: {}\n\n"
+        except Exception as e:
+            outcome["value"] = "error"
+            yield f"event: error\ndata: {json.dumps({'error': str(e)})}\n\n"
+        finally:
+            if stream is not None:
+                stream.cancel()
+
+    async def admitted(events):
+        # Hold the admission slot until the stream ends or the client goes away
+        try:
+            async for event in events:
+                # The generator is suspended while the server writes the event out
+                with session.span("sse_send"):
+                    yield event
+        finally:
+            executor.release()
+            _observe_request("generate_stream", outcome["value"], start)
+            session.finish()
 
-        return StreamingResponse(chunker(), media_type="text/event-stream")
+    async def profiled(events):
+        try:
+            async for event in events:
+                yield event
+        finally:
+            session.finish()
+
+    with session.span("cache_lookup"):
+        key = _cache_key(prompt, params)
+        cached = await response_cache.get_async(key) if key is not None else None
+    if cached is not None and cached.get("continuation") is not None:
+        return StreamingResponse(profiled(sse_cached(cached["continuation"])), media_type="text/event-stream",
+                                 headers=headers)
+
+    try:
+        executor.acquire()
+    except QueueFull as e:
+        _observe_request("generate_stream", "busy", start)
+        session.finish()
+        busy = _busy(prompt, e)
+        busy.headers.update(headers)
+        return busy
 
     # Choose the streaming path
     if hf is not None:
-        return StreamingResponse(sse_hf(), media_type="text/event-stream")
+        return StreamingResponse(admitted(sse_hf()), media_type="text/event-stream", headers=headers)
     else:
-        return sse_local()
+        return StreamingResponse(admitted(sse_local()), media_type="text/event-stream", headers=headers)
 
 @app.get("/vocab")
-def get_vocabulary():
+async def get_vocabulary():
     try:
         vocab_size = sp.get_piece_size()
         sample_pieces = []
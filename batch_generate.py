@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+"""
+Offline batch generation over a JSONL file of prompts.
+
+Prompts are tokenized up front, sorted by length and handed to the same
+batched decode loops the API server uses (LocalBatcher / HFBatchEngine),
+one length bucket at a time, so rows that decode together need little or
+no padding. With --workers, several forked processes share the weights;
+every bucket is sent whole to the worker with the fewest buckets in flight,
+so each worker decodes its own buckets on its own cores.
+
+Results are appended to the output JSONL as they finish. Rerunning with
+the same output file skips every prompt that already has a result.
+
+Usage:
+    python batch_generate.py prompts.jsonl -o completions.jsonl --max-tokens 64
+    python batch_generate.py requests.jsonl --prompt-field body --id-field request_id --backend hf
+"""
+
+import argparse
+import json
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from typing import Dict, List, Optional
+
+import torch
+
+from local_batcher import LocalBatcher
+from local_model import CHECK_PROMPTS, load_tiny_model, prepare_serving_model
+from streaming import IncrementalDecoder
+from tokenizer import SentencePieceTokenizer, unflatten
+
+# Per-prompt fields that override the command-line sampling defaults
+SAMPLING_FIELDS = ("max_tokens", "temperature", "top_k", "top_p", "repetition_penalty", "seed")
+
+
+def read_prompts(path: str, prompt_field: str, id_field: str) -> List[Dict]:
+    prompts = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f):
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if prompt_field not in record:
+                raise ValueError(f"{path}:{line_no + 1}: no {prompt_field!r} field")
+            record.setdefault(id_field, line_no)
+            prompts.append(record)
+    return prompts
+
+
+def finished_ids(path: str, id_field: str) -> set:
+    """Ids that already have a successful result in `path` (for resuming)."""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # a line cut short by a crash; that prompt is redone
+            if "error" not in record:
+                done.add(json.dumps(record.get(id_field)))
+    return done
+
+
+class LocalRunner:
+    """TinyModel + SentencePiece, loaded as in api_server.py."""
+
+    backend = "local"
+
+    def __init__(self, args):
+        self.tokenizer = SentencePieceTokenizer(args.tokenizer)
+        self.sp = self.tokenizer.sp
+        model, self.load_msg = load_tiny_model(args.model_path)
+        model, self.model_mode = prepare_serving_model(model, args.mode, self.encode_all(CHECK_PROMPTS))
+        self.model = model
+        self.max_batch = args.max_batch
+
+    def build_backend(self):
+        return LocalBatcher(self.model, self.sp.eos_id(), window_ms=50, max_batch=self.max_batch)
+
+    def encode_all(self, prompts: List[str]) -> List[List[int]]:
+        # One multi-threaded SentencePiece call for the whole input
+        return unflatten(*self.tokenizer.encode_batch(prompts))
+
+    def submit(self, backend, prompt: str, ids: List[int], params: Dict, worker: Optional[int] = None) -> Future:
+        pinned = {} if worker is None else {"worker": worker}
+        return backend.submit(ids, **params, **pinned)
+
+    def result(self, prompt: str, ids: List[int], output) -> Dict:
+        decoder = IncrementalDecoder(self.sp.decode, ids[-4:])
+        completion = "".join(decoder.push(t) for t in output) + decoder.flush()
+        return {"completion": completion, "text": self.sp.decode(ids + output), "completion_tokens": len(output)}
+
+
+class HFRunner:
+    """HFTextGen wrapped in the continuous-batching engine."""
+
+    backend = "hf"
+
+    def __init__(self, args):
+        from hf_backend import HFTextGen
+        self.gen = HFTextGen(args.hf_model)
+        self.model = self.gen.model
+        self.max_batch = args.max_batch
+        self.max_positions = getattr(self.model.config, "max_position_embeddings", None)
+
+    def build_backend(self):
+        from hf_backend import HFBatchEngine
+        return HFBatchEngine(self.gen, max_batch=self.max_batch)
+
+    def encode_all(self, prompts: List[str]) -> List[List[int]]:
+        return self.gen.tok(prompts)["input_ids"] if prompts else []
+
+    def submit(self, backend, prompt: str, ids: List[int], params: Dict, worker: Optional[int] = None) -> Future:
+        if self.max_positions and len(ids) + params["max_tokens"] > self.max_positions:
+            # Fail this row alone instead of the whole engine batch it would join
+            future = Future()
+            future.set_exception(ValueError(
+                f"{len(ids)} prompt + {params['max_tokens']} new tokens exceed the model's "
+                f"{self.max_positions} positions"))
+            return future
+        pinned = {} if worker is None else {"worker": worker}
+        return backend.submit(prompt, **params, **pinned).future
+
+    def result(self, prompt: str, ids: List[int], output: str) -> Dict:
+        completion = output[len(prompt):] if output.startswith(prompt) else output
+        # The engine only hands back text, so count the continuation by re-encoding it
+        tokens = len(self.gen.tok(output)["input_ids"]) - len(ids)
+        return {"completion": completion, "text": output, "completion_tokens": max(0, tokens)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate completions for a JSONL file of prompts")
+    parser.add_argument("input", help="JSONL with one prompt object per line")
+    parser.add_argument("-o", "--output", default="completions.jsonl")
+    parser.add_argument("--prompt-field", default="prompt")
+    parser.add_argument("--id-field", default="id", help="defaults to the line number when missing")
+    parser.add_argument("--backend", choices=["local", "hf"], default="local")
+    parser.add_argument("--model-path", default="mini_llm.pth")
+    parser.add_argument("--tokenizer", default="mymodel.model")
+    parser.add_argument("--mode", default="fp32", help="LOCAL_MODEL_MODE for the local model")
+    parser.add_argument("--hf-model", default="distilgpt2")
+    parser.add_argument("--max-batch", type=int, default=32, help="prompts per length bucket")
+    parser.add_argument("--workers", type=int, default=0, help="forked decode processes (0 = this process)")
+    parser.add_argument("--max-tokens", type=int, default=64)
+    parser.add_argument("--temperature", type=float, default=0.9)
+    parser.add_argument("--top-k", type=int, default=50)
+    parser.add_argument("--top-p", type=float, default=1.0)
+    parser.add_argument("--repetition-penalty", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    runner = LocalRunner(args) if args.backend == "local" else HFRunner(args)
+    defaults = {
+        "max_tokens": args.max_tokens,
+        "temperature": args.temperature,
+        "top_k": args.top_k,
+        "top_p": args.top_p,
+        "repetition_penalty": args.repetition_penalty,
+        "seed": args.seed,
+    }
+
+    prompts = read_prompts(args.input, args.prompt_field, args.id_field)
+    done = finished_ids(args.output, args.id_field)
+    todo = [p for p in prompts if json.dumps(p[args.id_field]) not in done]
+    print(f"📝 {len(prompts)} prompts, {len(prompts) - len(todo)} already done, {len(todo)} to generate")
+
+    # Sort by token length so each bucket of max_batch prompts has near-equal lengths
+    encoded = runner.encode_all([str(p[args.prompt_field]) for p in todo])
+    work = sorted(zip(encoded, todo), key=lambda item: len(item[0]))
+    buckets = [work[i:i + args.max_batch] for i in range(0, len(work), args.max_batch)]
+
+    if args.workers > 0:
+        from worker_pool import PooledHFEngine, PooledLocalBatcher, WorkerPool
+        pool = WorkerPool(args.workers, lambda: (runner.build_backend(), None) if runner.backend == "local"
+                          else (None, runner.build_backend()), shared_modules=[runner.model])
+        backends = [PooledLocalBatcher(pool) if runner.backend == "local" else PooledHFEngine(pool)]
+        # Keep every worker busy with its own bucket
+        in_flight_buckets = 2 * args.workers
+    else:
+        backends = [runner.build_backend()]
+        in_flight_buckets = 2
+
+    prompt_tokens = completion_tokens = completed = failed = 0
+    start = time.perf_counter()
+    pending: Dict[Future, tuple] = {}
+    next_bucket = 0
+
+    def fill():
+        nonlocal next_bucket
+        while next_bucket < len(buckets) and len({b for _, _, b, _ in pending.values()}) < in_flight_buckets:
+            worker = None
+            if args.workers > 0:
+                # The whole bucket goes to one worker, so its rows share that worker's decode batch
+                busy = {(b, w) for _, _, b, w in pending.values()}
+                worker = min(range(args.workers), key=lambda w: sum(1 for _, bw in busy if bw == w))
+            for ids, record in buckets[next_bucket]:
+                params = {**defaults, **{k: record[k] for k in SAMPLING_FIELDS if k in record}}
+                prompt = str(record[args.prompt_field])
+                future = runner.submit(backends[0], prompt, ids, params, worker)
+                pending[future] = (ids, record, next_bucket, worker)
+            next_bucket += 1
+
+    with open(args.output, "a", encoding="utf-8") as out:
+        fill()
+        while pending:
+            finished, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+            for future in finished:
+                ids, record, _, _ = pending.pop(future)
+                prompt = str(record[args.prompt_field])
+                result = {args.id_field: record[args.id_field], "prompt": prompt, "backend": runner.backend}
+                try:
+                    result.update(runner.result(prompt, ids, future.result()))
+                    result["prompt_tokens"] = len(ids)
+                    prompt_tokens += len(ids)
+                    completion_tokens += result["completion_tokens"]
+                    completed += 1
+                except Exception as e:
+                    result["error"] = f"{type(e).__name__}: {e}"
+                    failed += 1
+                out.write(json.dumps(result, ensure_ascii=False) + "\n")
+            out.flush()
+            fill()
+
+    elapsed = time.perf_counter() - start
+    print(f"✅ {completed} completions ({failed} failed) in {elapsed:.2f}s: "
+          f"{completion_tokens / elapsed if elapsed else 0:.0f} generated tok/s, "
+          f"{(prompt_tokens + completion_tokens) / elapsed if elapsed else 0:.0f} total tok/s "
+          f"with {max(1, args.workers)} process(es), {torch.get_num_threads()} torch threads")
+
+
+if __name__ == "__main__":
+    main()
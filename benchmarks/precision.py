@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+fp32 eager vs bf16 autocast vs torch.compile, for training and serving.
+
+Training: MiniLLM is trained for a fixed number of steps on a synthetic
+token file in every configuration, from the same initial weights and batch
+order, and the median step time and loss curve are compared against fp32
+eager.
+
+Serving: every LOCAL_MODEL_MODE variant of TinyModel runs batched decode
+steps (one token per row, carrying the LSTM state) and a prompt prefill.
+
+Usage:
+    python -m benchmarks.precision --steps 200 --batch-size 64
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import torch
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.train_scaling import write_corpus  # noqa: E402
+from local_model import CHECK_PROMPTS, TinyModel, prepare_serving_model  # noqa: E402
+from train_llm import MiniLLM, ShuffledBatches, WindowBatchDataset, autocast, training_forward  # noqa: E402
+
+TRAIN_CONFIGS = [("fp32", False), ("bf16", False), ("fp32", True), ("bf16", True)]
+
+
+def bench_training(data, steps, batch_size, warmup, seed=0):
+    device = torch.device("cpu")
+    dataset = WindowBatchDataset(data, 8)
+    batches = ShuffledBatches(len(dataset), batch_size, seed=seed)
+    order = [b for _, b in zip(range(steps), iter(batches))]
+
+    results = []
+    for precision, compile_model in TRAIN_CONFIGS:
+        torch.manual_seed(seed)
+        model = MiniLLM()
+        loss_fn = torch.nn.CrossEntropyLoss()
+        forward, used = training_forward(model, loss_fn, precision, compile_model,
+                                         dataset.__getitems__(order[0]), device)
+        optimizer = torch.optim.Adam(model.parameters(), lr=0.001)
+
+        times, losses = [], []
+        for indices in order:
+            x, y = dataset.__getitems__(indices)
+            start = time.perf_counter()
+            with autocast(used, device):
+                loss = loss_fn(forward(x), y)
+            loss.backward()
+            optimizer.step()
+            optimizer.zero_grad()
+            losses.append(loss.item())
+            times.append(time.perf_counter() - start)
+
+        results.append({
+            "precision": used,
+            "compiled": forward is not model,
+            "requested": f"{precision}{'+compile' if compile_model else ''}",
+            "median_step_ms": 1000 * statistics.median(times[warmup:] or times),
+            "first_step_ms": 1000 * times[0],
+            "final_loss": statistics.mean(losses[-10:]),
+            "losses": losses,
+        })
+
+    reference = results[0]
+    for result in results:
+        result["speedup"] = reference["median_step_ms"] / result["median_step_ms"]
+        result["max_loss_diff"] = max(abs(a - b) for a, b in zip(result["losses"], reference["losses"]))
+    return results
+
+
+def bench_serving(batch, decode_steps, prompt_len, min_agreement):
+    torch.manual_seed(0)
+    base = TinyModel().eval()
+    check_prompts = [[(7 * i + j) % 100 for j in range(4, 12)] for i in range(len(CHECK_PROMPTS))]
+
+    results = []
+    for mode in ("fp32", "bf16", "int8", "compile", "bf16-compile"):
+        model, info = prepare_serving_model(base, mode, check_prompts, min_agreement)
+        prompt = torch.randint(0, 100, (batch, prompt_len))
+        with torch.no_grad():
+            for _ in range(3):
+                output, state = model(prompt)
+            start = time.perf_counter()
+            output, state = model(prompt)
+            prefill = time.perf_counter() - start
+
+            token = output[:, -1, :].argmax(-1, keepdim=True)
+            times = []
+            for _ in range(decode_steps):
+                start = time.perf_counter()
+                output, state = model(token, state)
+                token = output[:, -1, :].argmax(-1, keepdim=True)
+                times.append(time.perf_counter() - start)
+
+        results.append({
+            "mode": mode,
+            "served_as": info["mode"],
+            "token_agreement": info.get("token_agreement"),
+            "prefill_ms": 1000 * prefill,
+            "decode_step_ms": 1000 * statistics.median(times[5:] or times),
+        })
+
+    reference = results[0]["decode_step_ms"]
+    for result in results:
+        result["speedup"] = reference / result["decode_step_ms"]
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare fp32 / bf16 autocast / torch.compile step times")
+    parser.add_argument("--steps", type=int, default=200, help="training steps per configuration")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--warmup", type=int, default=10, help="training steps left out of the median")
+    parser.add_argument("--tokens", type=int, default=500_000, help="size of the synthetic corpus")
+    parser.add_argument("--decode-batch", type=int, default=32)
+    parser.add_argument("--decode-steps", type=int, default=100)
+    parser.add_argument("--prompt-len", type=int, default=64)
+    parser.add_argument("--threads", type=int, default=0, help="torch threads (0 = torch default)")
+    parser.add_argument("--json", default="", help="also write the results here")
+    args = parser.parse_args()
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        data = os.path.join(workdir, "synthetic.bin")
+        write_corpus(data, args.tokens)
+        training = bench_training(data, args.steps, args.batch_size, args.warmup)
+
+    print(f"\n🏋️ Training: {args.steps} steps, batch {args.batch_size}, {torch.get_num_threads()} threads")
+    print(f"{'config':>14} {'ran as':>14} {'step ms':>9} {'speedup':>8} {'final loss':>11} {'max |dloss|':>12}")
+    for r in training:
+        ran_as = f"{r['precision']}{'+compile' if r['compiled'] else ''}"
+        print(f"{r['requested']:>14} {ran_as:>14} {r['median_step_ms']:>9.2f} {r['speedup']:>8.2f} "
+              f"{r['final_loss']:>11.4f} {r['max_loss_diff']:>12.4f}")
+
+    serving = bench_serving(args.decode_batch, args.decode_steps, args.prompt_len, min_agreement=0.0)
+    print(f"\n🚀 Serving: decode batch {args.decode_batch}, prompt {args.prompt_len} tokens")
+    print(f"{'mode':>14} {'served as':>14} {'prefill ms':>11} {'decode ms':>10} {'speedup':>8} {'agreement':>10}")
+    for r in serving:
+        agreement = "" if r["token_agreement"] is None else f"{r['token_agreement']:.3f}"
+        print(f"{r['mode']:>14} {r['served_as']:>14} {r['prefill_ms']:>11.2f} {r['decode_step_ms']:>10.3f} "
+              f"{r['speedup']:>8.2f} {agreement:>10}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"training": training, "serving": serving}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,537 @@
+#!/usr/bin/env python3
+"""
+End-to-end serving benchmark for api_server.py, local and hf backends.
+
+Every scenario (backend x driver x endpoint x concurrency) sends the same
+seeded workload: prompts cut from training_data.txt with word counts drawn
+from --prompt-words and max_tokens drawn from --max-tokens, each request
+with its own sampling seed. A closed loop of `concurrency` clients keeps
+that many requests in flight.
+
+Drivers:
+    inprocess  the FastAPI app is called directly over ASGI, in a fresh
+               child process per backend (api_server reads its config at import)
+    uvicorn    the app is served by a uvicorn subprocess on a local port
+
+The hf backend uses a tiny randomly initialized GPT-2 with a byte-level BPE
+tokenizer trained on training_data.txt, built on the fly, so nothing is
+downloaded. Generated tokens are read from the server's /metrics counters.
+Every level replays the same prompts, so the response, prefix-state and
+token caches are off unless --env turns them back on; otherwise later
+levels would be served from state warmed by earlier ones.
+
+Reports p50/p95/p99 latency, time to first byte of the response (the first
+delta for /generate_stream), generated tokens/sec and the server's peak RSS.
+Results can be written as JSON and compared against a stored baseline;
+the exit status is 1 when any metric regresses by more than --threshold.
+
+Usage:
+    python -m benchmarks.serving --json base.json
+    python -m benchmarks.serving --backends local --concurrency 1 8 --baseline base.json --threshold 0.15
+    python -m benchmarks.serving --results new.json --baseline base.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import re
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import h11
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Server settings for every run; --env overrides them. Caches are off because every level replays the workload.
+DEFAULT_ENV = {
+    "RESPONSE_CACHE_MB": "0",
+    "PREFIX_CACHE_MB": "0",
+    "TOKEN_CACHE_TOKENS": "0",
+    "PROFILE_MAX_PER_MINUTE": "0",
+    "INFERENCE_QUEUE": "1024",
+}
+
+# Metrics compared against a baseline, and whether a larger value is worse
+COMPARED = [
+    ("latency_ms.p50", True),
+    ("latency_ms.p95", True),
+    ("latency_ms.p99", True),
+    ("ttft_ms.p50", True),
+    ("ttft_ms.p95", True),
+    ("tokens_per_sec", False),
+    ("peak_rss_mb", True),
+]
+
+_GENERATED_RE = re.compile(r"^llm_generated_tokens_total(?:\{[^}]*\})? (\S+)$", re.M)
+
+
+# ----------------------------
+# Workload
+# ----------------------------
+def parse_distribution(spec):
+    """
+    Parse "fixed:N", "uniform:LO:HI" or "normal:MEAN:STD" into a sampler.
+
+    Returns:
+        A function taking a random.Random and returning an int >= 1
+    """
+    kind, *values = spec.split(":")
+    try:
+        values = [float(v) for v in values]
+        if kind == "fixed" and len(values) == 1:
+            return lambda rng: max(1, int(values[0]))
+        if kind == "uniform" and len(values) == 2:
+            return lambda rng: max(1, rng.randint(int(values[0]), int(values[1])))
+        if kind == "normal" and len(values) == 2:
+            return lambda rng: max(1, round(rng.gauss(values[0], values[1])))
+    except ValueError:
+        pass
+    raise argparse.ArgumentTypeError(f"bad distribution {spec!r}; use fixed:N, uniform:LO:HI or normal:MEAN:STD")
+
+
+def build_workload(num_requests, prompt_words, max_tokens, seed=0, corpus=None):
+    """The same list of request bodies for a given seed and distributions."""
+    with open(corpus or os.path.join(ROOT, "training_data.txt"), encoding="utf-8") as f:
+        words = f.read().split()
+    rng = random.Random(seed)
+    workload = []
+    for _ in range(num_requests):
+        length = min(prompt_words(rng), len(words))
+        start = rng.randrange(len(words) - length + 1)
+        workload.append({
+            "prompt": " ".join(words[start:start + length]),
+            "max_tokens": max_tokens(rng),
+            "temperature": 0.8,
+            "top_k": 50,
+            "seed": rng.randrange(2 ** 31),
+        })
+    return workload
+
+
+def build_tiny_hf_model(path, vocab_size=512, seed=0, corpus=None):
+    """Save a randomly initialized 2-layer GPT-2 and a BPE tokenizer trained on the corpus to `path`."""
+    import torch
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+    from transformers import GPT2Config, GPT2LMHeadModel, PreTrainedTokenizerFast
+
+    eos = "<|endoftext|>"
+    tok = Tokenizer(models.BPE())
+    tok.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tok.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(vocab_size=vocab_size, special_tokens=[eos],
+                                  initial_alphabet=pre_tokenizers.ByteLevel.alphabet(), show_progress=False)
+    tok.train([corpus or os.path.join(ROOT, "training_data.txt")], trainer)
+    fast = PreTrainedTokenizerFast(tokenizer_object=tok, bos_token=eos, eos_token=eos)
+    fast.save_pretrained(path)
+
+    eos_id = fast.convert_tokens_to_ids(eos)
+    config = GPT2Config(vocab_size=len(fast), n_positions=1024, n_embd=64, n_layer=2, n_head=4,
+                        bos_token_id=eos_id, eos_token_id=eos_id)
+    torch.manual_seed(seed)
+    GPT2LMHeadModel(config).save_pretrained(path)
+    return path
+
+
+# ----------------------------
+# Transports
+# ----------------------------
+def asgi_fetch(app):
+    """Call an ASGI app in this process; returns fetch(method, path, body) -> (status, first_byte, body)."""
+    async def fetch(method, path, body=b""):
+        url, _, query = path.partition("?")
+        scope = {
+            "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": method,
+            "scheme": "http", "path": url, "raw_path": url.encode(), "query_string": query.encode(),
+            "root_path": "", "headers": [(b"host", b"bench"), (b"content-type", b"application/json")],
+            "client": ("127.0.0.1", 0), "server": ("bench", 80),
+        }
+        done = asyncio.Event()
+        request_sent = False
+        status, first, chunks = None, None, []
+
+        async def receive():
+            nonlocal request_sent
+            if not request_sent:
+                request_sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            await done.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            nonlocal status, first
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                data = message.get("body", b"")
+                if data:
+                    first = first or time.perf_counter()
+                    chunks.append(data)
+                if not message.get("more_body", False):
+                    done.set()
+
+        try:
+            await app(scope, receive, send)
+        finally:
+            done.set()
+        return status, first, b"".join(chunks)
+    return fetch
+
+
+def http_fetch(host, port):
+    """HTTP/1.1 over a fresh connection per request; same interface as asgi_fetch()."""
+    async def fetch(method, path, body=b""):
+        reader, writer = await asyncio.open_connection(host, port)
+        conn = h11.Connection(h11.CLIENT)
+        headers = [("Host", f"{host}:{port}"), ("Content-Type", "application/json"),
+                   ("Content-Length", str(len(body))), ("Connection", "close")]
+        status, first, chunks = None, None, []
+        try:
+            writer.write(conn.send(h11.Request(method=method, target=path, headers=headers)))
+            if body:
+                writer.write(conn.send(h11.Data(data=body)))
+            writer.write(conn.send(h11.EndOfMessage()))
+            await writer.drain()
+            while True:
+                event = conn.next_event()
+                if event is h11.NEED_DATA:
+                    conn.receive_data(await reader.read(65536))
+                elif isinstance(event, h11.Response):
+                    status = event.status_code
+                elif isinstance(event, h11.Data):
+                    if event.data:
+                        first = first or time.perf_counter()
+                        chunks.append(bytes(event.data))
+                elif isinstance(event, (h11.EndOfMessage, h11.ConnectionClosed)):
+                    break
+        finally:
+            writer.close()
+        return status, first, b"".join(chunks)
+    return fetch
+
+
+# ----------------------------
+# Load generation
+# ----------------------------
+async def drive(fetch, workload, endpoint, concurrency):
+    """Send every request in `workload` with `concurrency` in flight; one record per request."""
+    pending = iter(workload)
+    records = []
+
+    async def client():
+        for body in pending:
+            start = time.perf_counter()
+            try:
+                status, first, data = await fetch("POST", f"/{endpoint}", json.dumps(body).encode())
+                ok = status == 200 and _succeeded(endpoint, data)
+            except Exception:
+                first, ok = None, False
+            end = time.perf_counter()
+            records.append({"latency": end - start, "ttft": (first or end) - start, "ok": ok})
+
+    await asyncio.gather(*(client() for _ in range(max(1, concurrency))))
+    return records
+
+
+def _succeeded(endpoint, data):
+    if endpoint == "generate_stream":
+        return b"event: done" in data and b"event: error" not in data
+    return bool(json.loads(data).get("success"))
+
+
+async def generated_tokens(fetch):
+    """Total of the server's llm_generated_tokens_total counters."""
+    status, _, data = await fetch("GET", "/metrics")
+    if status != 200:
+        return 0.0
+    return sum(float(value) for value in _GENERATED_RE.findall(data.decode()))
+
+
+def percentiles(values):
+    ordered = sorted(values)
+    if not ordered:
+        return {"p50": 0.0, "p95": 0.0, "p99": 0.0, "mean": 0.0}
+
+    def at(q):
+        # Nearest rank
+        return 1000 * ordered[min(len(ordered) - 1, max(0, int(round(q * len(ordered))) - 1))]
+
+    return {"p50": at(0.50), "p95": at(0.95), "p99": at(0.99), "mean": 1000 * sum(ordered) / len(ordered)}
+
+
+async def run_scenarios(fetch, workload, endpoints, levels, warmup, peak_rss):
+    """Run every endpoint x concurrency level against one server."""
+    results = []
+    for endpoint in endpoints:
+        await drive(fetch, workload[:warmup], endpoint, min(warmup, max(levels)))
+        for concurrency in levels:
+            before = await generated_tokens(fetch)
+            start = time.perf_counter()
+            records = await drive(fetch, workload, endpoint, concurrency)
+            wall = time.perf_counter() - start
+            tokens = await generated_tokens(fetch) - before
+            done = [r for r in records if r["ok"]]
+            results.append({
+                "endpoint": endpoint,
+                "concurrency": concurrency,
+                "requests": len(records),
+                "errors": len(records) - len(done),
+                "wall_s": wall,
+                "requests_per_sec": len(done) / wall,
+                "generated_tokens": int(tokens),
+                "tokens_per_sec": tokens / wall,
+                "latency_ms": percentiles([r["latency"] for r in done]),
+                "ttft_ms": percentiles([r["ttft"] for r in done]),
+                # Peak of the server process(es) so far, so it never drops across scenarios
+                "peak_rss_mb": peak_rss(),
+            })
+    return results
+
+
+# ----------------------------
+# Drivers
+# ----------------------------
+def _server_env(backend, hf_model, extra):
+    env = dict(os.environ, **DEFAULT_ENV, MODEL_BACKEND=backend, PYTHONPATH=ROOT)
+    if backend == "hf":
+        env["HF_MODEL_NAME"] = hf_model
+    env.update(extra)
+    return env
+
+
+def run_inprocess(backend, hf_model, extra_env, plan):
+    """Benchmark the app over ASGI in a child process, so each backend gets a fresh import of api_server."""
+    with tempfile.NamedTemporaryFile("r", suffix=".json") as out:
+        cmd = [sys.executable, "-m", "benchmarks.serving", "--child", json.dumps(plan), "--child-output", out.name]
+        subprocess.run(cmd, cwd=ROOT, env=_server_env(backend, hf_model, extra_env), check=True,
+                       stdout=subprocess.DEVNULL)
+        return json.load(out)
+
+
+def _child(plan, output):
+    import api_server
+
+    def peak_rss():
+        # ru_maxrss is in KiB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    results = asyncio.run(run_scenarios(asgi_fetch(api_server.app), plan["workload"], plan["endpoints"],
+                                        plan["concurrency"], plan["warmup"], peak_rss))
+    with open(output, "w") as f:
+        json.dump(results, f)
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _peak_rss_tree(pid):
+    """Summed VmHWM of a process and its children, in MiB (Linux /proc); shared pages count per process."""
+    total, stack = 0, [pid]
+    while stack:
+        current = stack.pop()
+        try:
+            with open(f"/proc/{current}/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        total += int(line.split()[1])
+            with open(f"/proc/{current}/task/{current}/children") as f:
+                stack.extend(int(child) for child in f.read().split())
+        except (FileNotFoundError, ProcessLookupError):
+            continue
+    return total / 1024
+
+
+def run_uvicorn(backend, hf_model, extra_env, plan, startup_timeout=120.0):
+    """Benchmark the app served by a uvicorn subprocess on a free local port."""
+    port = _free_port()
+    cmd = [sys.executable, "-m", "uvicorn", "api_server:app", "--host", "127.0.0.1", "--port", str(port),
+           "--log-level", "warning"]
+    server = subprocess.Popen(cmd, cwd=ROOT, env=_server_env(backend, hf_model, extra_env),
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        fetch = http_fetch("127.0.0.1", port)
+        deadline = time.monotonic() + startup_timeout
+        while True:
+            if server.poll() is not None:
+                raise RuntimeError(f"uvicorn exited with status {server.returncode} during startup")
+            try:
+                if asyncio.run(fetch("GET", "/health"))[0] == 200:
+                    break
+            except OSError:
+                pass
+            if time.monotonic() > deadline:
+                raise RuntimeError("uvicorn did not come up in time")
+            time.sleep(0.25)
+        return asyncio.run(run_scenarios(fetch, plan["workload"], plan["endpoints"], plan["concurrency"],
+                                         plan["warmup"], lambda: _peak_rss_tree(server.pid)))
+    finally:
+        server.terminate()
+        try:
+            server.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+
+
+# ----------------------------
+# Baseline comparison
+# ----------------------------
+def _key(result):
+    return (result["backend"], result["driver"], result["endpoint"], result["concurrency"])
+
+
+def _metric(result, path):
+    value = result
+    for part in path.split("."):
+        value = value[part]
+    return value
+
+
+def compare(results, baseline, threshold):
+    """
+    Relative change of every compared metric for scenarios present in both runs.
+
+    Returns:
+        (rows, regressions) where each row is (scenario, metric, baseline, current, change)
+        and change > threshold means worse
+    """
+    previous = {_key(r): r for r in baseline["results"]}
+    rows, regressions = [], []
+    for result in results["results"]:
+        old = previous.get(_key(result))
+        if old is None:
+            continue
+        for path, larger_is_worse in COMPARED:
+            before, after = _metric(old, path), _metric(result, path)
+            if not before:
+                continue
+            change = (after - before) / before if larger_is_worse else (before - after) / before
+            row = ("/".join(str(part) for part in _key(result)), path, before, after, change)
+            rows.append(row)
+            if change > threshold:
+                regressions.append(row)
+    return rows, regressions
+
+
+# ----------------------------
+# CLI
+# ----------------------------
+def _print_results(results):
+    print(f"\n{'backend':>7} {'driver':>9} {'endpoint':>15} {'conc':>5} {'err':>4} {'p50 ms':>9} {'p95 ms':>9} "
+          f"{'p99 ms':>9} {'ttft p50':>9} {'tok/s':>9} {'rss MB':>8}")
+    for r in results:
+        lat, ttft = r["latency_ms"], r["ttft_ms"]
+        print(f"{r['backend']:>7} {r['driver']:>9} {r['endpoint']:>15} {r['concurrency']:>5} {r['errors']:>4} "
+              f"{lat['p50']:>9.1f} {lat['p95']:>9.1f} {lat['p99']:>9.1f} {ttft['p50']:>9.1f} "
+              f"{r['tokens_per_sec']:>9.1f} {r['peak_rss_mb']:>8.1f}")
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Latency / throughput of api_server.py under load")
+    parser.add_argument("--backends", nargs="+", choices=["local", "hf"], default=["local", "hf"])
+    parser.add_argument("--drivers", nargs="+", choices=["inprocess", "uvicorn"], default=["inprocess", "uvicorn"])
+    parser.add_argument("--endpoints", nargs="+", choices=["generate", "generate_stream"],
+                        default=["generate", "generate_stream"])
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16], help="requests in flight")
+    parser.add_argument("--requests", type=int, default=32, help="requests per scenario")
+    parser.add_argument("--warmup", type=int, default=4, help="requests sent before each endpoint's scenarios")
+    parser.add_argument("--prompt-words", default="uniform:8:64",
+                        help="prompt length in words: fixed:N, uniform:LO:HI or normal:MEAN:STD")
+    parser.add_argument("--max-tokens", default="uniform:16:64",
+                        help="max_tokens per request, same forms as --prompt-words")
+    parser.add_argument("--seed", type=int, default=0, help="workload seed")
+    parser.add_argument("--hf-model", default="", help="HF model directory (default: build a tiny random one)")
+    parser.add_argument("--env", nargs="*", default=[], metavar="KEY=VALUE",
+                        help="extra server settings, e.g. HF_BATCHING=0 WORKER_PROCESSES=2")
+    parser.add_argument("--json", default="", help="write the results here")
+    parser.add_argument("--results", default="", help="compare these stored results instead of running")
+    parser.add_argument("--baseline", default="", help="results JSON to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="relative worsening that counts as a regression (0.10 = 10%%)")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--child-output", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        _child(json.loads(args.child), args.child_output)
+        return
+
+    if args.results:
+        with open(args.results) as f:
+            results = json.load(f)
+    else:
+        try:
+            prompt_words, max_tokens = parse_distribution(args.prompt_words), parse_distribution(args.max_tokens)
+        except argparse.ArgumentTypeError as e:
+            parser.error(str(e))
+        extra_env = dict(item.split("=", 1) for item in args.env)
+        workload = build_workload(args.requests, prompt_words, max_tokens, args.seed)
+        plan = {"workload": workload, "endpoints": args.endpoints, "concurrency": args.concurrency,
+                "warmup": args.warmup}
+        results = {
+            "meta": {
+                "commit": _git_commit(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpus": os.cpu_count(),
+                "args": {k: v for k, v in vars(args).items() if k not in ("child", "child_output")},
+                "server_env": {**DEFAULT_ENV, **extra_env},
+            },
+            "results": [],
+        }
+        print(f"🧪 {args.requests} requests per scenario, concurrency {args.concurrency}, "
+              f"{os.cpu_count()} cores, seed {args.seed}")
+
+        with tempfile.TemporaryDirectory() as workdir:
+            hf_model = args.hf_model
+            if "hf" in args.backends and not hf_model:
+                hf_model = build_tiny_hf_model(os.path.join(workdir, "tiny-gpt2"), seed=args.seed)
+            for backend in args.backends:
+                for driver in args.drivers:
+                    print(f"⏱️ {backend} backend, {driver} driver")
+                    run = run_inprocess if driver == "inprocess" else run_uvicorn
+                    for result in run(backend, hf_model, extra_env, plan):
+                        results["results"].append({"backend": backend, "driver": driver, **result})
+
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(results, f, indent=2)
+
+    _print_results(results["results"])
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("meta", {}).get("server_env") != results.get("meta", {}).get("server_env"):
+            print("⚠️ Baseline was run with different server settings; differences may not be regressions")
+        rows, regressions = compare(results, baseline, args.threshold)
+        print(f"\n📊 Against {args.baseline} (regression above {args.threshold:.0%} worse)")
+        print(f"{'scenario':>40} {'metric':>15} {'baseline':>10} {'current':>10} {'worse by':>9}")
+        for scenario, metric, before, after, change in rows:
+            flag = " ❌" if change > args.threshold else ""
+            print(f"{scenario:>40} {metric:>15} {before:>10.2f} {after:>10.2f} {change:>8.1%}{flag}")
+        if regressions:
+            print(f"\n❌ {len(regressions)} regression(s)")
+            sys.exit(1)
+        print("\n✅ No regressions")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Data-parallel training scaling benchmark.
+
+Writes a synthetic token file, then launches train_llm.py under torchrun
+with 1, 2, 4 and 8 processes (gloo) for a fixed number of optimizer steps
+and reports aggregate tokens/sec and scaling efficiency relative to one
+process.
+
+Usage:
+    python -m benchmarks.train_scaling --procs 1 2 4 8 --steps 100
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from token_file import TokenFileWriter  # noqa: E402
+
+
+def write_corpus(path, num_tokens, doc_length=256, vocab_size=100, seed=0):
+    """Random documents of `doc_length` ids, `num_tokens` in total."""
+    rng = np.random.default_rng(seed)
+    with TokenFileWriter(path, vocab_size, "00" * 32) as out:
+        for _ in range(max(1, num_tokens // doc_length)):
+            out.write(rng.integers(0, vocab_size, size=doc_length))
+
+
+def run(procs, data, args, workdir):
+    summary = os.path.join(workdir, f"summary_{procs}.json")
+    cmd = [
+        sys.executable, "-m", "torch.distributed.run",
+        "--standalone", "--nproc_per_node", str(procs),
+        os.path.join(ROOT, "train_llm.py"),
+        "--data", data,
+        "--output", os.path.join(workdir, f"model_{procs}.pth"),
+        "--epochs", "1000",
+        "--max-steps", str(args.steps),
+        "--batch-size", str(args.batch_size),
+        "--workers", str(args.workers),
+        "--threads", str(args.threads),
+        "--log-every", str(10 ** 9),
+        "--summary-json", summary,
+        # Snapshot time would count against throughput, and nothing should land in the repo
+        "--checkpoint-dir", os.path.join(workdir, f"checkpoints_{procs}"),
+        "--no-checkpoints",
+    ]
+    subprocess.run(cmd, cwd=ROOT, check=True, stdout=subprocess.DEVNULL)
+    with open(summary) as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput of train_llm.py across torchrun process counts")
+    parser.add_argument("--procs", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--tokens", type=int, default=2_000_000, help="size of the synthetic corpus")
+    parser.add_argument("--steps", type=int, default=100, help="optimizer steps per run")
+    parser.add_argument("--batch-size", type=int, default=64, help="per-process batch size")
+    parser.add_argument("--workers", type=int, default=1, help="DataLoader workers per process")
+    parser.add_argument("--threads", type=int, default=1, help="torch threads per process")
+    parser.add_argument("--json", default="", help="also write the results here")
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        data = os.path.join(workdir, "synthetic.bin")
+        write_corpus(data, args.tokens)
+        print(f"🧪 {args.tokens} synthetic tokens, {args.steps} steps, batch {args.batch_size} per process, "
+              f"{os.cpu_count()} cores")
+        print(f"{'procs':>5} {'tok/s':>12} {'speedup':>8} {'efficiency':>10}")
+        base = None
+        for procs in args.procs:
+            result = run(procs, data, args, workdir)
+            base = base or result["tokens_per_sec"] / procs
+            result["speedup"] = result["tokens_per_sec"] / base
+            result["efficiency"] = result["speedup"] / procs
+            results.append(result)
+            print(f"{procs:>5} {result['tokens_per_sec']:>12.0f} {result['speedup']:>8.2f} {result['efficiency']:>10.0%}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
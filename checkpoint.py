@@ -0,0 +1,165 @@
+"""
+Training checkpoints: CPU snapshots written atomically from a background thread.
+
+A checkpoint is a plain dict saved with torch.save. Its "model" entry is
+the model's state_dict, so serving code can load it in place of a bare
+state_dict (see model_state_dict). Everything else in it (optimizer state,
+counters, RNG states) is made of tensors and builtins only, so it loads
+with torch.load(weights_only=True).
+"""
+
+import glob
+import os
+import queue
+import random
+import re
+import threading
+from typing import Any, Dict, Optional
+
+import numpy as np
+import torch
+
+CHECKPOINT_PATTERN = "ckpt_step{step:08d}.pt"
+_STEP_RE = re.compile(r"ckpt_step(\d+)\.pt$")
+
+
+def snapshot(obj: Any) -> Any:
+    """Copy every tensor in a nested dict/list structure to CPU memory."""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {k: snapshot(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    return obj
+
+
+def rng_state() -> Dict[str, Any]:
+    """Python, numpy and torch RNG states, in a weights_only-loadable form."""
+    name, keys, pos, has_gauss, cached = np.random.get_state()
+    state = {
+        "python": random.getstate(),
+        "numpy": [name, keys.tolist(), pos, has_gauss, cached],
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state: Dict[str, Any]):
+    random.setstate(_as_tuples(state["python"]))
+    name, keys, pos, has_gauss, cached = state["numpy"]
+    np.random.set_state((name, np.array(keys, dtype=np.uint32), pos, has_gauss, cached))
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def _as_tuples(obj):
+    # random.setstate wants the nested tuples back, not lists
+    if isinstance(obj, (list, tuple)):
+        return tuple(_as_tuples(v) for v in obj)
+    return obj
+
+
+def checkpoint_step(path: str) -> int:
+    match = _STEP_RE.search(os.path.basename(path))
+    return int(match.group(1)) if match else -1
+
+
+def list_checkpoints(directory: str):
+    """Checkpoint files in `directory`, oldest step first."""
+    paths = glob.glob(os.path.join(directory, "ckpt_step*.pt"))
+    return sorted((p for p in paths if checkpoint_step(p) >= 0), key=checkpoint_step)
+
+
+def latest_checkpoint(directory: str) -> Optional[str]:
+    paths = list_checkpoints(directory)
+    return paths[-1] if paths else None
+
+
+def load_checkpoint(path: str) -> Dict[str, Any]:
+    return torch.load(path, map_location="cpu", weights_only=True)
+
+
+def model_state_dict(obj: Dict[str, Any]) -> Dict[str, torch.Tensor]:
+    """The model weights from either a training checkpoint or a bare state_dict."""
+    if isinstance(obj, dict) and isinstance(obj.get("model"), dict):
+        return obj["model"]
+    return obj
+
+
+class CheckpointWriter:
+    """
+    Writes checkpoints on a background thread.
+
+    save() takes a CPU snapshot of the state on the caller's thread (cheap
+    next to a disk write) and returns; the thread writes it to a temporary
+    file, fsyncs and renames it into place, so a crash never leaves a
+    partial checkpoint behind. Only the newest `keep_last` checkpoints are
+    kept. At most one snapshot waits behind the one being written; a
+    further save() blocks until the writer catches up.
+    """
+
+    def __init__(self, directory: str, keep_last: int = 3):
+        self.directory = directory
+        self.keep_last = max(1, int(keep_last))
+        os.makedirs(directory, exist_ok=True)
+        self.error: Optional[BaseException] = None
+        self.last_path: Optional[str] = None
+        self._queue: "queue.Queue" = queue.Queue(maxsize=1)
+        self._thread = threading.Thread(target=self._loop, name="checkpoint-writer", daemon=True)
+        self._thread.start()
+
+    def save(self, state: Dict[str, Any], step: int) -> str:
+        """Queue `state` as the checkpoint for `step` and return its final path."""
+        self._raise_error()
+        path = os.path.join(self.directory, CHECKPOINT_PATTERN.format(step=step))
+        self._queue.put((snapshot(state), path))
+        return path
+
+    def wait(self):
+        """Block until every queued checkpoint is on disk."""
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        self.wait()
+        self._queue.put(None)
+        self._thread.join()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError(f"checkpoint write failed: {error}") from error
+
+    def _loop(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                state, path = item
+                self._write(state, path)
+                self.last_path = path
+                self._prune()
+            except Exception as e:
+                self.error = e
+            finally:
+                self._queue.task_done()
+
+    def _write(self, state: Dict[str, Any], path: str):
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            torch.save(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def _prune(self):
+        for path in list_checkpoints(self.directory)[:-self.keep_last]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
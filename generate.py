@@ -1,52 +1,88 @@
-import torch
-import torch.nn as nn
-import numpy as np
+"""
+Sample continuations from the trained MiniLLM.
+
+Decoding is incremental: each prompt is run through the LSTM once, then
+every step feeds only the newly sampled token together with the carried
+state, so each new token costs one recurrent step. Several seeds are
+decoded together as one batch.
+
+Usage:
+    python generate.py "Hello, I am" "The quick brown fox" --length 30
+"""
+
+import argparse
+from typing import List
+
 import sentencepiece as spm
+import torch
+
+from checkpoint import model_state_dict
+from sampling import Sampler
+from train_llm import MiniLLM
 
 # Load SentencePiece model
 sp = spm.SentencePieceProcessor()
 sp.load("mymodel.model")
 
-# Load training parameters
-context_length = 8
-vocab_size = sp.get_piece_size()
-
-# Define the same model class used during training
-class MiniLLM(nn.Module):
-    def __init__(self, vocab_size, embedding_dim=64, hidden_dim=128):
-        super().__init__()
-        self.embedding = nn.Embedding(vocab_size, embedding_dim)
-        self.rnn = nn.GRU(embedding_dim, hidden_dim, batch_first=True)
-        self.fc = nn.Linear(hidden_dim, vocab_size)
-
-    def forward(self, x, hidden=None):
-        x = self.embedding(x)
-        out, hidden = self.rnn(x, hidden)
-        logits = self.fc(out)
-        return logits[:, -1, :], hidden
-
-# Load model
-model = MiniLLM(vocab_size)
-model.load_state_dict(torch.load("mini_llm.pth"))
+# Load model (same definition as training, so the checkpoint's weights match)
+model = MiniLLM()
+model.load_state_dict(model_state_dict(torch.load("mini_llm.pth", map_location="cpu")))
 model.eval()
 
-def generate_text(seed_text, length=20):
-    tokens = sp.encode(seed_text, out_type=int)
-    tokens = tokens[-context_length:]  # Trim if longer than context
-    input_ids = torch.tensor(tokens, dtype=torch.long).unsqueeze(0)
 
-    result = tokens[:]
+def generate_batch(seed_texts: List[str], length: int = 20, temperature: float = 1.0, top_k: int = 0) -> List[str]:
+    """
+    Continue every seed text by `length` sampled tokens.
 
-    hidden = None
-    for _ in range(length):
-        logits, hidden = model(input_ids, hidden)
-        probs = torch.softmax(logits, dim=-1)
-        next_id = torch.multinomial(probs, num_samples=1).item()
-        result.append(next_id)
-        input_ids = torch.tensor(result[-context_length:], dtype=torch.long).unsqueeze(0)
+    Args:
+        seed_texts: Prompts, decoded together as one batch
+        length: Tokens to sample per prompt
+        temperature: Softmax temperature
+        top_k: Sample from the k most likely tokens only (0 = full vocabulary)
+
+    Returns:
+        Each prompt followed by its continuation
+    """
+    prompts = [sp.encode(text, out_type=int) for text in seed_texts]
+    if any(not ids for ids in prompts):
+        raise ValueError("every seed text must encode to at least one token")
+
+    with torch.no_grad():
+        # Prefill each prompt once (no padding in the recurrent state), then batch the states
+        logits, hs, cs = [], [], []
+        for ids in prompts:
+            out, (h, c) = model.step(torch.tensor([ids], dtype=torch.long))
+            logits.append(out[:, -1, :])
+            hs.append(h)
+            cs.append(c)
+        logits = torch.cat(logits)
+        state = (torch.cat(hs, dim=1), torch.cat(cs, dim=1))
+
+        batch = len(prompts)
+        sampler = Sampler(logits.size(-1), batch)
+        temperatures = torch.full((batch,), float(temperature))
+        top_ks = torch.full((batch,), int(top_k), dtype=torch.long)
+        generated = torch.empty(batch, length, dtype=torch.long)
+        for t in range(length):
+            next_ids = sampler.sample(logits, temperatures, top_ks)
+            generated[:, t] = next_ids
+            out, state = model.step(next_ids.unsqueeze(1), state)
+            logits = out[:, -1, :]
+
+    return [sp.decode(ids + row) for ids, row in zip(prompts, generated.tolist())]
+
+
+def generate_text(seed_text, length=20):
+    return generate_batch([seed_text], length)[0]
 
-    return sp.decode(result)
 
 if __name__ == "__main__":
-    print("Generated:", generate_text("Hello, I am", length=30))
+    parser = argparse.ArgumentParser(description="Sample continuations from mini_llm.pth")
+    parser.add_argument("seeds", nargs="*", default=["Hello, I am"])
+    parser.add_argument("--length", type=int, default=30)
+    parser.add_argument("--temperature", type=float, default=1.0)
+    parser.add_argument("--top-k", type=int, default=0)
+    args = parser.parse_args()
 
+    for text in generate_batch(args.seeds, args.length, args.temperature, args.top_k):
+        print("Generated:", text)
@@ -1,10 +1,21 @@
-from typing import Iterable
+from typing import Iterable, List, Optional, Tuple
+from concurrent.futures import Future
+from contextlib import contextmanager
+import asyncio
+import queue
 import threading
+import time
 import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM, TextIteratorStreamer
+from transformers import AutoTokenizer, AutoModelForCausalLM, DynamicCache
+
+from metrics import RequestTimer, ServingMetrics
+from sampling import Sampler, mark_seen, seeded_generator
+from streaming import IncrementalDecoder, TokenStream
+from token_cache import TokenCache
 
 class HFTextGen:
-    def __init__(self, model_name: str = "distilgpt2"):
+    def __init__(self, model_name: str = "distilgpt2", token_cache: Optional[TokenCache] = None,
+                 metrics: Optional[ServingMetrics] = None):
         self.tok = AutoTokenizer.from_pretrained(model_name)
         # distilgpt2 has no pad token; use eos as pad
         if self.tok.pad_token_id is None and self.tok.eos_token_id is not None:
@@ -13,6 +24,26 @@ class HFTextGen:
         self.model.eval()
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
         self.model.to(self.device)
+        # Shared with the engines built on top of this model
+        self.metrics = metrics
+        self._encode = lambda text: self.tok(text)["input_ids"]
+        if token_cache is not None:
+            self._encode = token_cache.register(
+                f"hf:{self.tok.name_or_path}:{len(self.tok)}",
+                self._encode,
+                lambda texts: self.tok(texts, add_special_tokens=False)["input_ids"],
+            )
+
+    def encode(self, prompt: str) -> List[int]:
+        """Prompt ids, through the token cache when there is one; never empty."""
+        ids = self._encode(prompt)
+        if not ids:
+            ids = [self.tok.bos_token_id if self.tok.bos_token_id is not None else self.tok.eos_token_id]
+        return ids
+
+    def _inputs(self, prompt: str):
+        ids = torch.tensor([self.encode(prompt)], device=self.device)
+        return {"input_ids": ids, "attention_mask": torch.ones_like(ids)}
 
     def generate_once(
         self,
@@ -20,19 +51,27 @@ class HFTextGen:
         max_tokens: int = 60,
         temperature: float = 0.8,
         top_k: int = 50,
+        top_p: float = 1.0,
+        repetition_penalty: float = 1.0,
+        seed: Optional[int] = None,
     ) -> str:
         """Return FULL text (prompt + continuation)."""
-        enc = self.tok(prompt, return_tensors="pt").to(self.device)
-        with torch.no_grad():
+        enc = self._inputs(prompt)
+        timer = RequestTimer(self.metrics, time.perf_counter(), enc["input_ids"].size(1))
+        with torch.no_grad(), _seeded(seed):
             out = self.model.generate(
                 **enc,
+                streamer=_TimingStreamer(timer) if self.metrics is not None else None,
                 max_new_tokens=max(1, int(max_tokens)),
                 do_sample=True,
                 temperature=max(0.01, float(temperature)),
                 top_k=int(top_k),
+                top_p=float(top_p),
+                repetition_penalty=float(repetition_penalty),
                 eos_token_id=self.tok.eos_token_id,
                 pad_token_id=self.tok.pad_token_id or self.tok.eos_token_id,
             )
+        timer.finish()
         text = self.tok.decode(out[0], skip_special_tokens=True)
         return text
 
@@ -42,28 +81,555 @@ class HFTextGen:
         max_tokens: int = 60,
         temperature: float = 0.8,
         top_k: int = 50,
+        top_p: float = 1.0,
+        repetition_penalty: float = 1.0,
+        seed: Optional[int] = None,
     ) -> Iterable[str]:
-        """Yield ONLY the continuation (no prompt) in small chunks."""
-        enc = self.tok(prompt, return_tensors="pt").to(self.device)
-        streamer = TextIteratorStreamer(
-            self.tok,
-            skip_special_tokens=True,
-            skip_prompt=True,
-        )
+        """Yield ONLY the continuation (no prompt) as each token is decoded."""
+        enc = self._inputs(prompt)
+        pieces = TokenStream()
+        streamer = _DeltaStreamer(IncrementalDecoder(lambda ids: self.tok.decode(ids, skip_special_tokens=True)),
+                                  pieces)
+        timer = RequestTimer(self.metrics, time.perf_counter(), enc["input_ids"].size(1))
+        def run(**kwargs):
+            try:
+                with _seeded(seed):
+                    self.model.generate(**kwargs)
+            except Exception as e:
+                pieces.close(e)
+                return
+            timer.finish()
+
         t = threading.Thread(
-            target=self.model.generate,
+            target=run,
             kwargs=dict(
                 **enc,
-                streamer=streamer,
+                streamer=_TimingStreamer(timer, streamer) if self.metrics is not None else streamer,
                 max_new_tokens=max(1, int(max_tokens)),
                 do_sample=True,
                 temperature=max(0.01, float(temperature)),
                 top_k=int(top_k),
+                top_p=float(top_p),
+                repetition_penalty=float(repetition_penalty),
                 eos_token_id=self.tok.eos_token_id,
                 pad_token_id=self.tok.pad_token_id or self.tok.eos_token_id,
             ),
             daemon=True,
         )
         t.start()
-        for chunk in streamer:
-            yield chunk
+        for piece in pieces:
+            yield piece
+
+
+class _DeltaStreamer:
+    """
+    Streamer hook for model.generate that sends each token's text delta to a TokenStream.
+
+    Unlike TextIteratorStreamer, which holds text back until a word
+    boundary, every token that completes some text is released right away;
+    tokens that complete none (e.g. part of a multi-byte character) send
+    nothing.
+    """
+
+    def __init__(self, decoder: IncrementalDecoder, stream: TokenStream):
+        self.decoder = decoder
+        self.stream = stream
+        self._prompt_seen = False
+
+    def put(self, value):
+        if not self._prompt_seen:
+            self._prompt_seen = True
+            return
+        for token in value.reshape(-1).tolist():
+            piece = self.decoder.push(token)
+            if piece:
+                self.stream.put(piece)
+
+    def end(self):
+        tail = self.decoder.flush()
+        if tail:
+            self.stream.put(tail)
+        self.stream.close()
+
+
+class _TimingStreamer:
+    """
+    Streamer hook for model.generate that times prefill and every new token.
+
+    generate() hands a streamer the prompt first and then each sampled
+    token, so the gap between calls is the time per forward pass.
+    Everything is forwarded to `inner` when there is one.
+    """
+
+    def __init__(self, timer: RequestTimer, inner=None):
+        self.timer = timer
+        self.inner = inner
+        self._prompt_seen = False
+
+    def put(self, value):
+        if self._prompt_seen:
+            self.timer.token(time.perf_counter(), int(value.numel()))
+        else:
+            self._prompt_seen = True
+        if self.inner is not None:
+            self.inner.put(value)
+
+    def end(self):
+        if self.inner is not None:
+            self.inner.end()
+
+
+_SEED_LOCK = threading.Lock()
+
+
+@contextmanager
+def _seeded(seed: Optional[int]):
+    """
+    Seed the global torch RNG for one model.generate call and restore it
+    afterwards. generate() has no per-call generator, so seeded calls are
+    serialized; they are only reproducible when no unseeded sampling runs
+    concurrently.
+    """
+    if seed is None:
+        yield
+        return
+    with _SEED_LOCK, torch.random.fork_rng(devices=[]):
+        torch.manual_seed(int(seed))
+        yield
+
+
+def _cache_layers(past) -> List[Tuple[torch.Tensor, torch.Tensor]]:
+    """Per-layer (key, value) tensors from whatever cache object the model returned."""
+    if hasattr(past, "layers"):
+        return [(layer.keys, layer.values) for layer in past.layers]
+    if hasattr(past, "key_cache"):
+        return list(zip(past.key_cache, past.value_cache))
+    return [(layer[0], layer[1]) for layer in past]
+
+
+def _build_cache(layers: List[Tuple[torch.Tensor, torch.Tensor]]) -> DynamicCache:
+    cache = DynamicCache()
+    for i, (k, v) in enumerate(layers):
+        cache.update(k, v, i)
+    return cache
+
+
+def _crop(cache: DynamicCache, length: int):
+    """Drop cached positions beyond `length` (negative crop: positive lengths are deprecated)."""
+    extra = cache.get_seq_length() - length
+    if extra > 0:
+        cache.crop(-extra)
+
+
+def _left_pad(t: torch.Tensor, length: int, dim: int) -> torch.Tensor:
+    missing = length - t.size(dim)
+    if missing <= 0:
+        return t
+    shape = list(t.shape)
+    shape[dim] = missing
+    return torch.cat([t.new_zeros(shape), t], dim=dim)
+
+
+class _HFRequest:
+    def __init__(self, prompt_ids: List[int], max_tokens: int, temperature: float, top_k: int,
+                 top_p: float, repetition_penalty: float, generator: Optional[torch.Generator],
+                 stream: Optional[TokenStream], decoder: Optional[IncrementalDecoder]):
+        self.prompt_ids = prompt_ids
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+        self.repetition_penalty = repetition_penalty
+        self.generator = generator
+        self.stream = stream
+        self.decoder = decoder
+        self.generated: List[int] = []
+        self.position = len(prompt_ids)
+        self.future: Future = Future()
+        self.submitted = time.perf_counter()
+        self.first_token_at = 0.0
+        self.last_token_at = 0.0
+
+    def finish(self, text: str):
+        if self.stream is not None:
+            tail = self.decoder.flush()
+            if tail:
+                self.stream.put(tail)
+            self.stream.close()
+        if not self.future.done():
+            self.future.set_result(text)
+
+    def fail(self, exc: BaseException):
+        if self.stream is not None:
+            self.stream.close(exc)
+        if not self.future.done():
+            self.future.set_exception(exc)
+
+
+class HFBatchEngine:
+    """
+    Continuous (iteration-level) batching on top of an HFTextGen.
+
+    One background thread owns the decode loop. Between token steps it admits
+    queued requests (prefilled together, then merged into the running KV
+    cache) and drops rows that hit eos or their max_tokens. The cache is kept
+    left-padded so every row appends its next key/value in the same column;
+    each row keeps its own position ids and sampling parameters.
+
+    Exposes the same generate_once()/stream() methods as HFTextGen.
+    """
+
+    def __init__(self, gen: HFTextGen, max_batch: int = 16):
+        self.gen = gen
+        self.max_batch = max(1, int(max_batch))
+        self.sampler = Sampler(gen.model.config.vocab_size, self.max_batch, device=gen.device)
+        self._queue: "queue.Queue[_HFRequest]" = queue.Queue()
+        self._thread = threading.Thread(target=self._loop, name="hf-batch-engine", daemon=True)
+        self._thread.start()
+
+    def submit(self, prompt: str, max_tokens: int = 60, temperature: float = 0.8, top_k: int = 50,
+               top_p: float = 1.0, repetition_penalty: float = 1.0, seed: Optional[int] = None,
+               stream: bool = False, loop: Optional[asyncio.AbstractEventLoop] = None) -> _HFRequest:
+        """
+        Queue a prompt. `req.future` resolves to the full text; with stream=True,
+        `req.stream` also yields continuation deltas (async if `loop` is given).
+        """
+        tok = self.gen.tok
+        prompt_ids = self.gen.encode(prompt)
+        decoder = None
+        if stream:
+            decoder = IncrementalDecoder(lambda ids: tok.decode(ids, skip_special_tokens=True))
+        req = _HFRequest(
+            prompt_ids,
+            max(1, int(max_tokens)),
+            max(0.01, float(temperature)),
+            int(top_k),
+            float(top_p),
+            float(repetition_penalty),
+            seeded_generator(seed, self.gen.device),
+            TokenStream(loop) if stream else None,
+            decoder,
+        )
+        self._queue.put(req)
+        return req
+
+    def generate_once(self, prompt: str, max_tokens: int = 60, temperature: float = 0.8, top_k: int = 50,
+                      top_p: float = 1.0, repetition_penalty: float = 1.0, seed: Optional[int] = None) -> str:
+        """Return FULL text (prompt + continuation)."""
+        return self.submit(prompt, max_tokens, temperature, top_k, top_p, repetition_penalty, seed).future.result()
+
+    def stream(self, prompt: str, max_tokens: int = 60, temperature: float = 0.8, top_k: int = 50,
+               top_p: float = 1.0, repetition_penalty: float = 1.0, seed: Optional[int] = None) -> Iterable[str]:
+        """Yield ONLY the continuation (no prompt) as it is decoded."""
+        req = self.submit(prompt, max_tokens, temperature, top_k, top_p, repetition_penalty, seed, stream=True)
+        for piece in req.stream:
+            yield piece
+
+    # ----------------------------
+    # Decode loop
+    # ----------------------------
+    def _loop(self):
+        rows: List[_HFRequest] = []
+        state = None
+        while True:
+            admitted = []
+            if not rows:
+                admitted.append(self._queue.get())
+            while len(rows) + len(admitted) < self.max_batch:
+                try:
+                    admitted.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                with torch.no_grad():
+                    if admitted:
+                        start = time.perf_counter()
+                        state = self._merge(state, self._prefill(admitted))
+                        rows = rows + admitted
+                        metrics = self.gen.metrics
+                        if metrics is not None:
+                            for req in admitted:
+                                metrics.queued(start - req.submitted)
+                            metrics.prefill(time.perf_counter() - start, len(admitted),
+                                            sum(len(req.prompt_ids) for req in admitted))
+                    rows, state = self._step(rows, state)
+            except Exception as e:
+                for req in rows + admitted:
+                    req.fail(e)
+                rows, state = [], None
+
+    def _prefill(self, reqs: List[_HFRequest]):
+        """Run new prompts together, left-padded, and return their batch state."""
+        length = max(len(r.prompt_ids) for r in reqs)
+        pad = self.gen.tok.pad_token_id or 0
+        ids = torch.tensor([[pad] * (length - len(r.prompt_ids)) + r.prompt_ids for r in reqs])
+        mask = torch.tensor([[0] * (length - len(r.prompt_ids)) + [1] * len(r.prompt_ids) for r in reqs])
+        ids, mask = ids.to(self.gen.device), mask.to(self.gen.device)
+        positions = (mask.cumsum(-1) - 1).clamp(min=0)
+        out = self.gen.model(input_ids=ids, attention_mask=mask, position_ids=positions, use_cache=True)
+        logits = out.logits[:, -1, :].float()
+        seen = torch.zeros(logits.shape, dtype=torch.bool, device=logits.device)
+        for i, r in enumerate(reqs):
+            seen[i, r.prompt_ids] = True
+        return logits, _cache_layers(out.past_key_values), mask, seen
+
+    def _merge(self, state, new):
+        if state is None:
+            return new
+        logits, layers, mask, seen = state
+        new_logits, new_layers, new_mask, new_seen = new
+        length = max(mask.size(1), new_mask.size(1))
+        merged = [
+            (
+                torch.cat([_left_pad(k, length, 2), _left_pad(nk, length, 2)]),
+                torch.cat([_left_pad(v, length, 2), _left_pad(nv, length, 2)]),
+            )
+            for (k, v), (nk, nv) in zip(layers, new_layers)
+        ]
+        mask = torch.cat([_left_pad(mask, length, 1), _left_pad(new_mask, length, 1)])
+        return torch.cat([logits, new_logits]), merged, mask, torch.cat([seen, new_seen])
+
+    def _step(self, rows: List[_HFRequest], state):
+        """Sample one token for every row, retire finished rows, and advance the rest."""
+        logits, layers, mask, seen = state
+        device = logits.device
+        temperature = torch.tensor([r.temperature for r in rows], dtype=logits.dtype, device=device)
+        top_k = torch.tensor([r.top_k for r in rows], dtype=torch.long, device=device)
+        top_p = torch.tensor([r.top_p for r in rows], dtype=logits.dtype, device=device)
+        penalty = torch.tensor([r.repetition_penalty for r in rows], dtype=logits.dtype, device=device)
+        generators = [r.generator for r in rows] if any(r.generator is not None for r in rows) else None
+        next_tokens = self.sampler.sample(logits, temperature, top_k, top_p, penalty, seen, generators)
+        mark_seen(seen, next_tokens)
+
+        eos = self.gen.tok.eos_token_id
+        metrics = self.gen.metrics
+        now = time.perf_counter()
+        keep = []
+        for i, (req, token) in enumerate(zip(rows, next_tokens.tolist())):
+            if metrics is not None:
+                # Rows join at different steps, so each keeps its own token timestamps
+                if not req.generated:
+                    req.first_token_at = now
+                    metrics.first_token(now - req.submitted)
+                else:
+                    metrics.decode_step(now - req.last_token_at)
+                req.last_token_at = now
+            req.generated.append(token)
+            if req.stream is not None:
+                piece = req.decoder.push(token)
+                if piece:
+                    req.stream.put(piece)
+            cancelled = req.stream is not None and req.stream.cancelled
+            if token == eos or len(req.generated) >= req.max_tokens or cancelled:
+                req.finish(self.gen.tok.decode(req.prompt_ids + req.generated, skip_special_tokens=True))
+                if metrics is not None:
+                    metrics.finished(len(req.generated), now - req.first_token_at)
+            else:
+                keep.append(i)
+
+        if not keep:
+            return [], None
+        if len(keep) < len(rows):
+            idx = torch.tensor(keep, dtype=torch.long, device=mask.device)
+            rows = [rows[i] for i in keep]
+            next_tokens = next_tokens[idx]
+            layers = [(k[idx], v[idx]) for k, v in layers]
+            mask = mask[idx]
+            seen = seen[idx]
+            # Drop columns that are now padding for every remaining row
+            start = int((mask.sum(0) > 0).nonzero()[0])
+            if start:
+                layers = [(k[:, :, start:], v[:, :, start:]) for k, v in layers]
+                mask = mask[:, start:]
+
+        mask = torch.cat([mask, mask.new_ones(mask.size(0), 1)], dim=1)
+        positions = torch.tensor([[r.position] for r in rows], device=mask.device)
+        out = self.gen.model(
+            input_ids=next_tokens.unsqueeze(1),
+            attention_mask=mask,
+            position_ids=positions,
+            past_key_values=_build_cache(layers),
+            use_cache=True,
+        )
+        for r in rows:
+            r.position += 1
+        return rows, (out.logits[:, -1, :].float(), _cache_layers(out.past_key_values), mask, seen)
+
+
+class SpeculativeGen:
+    """
+    Speculative decoding for an HFTextGen with a smaller draft model.
+
+    Each round the draft proposes up to `num_speculative` tokens one at a
+    time, and the target scores all of them in a single forward pass. Draft
+    token x is accepted with probability min(1, p(x) / q(x)), where p and q
+    are the target and draft distributions after temperature / top-k /
+    top-p / repetition penalty. The first rejected position is resampled
+    from normalize(max(0, p - q)), and if every draft is accepted a bonus
+    token is drawn from the target. This keeps every emitted token
+    distributed exactly as sampling from the target alone would, so the
+    draft only changes speed, never the output distribution.
+
+    Both models must share the tokenizer. Requests are decoded one at a
+    time per calling thread; exposes the same generate_once()/stream()
+    methods as HFTextGen.
+    """
+
+    def __init__(self, gen: HFTextGen, draft: HFTextGen, num_speculative: int = 4):
+        if gen.tok.get_vocab() != draft.tok.get_vocab() or \
+                gen.model.config.vocab_size != draft.model.config.vocab_size:
+            raise ValueError("draft model must use the same tokenizer and vocabulary as the target model")
+        self.gen = gen
+        self.tok = gen.tok
+        self.model = gen.model
+        self.draft = draft.model.to(gen.device)
+        self.device = gen.device
+        self.num_speculative = max(1, int(num_speculative))
+        self._lock = threading.Lock()
+        self._rounds = 0
+        self._drafted = 0
+        self._accepted = 0
+        self._emitted = 0
+
+    def generate_once(self, prompt: str, max_tokens: int = 60, temperature: float = 0.8, top_k: int = 50,
+                      top_p: float = 1.0, repetition_penalty: float = 1.0, seed: Optional[int] = None) -> str:
+        """Return FULL text (prompt + continuation)."""
+        prompt_ids = self.gen.encode(prompt)
+        generated = []
+        rounds = self._decode(prompt_ids, max_tokens, temperature, top_k, top_p, repetition_penalty, seed)
+        for tokens in self._timed(prompt_ids, rounds):
+            generated.extend(tokens)
+        return self.tok.decode(prompt_ids + generated, skip_special_tokens=True)
+
+    def stream(self, prompt: str, max_tokens: int = 60, temperature: float = 0.8, top_k: int = 50,
+               top_p: float = 1.0, repetition_penalty: float = 1.0, seed: Optional[int] = None) -> Iterable[str]:
+        """Yield ONLY the continuation (no prompt) as each round is verified."""
+        decoder = IncrementalDecoder(lambda ids: self.tok.decode(ids, skip_special_tokens=True))
+        prompt_ids = self.gen.encode(prompt)
+        rounds = self._decode(prompt_ids, max_tokens, temperature, top_k, top_p, repetition_penalty, seed)
+        for tokens in self._timed(prompt_ids, rounds):
+            piece = "".join(decoder.push(token) for token in tokens)
+            if piece:
+                yield piece
+        tail = decoder.flush()
+        if tail:
+            yield tail
+
+    def stats(self):
+        with self._lock:
+            return {
+                "rounds": self._rounds,
+                "draft_tokens": self._drafted,
+                "accepted_tokens": self._accepted,
+                "acceptance_rate": self._accepted / self._drafted if self._drafted else 0.0,
+                "tokens_per_target_pass": self._emitted / self._rounds if self._rounds else 0.0,
+            }
+
+    def _timed(self, prompt_ids: List[int], rounds: Iterable[List[int]]) -> Iterable[List[int]]:
+        """Pass the rounds through, recording their timing; a round's tokens share its duration."""
+        timer = RequestTimer(self.gen.metrics, time.perf_counter(), len(prompt_ids))
+        for tokens in rounds:
+            timer.token(time.perf_counter(), len(tokens))
+            yield tokens
+        timer.finish()
+
+    # A decorated generator re-enters no_grad on every next(), whichever thread resumes it
+    @torch.no_grad()
+    def _decode(self, prompt_ids: List[int], max_tokens: int, temperature: float, top_k: int,
+                top_p: float, repetition_penalty: float, seed: Optional[int] = None) -> Iterable[List[int]]:
+        """Yield the tokens accepted in each round until eos or `max_tokens`."""
+        max_tokens = max(1, int(max_tokens))
+        generator = seeded_generator(seed, self.device)
+        vocab = self.model.config.vocab_size
+        # Samplers are per call: their scratch buffers must not be shared between threads
+        sampler = Sampler(vocab, self.num_speculative + 1, device=self.device)
+        draft_sampler = Sampler(vocab, 1, device=self.device)
+
+        def params(rows: int):
+            return (
+                torch.full((rows,), max(0.01, float(temperature)), device=self.device),
+                torch.full((rows,), int(top_k), dtype=torch.long, device=self.device),
+                torch.full((rows,), float(top_p), device=self.device),
+                torch.full((rows,), float(repetition_penalty), device=self.device),
+            )
+
+        eos = self.tok.eos_token_id
+        seq = list(prompt_ids)
+        seen = torch.zeros(1, vocab, dtype=torch.bool, device=self.device)
+        seen[0, seq] = True
+        target_cache, draft_cache = DynamicCache(), DynamicCache()
+        produced = 0
+
+        while produced < max_tokens:
+            # Leave room for the token the target always contributes
+            k = min(self.num_speculative, max_tokens - produced - 1)
+
+            # --- draft proposes k tokens ---
+            drafts, draft_probs = [], []
+            draft_seen = seen.clone()
+            pending = seq[draft_cache.get_seq_length():]
+            for _ in range(k):
+                out = self.draft(
+                    input_ids=torch.tensor([pending], device=self.device),
+                    past_key_values=draft_cache,
+                    use_cache=True,
+                )
+                q = draft_sampler.probs(out.logits[:, -1, :].float(), *params(1), draft_seen)
+                token = int(torch.multinomial(q, 1, generator=generator))
+                drafts.append(token)
+                draft_probs.append(q[0])
+                draft_seen[0, token] = True
+                pending = [token]
+
+            # --- target scores every draft position in one pass ---
+            fed = seq[target_cache.get_seq_length():] + drafts
+            out = self.model(
+                input_ids=torch.tensor([fed], device=self.device),
+                past_key_values=target_cache,
+                use_cache=True,
+            )
+            logits = out.logits[0, -(k + 1):, :].float()
+            # Row j conditions on drafts[:j], so its repetition mask includes them
+            target_seen = seen.repeat(k + 1, 1)
+            for j, token in enumerate(drafts):
+                target_seen[j + 1:, token] = True
+            p = sampler.probs(logits, *params(k + 1), target_seen)
+
+            # --- accept / reject ---
+            accepted = []
+            for j, token in enumerate(drafts):
+                if torch.rand((), generator=generator, device=self.device).item() * draft_probs[j][token].item() \
+                        < p[j, token].item():
+                    accepted.append(token)
+                    continue
+                residual = (p[j] - draft_probs[j]).clamp_min(0)
+                if residual.sum().item() <= 0:
+                    residual = p[j]
+                hits = len(accepted)
+                accepted.append(int(torch.multinomial(residual, 1, generator=generator)))
+                break
+            else:
+                hits = len(accepted)
+                accepted.append(int(torch.multinomial(p[k], 1, generator=generator)))
+
+            if eos in accepted:
+                accepted = accepted[:accepted.index(eos) + 1]
+            accepted = accepted[:max_tokens - produced]
+
+            # Caches keep every token except the newest, which is fed next round
+            seq.extend(accepted)
+            _crop(target_cache, len(seq) - 1)
+            _crop(draft_cache, len(seq) - 1)
+            seen[0, accepted] = True
+            produced += len(accepted)
+
+            with self._lock:
+                self._rounds += 1
+                self._drafted += len(drafts)
+                self._accepted += hits
+                self._emitted += len(accepted)
+
+            yield accepted
+            if accepted[-1] == eos:
+                return
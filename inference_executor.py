@@ -0,0 +1,86 @@
+"""
+Bounded executor for blocking inference work.
+
+Keeps CPU-bound generation off Starlette's default threadpool and rejects
+work up front once the configured number of in-flight requests is reached.
+"""
+
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, AsyncIterator, Callable, Dict, Iterator
+
+
+class QueueFull(Exception):
+    """Raised when a request cannot be admitted because the executor is saturated."""
+
+
+class InferenceExecutor:
+    """
+    A dedicated thread pool plus an admission limit.
+
+    At most `workers + max_queue` requests are admitted at once; the rest are
+    rejected immediately with QueueFull. Work that runs on the batching
+    threads (and therefore needs no pool thread) is admitted the same way, so
+    one limit covers every backend.
+    """
+
+    def __init__(self, workers: int = 2, max_queue: int = 64):
+        """
+        Args:
+            workers: Threads available for blocking calls
+            max_queue: Admitted requests allowed beyond the busy workers
+        """
+        self.workers = max(1, int(workers))
+        self.max_queue = max(0, int(max_queue))
+        self.capacity = self.workers + self.max_queue
+        self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="inference")
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.rejected = 0
+
+    def acquire(self):
+        """Take an admission slot or raise QueueFull."""
+        with self._lock:
+            if self.in_flight >= self.capacity:
+                self.rejected += 1
+                raise QueueFull(f"inference queue is full ({self.capacity} requests in flight)")
+            self.in_flight += 1
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    @contextmanager
+    def admit(self):
+        """Hold an admission slot for the duration of the block."""
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def run(self, fn: Callable, *args, **kwargs) -> Any:
+        """Run a blocking call on the inference pool and await its result."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._pool, functools.partial(fn, *args, **kwargs))
+
+    async def iterate(self, iterator: Iterator) -> AsyncIterator:
+        """Drive a blocking iterator from the inference pool, one item at a time."""
+        done = object()
+        while True:
+            item = await self.run(next, iterator, done)
+            if item is done:
+                return
+            yield item
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "capacity": self.capacity,
+                "in_flight": self.in_flight,
+                "rejected": self.rejected,
+            }
@@ -5,17 +5,24 @@ Demonstrates how to load the preprocessed encoded data for use in training.
 """
 
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from token_file import TokenFile
 
 def load_encoded_data(filename):
     """
     Load encoded data from file.
     
     Args:
-        filename: Path to the encoded data file
+        filename: Path to a binary token file written by preprocess.py, or a
+            legacy text file with one space-separated sequence per line
         
     Returns:
         List of encoded sequences (each sequence is a list of integers)
     """
+    if filename.endswith('.bin'):
+        return TokenFile(filename).documents()
+
     with open(filename, 'r') as f:
         lines = f.readlines()
     
@@ -56,24 +63,85 @@ def create_training_pairs(sequences, context_length=8):
     
     return np.array(inputs), np.array(targets)
 
+class TokenWindowDataset:
+    """
+    Training windows read straight from a memory-mapped token file.
+
+    Window i is `context_length` input tokens plus the next token as target,
+    taken from inside a single document, in the same order as
+    create_training_pairs. Nothing is materialized up front: windows are
+    strided views over the mapped file, and only the rows of a requested
+    batch are copied, so the corpus size is bounded by disk rather than RAM.
+    """
+
+    def __init__(self, path, context_length=8, tokenizer_model=None):
+        """
+        Args:
+            path: Binary token file written by preprocess.py
+            context_length: Input tokens per window
+            tokenizer_model: Optional SentencePiece model the file must match
+        """
+        self.context_length = int(context_length)
+        self.file = TokenFile(path, tokenizer_model)
+        span = self.context_length + 1
+        if self.file.num_tokens >= span:
+            self.windows = sliding_window_view(self.file.tokens, span)
+        else:
+            self.windows = np.zeros((0, span), dtype=self.file.dtype)
+
+        # Document d owns windows cum[d] .. cum[d + 1] - 1, starting at its first token
+        counts = np.maximum(self.file.lengths() - self.context_length, 0)
+        self._cum = np.concatenate([[0], np.cumsum(counts)])
+        self._doc_start = self.file.offsets[:-1].astype(np.int64)
+
+    def __len__(self):
+        return int(self._cum[-1])
+
+    def window_starts(self, indices):
+        """Token offsets of the given window indices."""
+        indices = np.asarray(indices, dtype=np.int64)
+        if indices.size and (indices.min() < 0 or indices.max() >= len(self)):
+            raise IndexError("window index out of range")
+        docs = np.searchsorted(self._cum, indices, side="right") - 1
+        return self._doc_start[docs] + (indices - self._cum[docs])
+
+    def __getitem__(self, i):
+        """(inputs, target) of one window, as views into the mapped file."""
+        window = self.windows[int(self.window_starts([i])[0])]
+        return window[:-1], window[-1]
+
+    def get_batch(self, indices):
+        """
+        Returns:
+            (inputs, targets) int64 arrays of shape (n, context_length) and (n,)
+        """
+        rows = self.windows[self.window_starts(indices)].astype(np.int64)
+        return rows[:, :-1], rows[:, -1]
+
+    def sample_batch(self, batch_size, rng=None):
+        """A batch of windows drawn uniformly at random."""
+        rng = rng if rng is not None else np.random.default_rng()
+        return self.get_batch(rng.integers(0, len(self), size=batch_size))
+
 def main():
     """Demonstrate loading and processing encoded data."""
     
     # Load encoded data
     print("Loading encoded data...")
-    encoded_sequences = load_encoded_data('encoded_data.txt')
+    encoded_sequences = load_encoded_data('encoded_data.bin')
     
     print(f"Loaded {len(encoded_sequences)} sequences")
     print(f"Sample sequence: {encoded_sequences[0]}")
     print(f"Sequence lengths: {[len(seq) for seq in encoded_sequences]}")
     
-    # Create training pairs
-    print("\nCreating training pairs...")
-    inputs, targets = create_training_pairs(encoded_sequences, context_length=8)
+    # Training windows are read on demand from the token file
+    print("\nOpening training windows...")
+    dataset = TokenWindowDataset('encoded_data.bin', context_length=8)
+    inputs, targets = dataset.sample_batch(4)
     
-    print(f"Created {len(inputs)} training pairs")
-    print(f"Input shape: {inputs.shape}")
-    print(f"Target shape: {targets.shape}")
+    print(f"{len(dataset)} training windows")
+    print(f"Batch input shape: {inputs.shape}")
+    print(f"Batch target shape: {targets.shape}")
     
     # Show some examples
     print("\nSample training pairs:")
@@ -81,13 +149,6 @@ def main():
         print(f"Input {i}: {inputs[i]}")
         print(f"Target {i}: {targets[i]}")
         print()
-    
-    # Save processed data for training
-    np.save('training_inputs.npy', inputs)
-    np.save('training_targets.npy', targets)
-    print("Saved training data as numpy arrays:")
-    print("- training_inputs.npy")
-    print("- training_targets.npy")
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
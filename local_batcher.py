@@ -0,0 +1,269 @@
+"""
+Dynamic request batching for the local TinyModel backend.
+
+Prompts that arrive within a short window are decoded together in one padded
+batch by a single background thread, instead of every request running its own
+batch-size-1 loop.
+"""
+
+import asyncio
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import List, Optional
+
+import torch
+
+from metrics import ServingMetrics
+from prefix_cache import PrefixStateCache
+from sampling import Sampler, mark_seen, seeded_generator
+from streaming import TokenStream
+
+
+class _Request:
+    def __init__(self, input_ids: List[int], max_tokens: int, temperature: float, top_k: int,
+                 top_p: float = 1.0, repetition_penalty: float = 1.0, seed: Optional[int] = None,
+                 stream: Optional[TokenStream] = None):
+        self.input_ids = list(input_ids)
+        self.max_tokens = int(max_tokens)
+        self.temperature = float(temperature)
+        self.top_k = int(top_k)
+        self.top_p = float(top_p)
+        self.repetition_penalty = float(repetition_penalty)
+        self.generator = seeded_generator(seed)
+        self.stream = stream
+        self.generated: List[int] = []
+        self.future: Future = Future()
+        self.submitted = time.perf_counter()
+        self.first_token_at = 0.0
+
+    @property
+    def cancelled(self) -> bool:
+        return self.stream is not None and self.stream.cancelled
+
+    def emit(self, token: int):
+        self.generated.append(token)
+        if self.stream is not None:
+            self.stream.put(token)
+
+    def finish(self):
+        if self.stream is not None:
+            self.stream.close()
+        if not self.future.done():
+            self.future.set_result(self.generated)
+
+    def fail(self, exc: BaseException):
+        if self.stream is not None:
+            self.stream.close(exc)
+        if not self.future.done():
+            self.future.set_exception(exc)
+
+
+class LocalBatcher:
+    """
+    Collects in-flight prompts and decodes them together.
+
+    The first queued request opens a batch; anything else that arrives within
+    `window_ms` (up to `max_batch` requests) joins it. Rows leave the batch as
+    soon as they sample `eos_id` or reach their own `max_tokens`.
+
+    With a `prefix_cache`, each prompt resumes from the LSTM state of its
+    longest cached prefix and only its suffix is run through the model.
+
+    With `metrics`, queue, prefill, per-token decode and time-to-first-token
+    latencies are recorded for every request.
+    """
+
+    def __init__(self, model: torch.nn.Module, eos_id: int, window_ms: float = 5.0, max_batch: int = 32,
+                 prefix_cache: Optional[PrefixStateCache] = None, metrics: Optional[ServingMetrics] = None):
+        self.model = model
+        self.eos_id = eos_id
+        self.prefix_cache = prefix_cache
+        self.metrics = metrics
+        self.sampler: Optional[Sampler] = None
+        self.window = max(0.0, window_ms) / 1000.0
+        self.max_batch = max(1, int(max_batch))
+        self._queue: "queue.Queue[_Request]" = queue.Queue()
+        self._thread = threading.Thread(target=self._loop, name="local-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, input_ids: List[int], max_tokens: int, temperature: float, top_k: int,
+               top_p: float = 1.0, repetition_penalty: float = 1.0, seed: Optional[int] = None) -> Future:
+        """Queue a prompt; the future resolves to the list of generated token ids."""
+        req = _Request(input_ids, max_tokens, temperature, top_k, top_p, repetition_penalty, seed)
+        self._queue.put(req)
+        return req.future
+
+    def generate(self, input_ids: List[int], max_tokens: int, temperature: float, top_k: int,
+                 top_p: float = 1.0, repetition_penalty: float = 1.0, seed: Optional[int] = None) -> List[int]:
+        """Blocking helper around submit()."""
+        return self.submit(input_ids, max_tokens, temperature, top_k, top_p, repetition_penalty, seed).result()
+
+    def stream(self, input_ids: List[int], max_tokens: int, temperature: float, top_k: int,
+               top_p: float = 1.0, repetition_penalty: float = 1.0, seed: Optional[int] = None,
+               loop: Optional[asyncio.AbstractEventLoop] = None) -> TokenStream:
+        """
+        Return a stream of generated token ids, each delivered as soon as it is sampled.
+
+        Pass the running event loop to consume it with `async for`.
+        """
+        stream = TokenStream(loop)
+        self._queue.put(_Request(input_ids, max_tokens, temperature, top_k, top_p, repetition_penalty, seed, stream))
+        return stream
+
+    # ----------------------------
+    # Scheduler
+    # ----------------------------
+    def _collect(self) -> List[_Request]:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            try:
+                if timeout > 0:
+                    batch.append(self._queue.get(timeout=timeout))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+            try:
+                self.run_batch(batch)
+            except Exception as e:
+                for req in batch:
+                    req.fail(e)
+
+    # ----------------------------
+    # Batched decode
+    # ----------------------------
+    def _prefill(self, rows: List[_Request]):
+        """
+        Run the prompts and return (logits, (h, c)) for the whole batch.
+
+        Rows are advanced in chunks that end on cache block boundaries, and
+        each chunk is run in groups of equal length so no padding leaks into
+        the LSTM state.
+        """
+        cache = self.prefix_cache
+        block = cache.block_size if cache is not None else max(len(req.input_ids) for req in rows)
+
+        pos, states, logits = [], [], []
+        for req in rows:
+            length, state = cache.lookup(req.input_ids) if cache is not None else (0, None)
+            pos.append(length)
+            states.append(state[:2] if state is not None else None)
+            logits.append(state[2] if state is not None else None)
+
+        while True:
+            groups = {}
+            for i, req in enumerate(rows):
+                if pos[i] < len(req.input_ids):
+                    end = min(len(req.input_ids), (pos[i] // block + 1) * block)
+                    groups.setdefault((end - pos[i], states[i] is None), []).append(i)
+            if not groups:
+                break
+
+            for (size, fresh), members in groups.items():
+                x = torch.tensor([rows[i].input_ids[pos[i]:pos[i] + size] for i in members], dtype=torch.long)
+                if fresh:
+                    output, (h, c) = self.model(x)
+                else:
+                    h0 = torch.cat([states[i][0] for i in members], dim=1)
+                    c0 = torch.cat([states[i][1] for i in members], dim=1)
+                    output, (h, c) = self.model(x, (h0, c0))
+
+                for j, i in enumerate(members):
+                    pos[i] += size
+                    states[i] = (h[:, j:j + 1], c[:, j:j + 1])
+                    logits[i] = output[j:j + 1, -1, :]
+                    if cache is not None:
+                        cache.insert(rows[i].input_ids[:pos[i]], states[i][0], states[i][1], logits[i])
+
+        h = torch.cat([state[0] for state in states], dim=1)
+        c = torch.cat([state[1] for state in states], dim=1)
+        return torch.cat(logits), (h, c)
+
+    def run_batch(self, batch: List[_Request]):
+        """Decode a list of requests to completion in one padded batch."""
+        rows = []
+        for req in batch:
+            if not req.input_ids:
+                req.fail(ValueError("prompt encodes to zero tokens"))
+            elif req.max_tokens <= 0:
+                req.finish()
+            else:
+                rows.append(req)
+        if not rows:
+            return
+
+        metrics = self.metrics
+        start = time.perf_counter()
+        if metrics is not None:
+            for req in rows:
+                metrics.queued(start - req.submitted)
+
+        with torch.no_grad():
+            logits, (h, c) = self._prefill(rows)
+            if metrics is not None:
+                metrics.prefill(time.perf_counter() - start, len(rows), sum(len(req.input_ids) for req in rows))
+            last_step = None
+            if self.sampler is None:
+                self.sampler = Sampler(logits.size(-1), self.max_batch)
+            temperature = torch.tensor([req.temperature for req in rows], dtype=logits.dtype)
+            top_k = torch.tensor([req.top_k for req in rows], dtype=torch.long)
+            top_p = torch.tensor([req.top_p for req in rows], dtype=logits.dtype)
+            penalty = torch.tensor([req.repetition_penalty for req in rows], dtype=logits.dtype)
+            seen = None
+            if bool((penalty != 1.0).any()):
+                seen = torch.zeros(len(rows), logits.size(-1), dtype=torch.bool)
+                for i, req in enumerate(rows):
+                    seen[i, req.input_ids] = True
+
+            while rows:
+                generators = [req.generator for req in rows] if any(req.generator is not None for req in rows) else None
+                next_tokens = self.sampler.sample(logits, temperature, top_k, top_p, penalty, seen, generators)
+                if seen is not None:
+                    mark_seen(seen, next_tokens)
+
+                if metrics is not None:
+                    now = time.perf_counter()
+                    if last_step is None:
+                        for req in rows:
+                            req.first_token_at = now
+                            metrics.first_token(now - req.submitted)
+                    else:
+                        metrics.decode_step(now - last_step, len(rows))
+                    last_step = now
+
+                keep = []
+                for i, (req, token) in enumerate(zip(rows, next_tokens.tolist())):
+                    req.emit(token)
+                    if token == self.eos_id or len(req.generated) >= req.max_tokens or req.cancelled:
+                        req.finish()
+                        if metrics is not None:
+                            metrics.finished(len(req.generated), last_step - req.first_token_at)
+                    else:
+                        keep.append(i)
+
+                if not keep:
+                    break
+                if len(keep) < len(rows):
+                    idx = torch.tensor(keep, dtype=torch.long)
+                    rows = [rows[i] for i in keep]
+                    next_tokens = next_tokens[idx]
+                    temperature = temperature[idx]
+                    top_k = top_k[idx]
+                    top_p = top_p[idx]
+                    penalty = penalty[idx]
+                    if seen is not None:
+                        seen = seen[idx]
+                    h = h[:, idx]
+                    c = c[:, idx]
+
+                output, (h, c) = self.model(next_tokens.unsqueeze(1), (h, c))
+                logits = output[:, -1, :]
@@ -0,0 +1,188 @@
+"""
+The local TinyModel backend: model definition, checkpoint loading and the
+optional int8 / TorchScript, bf16 autocast and torch.compile serving
+variants.
+"""
+
+import warnings
+from typing import Dict, List, Optional, Tuple
+
+import torch
+
+from checkpoint import model_state_dict
+
+# Fixed prompts used to check a reduced-precision model against fp32
+CHECK_PROMPTS = [
+    "Hello, I am building",
+    "This is a sample text",
+    "Machine learning and natural",
+    "The quick brown fox",
+    "Python is a great",
+    "Neural networks and deep",
+    "Tokenization is an important",
+    "SentencePiece is a popular",
+]
+
+
+class TinyModel(torch.nn.Module):
+    def __init__(self, vocab_size=100, dim=64, hidden_size=128):  # LSTM hidden size is 128
+        super().__init__()
+        self.embed = torch.nn.Embedding(vocab_size, dim)
+        self.lstm = torch.nn.LSTM(dim, hidden_size, batch_first=True)  # dim=64, hidden_size=128
+        self.fc = torch.nn.Linear(hidden_size, vocab_size)  # hidden_size=128 to vocab_size=100
+
+    def forward(self, x, h: Optional[Tuple[torch.Tensor, torch.Tensor]] = None):
+        x = self.embed(x)
+        if h is None:
+            x, state = self.lstm(x)
+        else:
+            x, state = self.lstm(x, h)
+        return self.fc(x), state
+
+
+def load_tiny_model(path: str = "mini_llm.pth") -> Tuple[TinyModel, str]:
+    """
+    Build a TinyModel and load weights from `path`, either a bare
+    state_dict or a training checkpoint written by train_llm.py.
+
+    Returns:
+        (model in eval mode, status message for /health)
+    """
+    model = TinyModel()
+    try:
+        state = torch.load(path, map_location="cpu")
+        model.load_state_dict(model_state_dict(state), strict=False)
+        load_msg = "model loaded successfully"
+    except Exception as e:
+        load_msg = f"model load warning: {e}"
+    model.eval()
+    return model, load_msg
+
+
+def quantize_tiny_model(model: TinyModel) -> torch.nn.Module:
+    """
+    Dynamic int8 quantization of the LSTM and Linear layers, then
+    TorchScript scripting and freezing. Falls back to the eager quantized
+    model if scripting is not available.
+    """
+    with warnings.catch_warnings():
+        # quantize_dynamic is flagged for migration to torchao but still works
+        warnings.simplefilter("ignore")
+        quantized = torch.ao.quantization.quantize_dynamic(
+            model, {torch.nn.LSTM, torch.nn.Linear}, dtype=torch.qint8
+        )
+        quantized.eval()
+        try:
+            return torch.jit.freeze(torch.jit.script(quantized))
+        except Exception as e:
+            print(f"⚠️ TorchScript unavailable for the int8 model, running it eagerly: {e}")
+            return quantized
+
+
+class AutocastModel(torch.nn.Module):
+    """
+    Runs a TinyModel under CPU bf16 autocast and hands back fp32 logits and
+    LSTM state, so the batcher, sampler and prefix cache see the same dtypes
+    as in fp32 mode.
+    """
+
+    def __init__(self, model: torch.nn.Module, dtype: torch.dtype = torch.bfloat16):
+        super().__init__()
+        self.model = model
+        self.dtype = dtype
+
+    def forward(self, x, h: Optional[Tuple[torch.Tensor, torch.Tensor]] = None):
+        with torch.autocast(device_type="cpu", dtype=self.dtype):
+            out, state = self.model(x, h)
+        return out.float(), (state[0].float(), state[1].float())
+
+
+def compile_tiny_model(model: torch.nn.Module) -> torch.nn.Module:
+    """
+    torch.compile with dynamic shapes, warmed up on a prefill and a decode
+    shape so compilation errors surface here instead of mid-request.
+    """
+    compiled = torch.compile(model, dynamic=True)
+    with torch.no_grad():
+        _, state = compiled(torch.zeros(2, 8, dtype=torch.long))
+        compiled(torch.zeros(2, 1, dtype=torch.long), state)
+    return compiled
+
+
+SERVING_MODES = ("fp32", "int8", "bf16", "compile", "bf16-compile")
+
+
+def prepare_serving_model(model: TinyModel, mode: str, prompts: List[List[int]],
+                          min_agreement: float = 0.95) -> Tuple[torch.nn.Module, Dict]:
+    """
+    Build the requested serving variant of `model` and keep it only if it
+    works here and its greedy choices agree with fp32 often enough.
+
+    Args:
+        model: The fp32 eager model
+        mode: One of SERVING_MODES
+        prompts: Encoded prompts for the agreement check
+        min_agreement: Lowest acceptable greedy token agreement
+
+    Returns:
+        (model to serve, description for /health); falls back to `model`
+    """
+    if mode == "fp32":
+        return model, {"mode": "fp32"}
+    if mode not in SERVING_MODES:
+        print(f"⚠️ Unknown LOCAL_MODEL_MODE {mode!r}, keeping fp32")
+        return model, {"mode": "fp32", "requested": mode, "error": "unknown mode"}
+
+    try:
+        if mode == "int8":
+            candidate = quantize_tiny_model(model)
+        else:
+            candidate = AutocastModel(model) if mode.startswith("bf16") else model
+            if mode.endswith("compile"):
+                candidate = compile_tiny_model(candidate)
+        check = greedy_agreement(model, candidate, prompts)
+    except Exception as e:
+        print(f"⚠️ {mode} is not supported here, keeping fp32: {e}")
+        return model, {"mode": "fp32", "requested": mode, "error": f"{type(e).__name__}: {e}"}
+
+    if check["token_agreement"] < min_agreement:
+        print(f"⚠️ {mode} model disagrees with fp32 beyond tolerance, keeping fp32: {check}")
+        return model, {"mode": "fp32", f"{mode}_rejected": check}
+    print(f"⚡ Local model running {mode}: {check}")
+    return candidate, {"mode": mode, **check}
+
+
+def greedy_agreement(reference: torch.nn.Module, candidate: torch.nn.Module, prompts: List[List[int]],
+                     max_tokens: int = 32) -> Dict[str, float]:
+    """
+    Compare `candidate` against `reference` on greedy decoding.
+
+    The reference decodes each prompt greedily; both models are then run over
+    that same sequence and we report how often their next-token argmax
+    agrees, plus the largest absolute logit difference.
+    """
+    agree = total = 0
+    max_diff = 0.0
+    with torch.no_grad():
+        for ids in prompts:
+            if not ids:
+                continue
+            seq = list(ids)
+            output, hidden = reference(torch.tensor([seq]))
+            for _ in range(max_tokens):
+                seq.append(int(output[0, -1].argmax()))
+                output, hidden = reference(torch.tensor([[seq[-1]]]), hidden)
+
+            x = torch.tensor([seq[:-1]])
+            ref_logits, _ = reference(x)
+            cand_logits, _ = candidate(x)
+            ref_logits = ref_logits[0, len(ids) - 1:].float()
+            cand_logits = cand_logits[0, len(ids) - 1:].float()
+            agree += int((ref_logits.argmax(-1) == cand_logits.argmax(-1)).sum())
+            total += ref_logits.size(0)
+            max_diff = max(max_diff, float((ref_logits - cand_logits).abs().max()))
+
+    return {
+        "token_agreement": agree / total if total else 1.0,
+        "max_logit_diff": max_diff,
+    }
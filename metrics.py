@@ -0,0 +1,302 @@
+"""
+In-process serving metrics, rendered in the Prometheus text format.
+
+Counters, gauges and histograms live in a Registry and need nothing beyond
+the standard library. Every serving metric is labelled with the backend
+and model it describes; ServingMetrics binds those labels once so the
+decode loops can record a phase with a single call.
+
+Worker processes keep their own registry. Registry.snapshot() returns the
+values in a picklable form, and render() can merge snapshots from other
+processes into its output.
+"""
+
+import bisect
+import math
+import threading
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+# Seconds, from sub-millisecond decode steps to multi-second requests
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+RATE_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+Labels = Tuple[str, ...]
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Labels, Any] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, Any]) -> Labels:
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            values = {k: (list(v) if isinstance(v, list) else v) for k, v in self._values.items()}
+        return {"kind": self.kind, "help": self.help, "labelnames": self.labelnames, "values": values}
+
+
+class Counter(_Metric):
+    """Monotonically increasing total."""
+
+    kind = "counter"
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+
+class Gauge(_Metric):
+    """Point-in-time value."""
+
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = float(value)
+
+
+class Histogram(_Metric):
+    """Bucketed distribution of observations, with their sum and count."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, count: int = 1, **labels):
+        """Record `value` `count` times (e.g. one decode step shared by every row of a batch)."""
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Per-bucket counts (last one is +Inf), then sum and count
+                state = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            state[index] += count
+            state[-2] += value * count
+            state[-1] += count
+
+    def snapshot(self) -> Dict[str, Any]:
+        snap = super().snapshot()
+        snap["buckets"] = self.buckets
+        return snap
+
+
+class Registry:
+    """A set of metrics plus callbacks that refresh gauges just before rendering."""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._collectors: List[Callable[[], None]] = []
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._add(Counter(name, help, labelnames))
+
+    def gauge(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._add(Gauge(name, help, labelnames))
+
+    def histogram(self, name: str, help: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help, labelnames, buckets))
+
+    def on_collect(self, callback: Callable[[], None]):
+        """Call `callback` before every snapshot, e.g. to copy cache stats into gauges."""
+        self._collectors.append(callback)
+
+    def snapshot(self, collect: bool = True) -> Dict[str, Dict[str, Any]]:
+        """Current values of every metric; collect=False skips the gauge callbacks."""
+        for callback in self._collectors if collect else ():
+            try:
+                callback()
+            except Exception as e:
+                print(f"⚠️ Metrics collector failed: {e}")
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {metric.name: metric.snapshot() for metric in metrics}
+
+    def render(self, others: Iterable[Dict[str, Dict[str, Any]]] = ()) -> str:
+        """
+        Prometheus text exposition of this registry.
+
+        Args:
+            others: Snapshots from other processes; counters, histograms and
+                gauges with the same name and labels are summed
+
+        Returns:
+            The /metrics response body
+        """
+        merged = self.snapshot()
+        for other in others:
+            merged = merge_snapshots(merged, other)
+
+        lines = []
+        for name, metric in merged.items():
+            lines.append(f"# HELP {name} {_escape_help(metric['help'])}")
+            lines.append(f"# TYPE {name} {metric['kind']}")
+            labelnames = metric["labelnames"]
+            for key, value in sorted(metric["values"].items()):
+                labels = list(zip(labelnames, key))
+                if metric["kind"] != "histogram":
+                    lines.append(f"{name}{_labels(labels)} {_number(value)}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(list(metric["buckets"]) + [math.inf], value[:-2]):
+                    cumulative += count
+                    le = "+Inf" if bound == math.inf else _number(bound)
+                    lines.append(f"{name}_bucket{_labels(labels + [('le', le)])} {cumulative}")
+                lines.append(f"{name}_sum{_labels(labels)} {_number(value[-2])}")
+                lines.append(f"{name}_count{_labels(labels)} {value[-1]}")
+        return "\n".join(lines) + "\n"
+
+    def _add(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric) or existing.labelnames != metric.labelnames:
+                    raise ValueError(f"metric {metric.name} is already registered differently")
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+
+def merge_snapshots(a: Dict[str, Dict[str, Any]], b: Dict[str, Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    """Sum two registry snapshots metric by metric and label set by label set."""
+    merged = {name: dict(metric, values=dict(metric["values"])) for name, metric in a.items()}
+    for name, metric in b.items():
+        target = merged.setdefault(name, dict(metric, values={}))
+        values = target["values"]
+        for key, value in metric["values"].items():
+            if key not in values:
+                values[key] = list(value) if isinstance(value, list) else value
+            elif isinstance(value, list):
+                values[key] = [x + y for x, y in zip(values[key], value)]
+            else:
+                values[key] = values[key] + value
+    return merged
+
+
+def _labels(pairs: List[Tuple[str, str]]) -> str:
+    if not pairs:
+        return ""
+    body = ",".join(f'{k}="{_escape_label(v)}"' for k, v in pairs)
+    return "{" + body + "}"
+
+
+def _escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _escape_help(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("\n", "\\n")
+
+
+def _number(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+# ----------------------------
+# Serving metrics
+# ----------------------------
+REGISTRY = Registry()
+_LABELS = ("backend", "model")
+
+REQUESTS = REGISTRY.counter(
+    "llm_requests_total", "Generation requests by endpoint and outcome (ok, error, busy, cached)",
+    _LABELS + ("endpoint", "outcome"))
+REQUEST_SECONDS = REGISTRY.histogram(
+    "llm_request_duration_seconds", "End-to-end request time, admission to last byte", _LABELS + ("endpoint",))
+QUEUE_SECONDS = REGISTRY.histogram(
+    "llm_queue_seconds", "Time from submission until the request's prefill starts", _LABELS)
+PREFILL_SECONDS = REGISTRY.histogram(
+    "llm_prefill_seconds", "Prompt forward pass (per batch the request was prefilled in)", _LABELS)
+DECODE_TOKEN_SECONDS = REGISTRY.histogram(
+    "llm_decode_token_seconds", "Time per generated token after the first", _LABELS)
+TTFT_SECONDS = REGISTRY.histogram(
+    "llm_time_to_first_token_seconds", "Time from submission to the first generated token", _LABELS)
+TOKENS_PER_SECOND = REGISTRY.histogram(
+    "llm_request_tokens_per_second", "Generated tokens per second of each request", _LABELS, RATE_BUCKETS)
+PROMPT_TOKENS = REGISTRY.counter("llm_prompt_tokens_total", "Prompt tokens processed", _LABELS)
+GENERATED_TOKENS = REGISTRY.counter("llm_generated_tokens_total", "Tokens generated", _LABELS)
+
+
+class ServingMetrics:
+    """The serving metrics with the backend / model labels bound, for one decode loop."""
+
+    def __init__(self, backend: str, model: str):
+        self.labels = {"backend": backend, "model": model}
+
+    def queued(self, seconds: float, count: int = 1):
+        QUEUE_SECONDS.observe(seconds, count, **self.labels)
+
+    def prefill(self, seconds: float, count: int = 1, prompt_tokens: int = 0):
+        PREFILL_SECONDS.observe(seconds, count, **self.labels)
+        if prompt_tokens:
+            PROMPT_TOKENS.inc(prompt_tokens, **self.labels)
+
+    def decode_step(self, seconds: float, count: int = 1):
+        """One decode step that produced a token for each of `count` rows."""
+        DECODE_TOKEN_SECONDS.observe(seconds, count, **self.labels)
+
+    def first_token(self, seconds: float):
+        TTFT_SECONDS.observe(seconds, **self.labels)
+
+    def finished(self, generated_tokens: int, decode_seconds: float):
+        """A request is done: `decode_seconds` runs from its first token to its last."""
+        GENERATED_TOKENS.inc(generated_tokens, **self.labels)
+        if generated_tokens > 1 and decode_seconds > 0:
+            TOKENS_PER_SECOND.observe((generated_tokens - 1) / decode_seconds, **self.labels)
+
+
+class RequestTimer:
+    """
+    Phase timestamps of one request, for decode loops that handle one request per call.
+
+    Create it when generation starts (queue time is recorded by the caller),
+    call token() as tokens come out (the first one closes the prefill
+    phase), and finish() at the end.
+    """
+
+    def __init__(self, metrics: Optional[ServingMetrics], submitted: float, prompt_tokens: int = 0):
+        self.metrics = metrics
+        self.submitted = submitted
+        self.prompt_tokens = prompt_tokens
+        self.first = None
+        self.last = None
+        self.tokens = 0
+
+    def token(self, now: float, count: int = 1):
+        if self.metrics is None or count <= 0:
+            return
+        if self.first is None:
+            self.first = now
+            self.metrics.prefill(now - self.submitted, prompt_tokens=self.prompt_tokens)
+            self.metrics.first_token(now - self.submitted)
+            count -= 1
+            self.tokens += 1
+            self.last = now
+        if count > 0:
+            self.metrics.decode_step((now - self.last) / count, count)
+            self.tokens += count
+            self.last = now
+
+    def finish(self):
+        if self.metrics is not None and self.first is not None:
+            self.metrics.finished(self.tokens, self.last - self.first)
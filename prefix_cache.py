@@ -0,0 +1,134 @@
+"""
+Prompt-prefix hidden-state cache for the local LSTM backend.
+
+Maps SentencePiece token-id prefixes to the LSTM `(h, c)` state (and the
+next-token logits) reached after that prefix, so a prompt that shares a long
+prefix with an earlier one only runs the LSTM over its uncached suffix.
+"""
+
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import torch
+
+State = Tuple[torch.Tensor, torch.Tensor, torch.Tensor]
+
+# Rough per-trie-node bookkeeping cost, counted against the byte budget
+_NODE_BYTES = 64
+
+
+class _Node:
+    __slots__ = ("parent", "token", "children", "state", "nbytes")
+
+    def __init__(self, parent: Optional["_Node"], token: int):
+        self.parent = parent
+        self.token = token
+        self.children: Dict[int, "_Node"] = {}
+        self.state: Optional[State] = None
+        self.nbytes = 0
+
+
+class PrefixStateCache:
+    """
+    LRU cache of LSTM states keyed by token-id prefix, stored in a trie.
+
+    States are only recorded at multiples of `block_size` tokens and at the
+    end of each prompt, which keeps the number of entries per prompt small
+    while still letting prompts that share a long system prefix reuse it.
+    """
+
+    def __init__(self, max_bytes: int, block_size: int = 16):
+        """
+        Args:
+            max_bytes: Memory budget for cached tensors and trie nodes
+            block_size: Token interval between recorded states
+        """
+        self.max_bytes = int(max_bytes)
+        self.block_size = max(1, int(block_size))
+        self._root = _Node(None, -1)
+        self._lru: "OrderedDict[_Node, None]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._nodes = 0
+        self.bytes_used = 0
+        self.hits = 0
+        self.misses = 0
+        self.tokens_reused = 0
+        self.evictions = 0
+
+    def lookup(self, ids: List[int]) -> Tuple[int, Optional[State]]:
+        """
+        Find the longest cached prefix of `ids`.
+
+        Returns:
+            (prefix length, (h, c, logits)) or (0, None) on a miss
+        """
+        with self._lock:
+            node, best, best_len = self._root, None, 0
+            for i, token in enumerate(ids):
+                node = node.children.get(token)
+                if node is None:
+                    break
+                if node.state is not None:
+                    best, best_len = node, i + 1
+
+            if best is None:
+                self.misses += 1
+                return 0, None
+            self._lru.move_to_end(best)
+            self.hits += 1
+            self.tokens_reused += best_len
+            return best_len, best.state
+
+    def insert(self, ids: List[int], h: torch.Tensor, c: torch.Tensor, logits: torch.Tensor):
+        """Record the state after `ids`; tensors are copied so batch buffers are not pinned."""
+        if not ids:
+            return
+        with self._lock:
+            node = self._root
+            for token in ids:
+                child = node.children.get(token)
+                if child is None:
+                    child = _Node(node, token)
+                    node.children[token] = child
+                    self._nodes += 1
+                    self.bytes_used += _NODE_BYTES
+                node = child
+
+            if node.state is None:
+                state = (h.detach().clone(), c.detach().clone(), logits.detach().clone())
+                node.state = state
+                node.nbytes = sum(t.numel() * t.element_size() for t in state)
+                self.bytes_used += node.nbytes
+            self._lru[node] = None
+            self._lru.move_to_end(node)
+            self._evict()
+
+    def _evict(self):
+        while self.bytes_used > self.max_bytes and self._lru:
+            node, _ = self._lru.popitem(last=False)
+            node.state = None
+            self.bytes_used -= node.nbytes
+            node.nbytes = 0
+            self.evictions += 1
+            # Prune the now-empty tail of the trie
+            while node.parent is not None and not node.children and node.state is None:
+                del node.parent.children[node.token]
+                self._nodes -= 1
+                self.bytes_used -= _NODE_BYTES
+                node = node.parent
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "tokens_reused": self.tokens_reused,
+                "entries": len(self._lru),
+                "trie_nodes": self._nodes,
+                "bytes_used": self.bytes_used,
+                "max_bytes": self.max_bytes,
+                "evictions": self.evictions,
+            }
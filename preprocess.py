@@ -1,18 +1,114 @@
 # preprocess.py
-import sentencepiece as spm
+"""
+Encode a text corpus into a binary token file (see token_file.py).
 
-# Load the trained SentencePiece model
-sp = spm.SentencePieceProcessor()
-sp.load('mymodel.model')
+The input is read in chunks of lines and encoded across a process pool;
+each worker loads the SentencePiece model once and encodes a whole chunk
+with SentencePieceTokenizer.encode_batch, which hands back one flat id
+buffer plus offsets instead of a Python list per line. Only a bounded number of
+chunks is in flight at any time, and results are written in input order, so
+corpora larger than RAM go through in constant memory.
+
+Usage:
+    python preprocess.py training_data.txt -o encoded_data.bin
+"""
+
+import argparse
+import itertools
+import multiprocessing as mp
+import os
+from collections import deque
+from typing import Iterator, List, Tuple
+
+import numpy as np
+
+from token_file import TokenFileWriter, sha256_file, token_dtype
+from tokenizer import SentencePieceTokenizer, unflatten
+
+_sp = None
+_threads = 1
+
+
+def _init_worker(model_path: str, threads: int = 1):
+    global _sp, _threads
+    _sp = SentencePieceTokenizer(model_path)
+    _threads = threads
+
+
+def _encode_chunk(lines: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    dtype = token_dtype(_sp.get_vocab_size())
+    return _sp.encode_batch([line.strip() for line in lines], num_threads=_threads, dtype=dtype)
+
+
+def read_chunks(filename: str, chunk_lines: int) -> Iterator[List[str]]:
+    """Yield the file's lines `chunk_lines` at a time without reading it whole."""
+    with open(filename, "r", encoding="utf-8") as f:
+        while True:
+            chunk = list(itertools.islice(f, chunk_lines))
+            if not chunk:
+                return
+            yield chunk
+
+
+def encode_text_file(filename: str, model_path: str = "mymodel.model") -> List[List[int]]:
+    """Encode every line of `filename` in this process (small inputs, tests)."""
+    _init_worker(model_path)
+    return [ids for chunk in read_chunks(filename, 1024) for ids in unflatten(*_encode_chunk(chunk))]
+
+
+def encode_to_token_file(filename: str, output: str, model_path: str = "mymodel.model",
+                         workers: int = 0, chunk_lines: int = 4096, threads: int = 0) -> TokenFileWriter:
+    """
+    Encode `filename` one document per line into the token file `output`.
+
+    Args:
+        filename: UTF-8 text corpus
+        output: Path of the .bin file (the .idx is written next to it)
+        model_path: SentencePiece model used for encoding
+        workers: Encoder processes; 0 uses every available core
+        chunk_lines: Lines per task sent to a worker
+        threads: SentencePiece encoder threads per process; 0 gives a single
+            process every core and pool workers one thread each
+
+    Returns:
+        The closed writer, for its token / document counts
+    """
+    workers = workers or os.cpu_count() or 1
+    vocab_size = SentencePieceTokenizer(model_path).get_vocab_size()
+    chunks = read_chunks(filename, chunk_lines)
+
+    with TokenFileWriter(output, vocab_size, sha256_file(model_path)) as out:
+        if workers == 1:
+            _init_worker(model_path, threads or os.cpu_count() or 1)
+            for chunk in chunks:
+                out.write_flat(*_encode_chunk(chunk))
+            return out
+
+        with mp.Pool(workers, initializer=_init_worker, initargs=(model_path, threads or 1)) as pool:
+            # Pool.imap would read the whole input ahead; keep a fixed window instead
+            pending = deque()
+            for chunk in chunks:
+                pending.append(pool.apply_async(_encode_chunk, (chunk,)))
+                if len(pending) >= 2 * workers:
+                    out.write_flat(*pending.popleft().get())
+            while pending:
+                out.write_flat(*pending.popleft().get())
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Encode a text corpus into a binary token file")
+    parser.add_argument("input", nargs="?", default="training_data.txt")
+    parser.add_argument("-o", "--output", default="encoded_data.bin")
+    parser.add_argument("--model", default="mymodel.model")
+    parser.add_argument("--workers", type=int, default=0, help="encoder processes (0 = all cores)")
+    parser.add_argument("--chunk-lines", type=int, default=4096)
+    parser.add_argument("--threads", type=int, default=0, help="SentencePiece threads per process (0 = auto)")
+    args = parser.parse_args()
+
+    out = encode_to_token_file(args.input, args.output, args.model, args.workers, args.chunk_lines, args.threads)
+    print(f"✅ Encoded {out.num_docs} lines, {out.num_tokens} tokens ({out.dtype.name}) into {args.output}")
 
-def encode_text_file(filename):
-    with open(filename, 'r') as f:
-        lines = f.readlines()
-    encoded = [sp.encode(line.strip(), out_type=int) for line in lines]
-    return encoded
 
 if __name__ == '__main__':
-    data = encode_text_file('training_data.txt')
-    with open('encoded_data.txt', 'w') as f:
-        for line in data:
-            f.write(' '.join(map(str, line)) + '\n') 
\ No newline at end of file
+    main()
@@ -0,0 +1,287 @@
+"""
+Opt-in profiling of single requests.
+
+A request that asks for it (X-Profile header or ?profile=1) runs under
+torch.profiler while a span tracer records wall-clock phases (cache
+lookup, tokenization, generation, SSE serialization). When the request
+ends, a Chrome trace (open in chrome://tracing or Perfetto) with the spans
+on their own track, plus a text summary of the top-N operators and the
+spans, is written to the profile directory.
+
+torch.profiler is process-wide, so at most one request is profiled at a
+time, and a token bucket caps how many are profiled per minute; requests
+over the limit are served normally without a profile. Every thread is
+profiled, so operators of other requests that share the profiled one's
+batch show up in the trace too. With worker processes the forward pass
+runs outside this process and only the spans are recorded. Starting and
+stopping the profiler can take milliseconds, so start_async() and
+finish() do it on other threads rather than the event loop.
+"""
+
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from typing import AsyncIterator, Dict, List, Tuple
+
+import torch
+from torch.profiler import ProfilerActivity, profile
+
+# Trace process / thread ids for the span track, apart from real pids and tids
+_SPAN_PID = "Request spans"
+_SPAN_TID = 0
+
+
+def _new_profiler() -> profile:
+    activities = [ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(ProfilerActivity.CUDA)
+    try:
+        from torch._C._profiler import _ExperimentalConfig
+        # Decode loops run on their own threads, not the one that starts the profiler
+        config = _ExperimentalConfig(profile_all_threads=True)
+    except (ImportError, TypeError):
+        print("⚠️ This torch build can't profile every thread; only the request thread is traced")
+        config = None
+    return profile(activities=activities, record_shapes=True, experimental_config=config)
+
+
+class _NoProfile:
+    """Stand-in session for requests that are not profiled."""
+
+    active = False
+    name = None
+
+    def span(self, name: str):
+        return nullcontext()
+
+    def timed(self, name: str, iterator: AsyncIterator) -> AsyncIterator:
+        return iterator
+
+    def finish(self):
+        pass
+
+
+NO_PROFILE = _NoProfile()
+
+
+class ProfileSession:
+    """torch.profiler plus wall-clock spans for one request; see RequestProfiler.start()."""
+
+    active = True
+
+    def __init__(self, owner: "RequestProfiler", name: str):
+        self.owner = owner
+        self.name = name
+        self.spans: List[Tuple[str, int, int, int]] = []
+        self._prof = _new_profiler()
+        self._start_ns = time.time_ns()
+        self._end_ns = None
+        self._prof.start()
+
+    @contextmanager
+    def span(self, name: str):
+        """Time the enclosed block as a named phase of the request."""
+        start = time.time_ns()
+        try:
+            yield
+        finally:
+            self.spans.append((name, start, time.time_ns(), threading.get_ident()))
+
+    async def timed(self, name: str, iterator: AsyncIterator) -> AsyncIterator:
+        """Pass `iterator` through, recording each wait for its next item as a span."""
+        it = iterator.__aiter__()
+        while True:
+            with self.span(name):
+                try:
+                    item = await it.__anext__()
+                except StopAsyncIteration:
+                    return
+            yield item
+
+    def finish(self):
+        """Stop profiling and write the trace and summary, all from a background thread."""
+        if self._end_ns is not None:
+            return
+        self._end_ns = time.time_ns()
+        threading.Thread(target=self._stop_and_save, name=f"profile-{self.name}", daemon=True).start()
+
+    def _stop_and_save(self):
+        try:
+            self._prof.stop()
+        except Exception as e:
+            print(f"⚠️ Failed to stop the profiler for {self.name}: {e}")
+            return
+        finally:
+            self.owner._release()
+        try:
+            trace, summary = self.owner.paths(self.name)
+            self._prof.export_chrome_trace(trace)
+            self._add_spans(trace)
+            with open(summary, "w", encoding="utf-8") as f:
+                f.write(self.summary())
+            self.owner._prune()
+            print(f"🔬 Profile saved: {trace}")
+        except Exception as e:
+            print(f"⚠️ Failed to save profile {self.name}: {e}")
+
+    def _add_spans(self, path: str):
+        with open(path, encoding="utf-8") as f:
+            trace = json.load(f)
+        events = trace["traceEvents"] if isinstance(trace, dict) else trace
+        # Kineto timestamps are microseconds after baseTimeNanoseconds
+        base = trace.get("baseTimeNanoseconds", 0) if isinstance(trace, dict) else 0
+        events.append({"ph": "M", "name": "process_name", "pid": _SPAN_PID, "args": {"name": _SPAN_PID}})
+        events.append({"ph": "M", "name": "process_sort_index", "pid": _SPAN_PID, "args": {"sort_index": -1}})
+        spans = [("request", self._start_ns, self._end_ns, 0)] + self.spans
+        for name, start, end, thread in spans:
+            events.append({
+                "ph": "X", "cat": "span", "name": name, "pid": _SPAN_PID, "tid": _SPAN_TID,
+                "ts": (start - base) / 1000, "dur": (end - start) / 1000, "args": {"thread": thread},
+            })
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(trace, f)
+
+    def summary(self) -> str:
+        """The spans by total time, then the top operators by self CPU time."""
+        wall = (self._end_ns - self._start_ns) / 1e6
+        totals: Dict[str, List[float]] = {}
+        for name, start, end, _ in self.spans:
+            total = totals.setdefault(name, [0, 0.0])
+            total[0] += 1
+            total[1] += (end - start) / 1e6
+
+        lines = [f"Request {self.name}: {wall:.2f} ms wall clock", "", "Spans"]
+        lines.append(f"{'Name':<24} {'Calls':>7} {'Total ms':>11} {'% wall':>8}")
+        for name, (calls, ms) in sorted(totals.items(), key=lambda item: -item[1][1]):
+            share = 100 * ms / wall if wall else 0.0
+            lines.append(f"{name:<24} {calls:>7} {ms:>11.3f} {share:>7.1f}%")
+        lines += ["", f"Top {self.owner.top_n} operators by self CPU time"]
+        table = self._prof.key_averages().table(sort_by="self_cpu_time_total", row_limit=self.owner.top_n)
+        # Empty when the forward pass ran in a worker process
+        lines.append(table or "(none recorded in this process)")
+        return "\n".join(lines) + "\n"
+
+
+class RequestProfiler:
+    """
+    Hands out ProfileSessions, one at a time and at most `max_per_minute`.
+
+    Usage:
+        profiler = RequestProfiler("profiles", max_per_minute=2)
+        session = await profiler.start_async("generate", requested=True)
+        with session.span("tokenize"):
+            ids = encode(prompt)
+        ...
+        session.finish()
+    """
+
+    def __init__(self, directory: str = "profiles", max_per_minute: float = 0.0, sample_rate: float = 0.0,
+                 top_n: int = 25, keep: int = 100):
+        """
+        Args:
+            directory: Where traces and summaries are written
+            max_per_minute: Profiles allowed per minute, with a burst of one (0, the default, disables profiling)
+            sample_rate: Fraction of requests profiled without asking for it
+            top_n: Operators listed in each summary
+            keep: Most recent profiles kept on disk; older ones are deleted
+        """
+        self.directory = directory
+        self.max_per_minute = float(max_per_minute)
+        self.sample_rate = float(sample_rate)
+        self.top_n = int(top_n)
+        self.keep = int(keep)
+        self._lock = threading.Lock()
+        self._busy = False
+        self._tokens = 1.0
+        self._refilled = time.monotonic()
+        self._count = 0
+        self.profiled = 0
+        self.skipped = 0
+        if self.enabled:
+            os.makedirs(self.directory, exist_ok=True)
+            # The first profiler start in a process initializes Kineto, which takes a while
+            warmup = _new_profiler()
+            warmup.start()
+            warmup.stop()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_per_minute > 0
+
+    def start(self, endpoint: str, requested: bool):
+        """
+        Begin profiling a request if it asked for it (or is sampled) and the limits allow.
+
+        Returns:
+            A ProfileSession, or NO_PROFILE whose span() and finish() do nothing
+        """
+        name = self._admit(endpoint, requested)
+        return NO_PROFILE if name is None else self._open(name)
+
+    async def start_async(self, endpoint: str, requested: bool):
+        """Like start(), but the profiler is started in a worker thread instead of the event loop."""
+        name = self._admit(endpoint, requested)
+        return NO_PROFILE if name is None else await asyncio.to_thread(self._open, name)
+
+    def paths(self, name: str) -> Tuple[str, str]:
+        """Chrome trace and summary paths for a session name."""
+        base = os.path.join(self.directory, name)
+        return f"{base}.trace.json", f"{base}.summary.txt"
+
+    def stats(self) -> Dict[str, object]:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "directory": self.directory,
+                "max_per_minute": self.max_per_minute,
+                "sample_rate": self.sample_rate,
+                "profiled": self.profiled,
+                "skipped": self.skipped,
+            }
+
+    def _admit(self, endpoint: str, requested: bool):
+        """A session name if this request gets profiled (taking the slot), else None."""
+        if not self.enabled:
+            return None
+        if not requested and not (self.sample_rate > 0 and random.random() < self.sample_rate):
+            return None
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(1.0, self._tokens + (now - self._refilled) * self.max_per_minute / 60.0)
+            self._refilled = now
+            if self._busy or self._tokens < 1.0:
+                self.skipped += 1
+                return None
+            self._busy = True
+            self._tokens -= 1.0
+            self._count += 1
+            self.profiled += 1
+            return f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{self._count}-{endpoint}"
+
+    def _open(self, name: str):
+        try:
+            return ProfileSession(self, name)
+        except Exception as e:
+            print(f"⚠️ Could not start the profiler: {e}")
+            self._release()
+            return NO_PROFILE
+
+    def _prune(self):
+        traces = sorted(
+            (entry for entry in os.scandir(self.directory) if entry.name.endswith(".trace.json")),
+            key=lambda entry: entry.stat().st_mtime,
+        )
+        for entry in traces[:max(0, len(traces) - self.keep)]:
+            for path in self.paths(entry.name[:-len(".trace.json")]):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def _release(self):
+        with self._lock:
+            self._busy = False
@@ -0,0 +1,214 @@
+"""
+Exact-match cache for deterministic generation responses.
+
+Entries live in an in-memory LRU bounded by bytes and expire after a TTL.
+With a `path`, every entry is also written to a SQLite file so the cache
+survives restarts; misses in memory fall through to disk. Disk writes are
+queued to a background thread that commits them in batches, and
+`get_async` reads disk from a worker thread, so neither blocks the event
+loop.
+"""
+
+import asyncio
+import hashlib
+import json
+import queue
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+# Memory lookup result meaning "not in memory, try disk"
+_MISS = object()
+
+class ResponseCache:
+    """
+    Maps a request key to a JSON-serializable dict.
+
+    Callers decide what is cacheable; this class only stores, expires and
+    evicts. Values are stored serialized, so a hit always returns a fresh
+    copy.
+    """
+
+    # Prune expired / over-budget rows from disk once every this many writes
+    PRUNE_EVERY = 64
+    # Most queued writes committed in one transaction
+    WRITE_BATCH = 256
+
+    def __init__(self, max_bytes: int, ttl: float = 3600.0, path: Optional[str] = None):
+        """
+        Args:
+            max_bytes: Budget for serialized values, in memory and on disk each
+            ttl: Seconds an entry stays valid after it is written
+            path: Optional SQLite file backing the cache
+        """
+        self.max_bytes = int(max_bytes)
+        self.ttl = float(ttl)
+        self.path = path
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (expires, payload)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self.evictions = 0
+
+        self._db = None
+        # The connection is shared by the writer thread and disk lookups
+        self._db_lock = threading.Lock()
+        self._pending: "queue.Queue[tuple]" = queue.Queue()
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses "
+                "(key TEXT PRIMARY KEY, expires REAL NOT NULL, written REAL NOT NULL, value TEXT NOT NULL)"
+            )
+            self._db.commit()
+            threading.Thread(target=self._write_loop, name="response-cache-writer", daemon=True).start()
+
+    @staticmethod
+    def make_key(**fields: Any) -> str:
+        """Stable key for a set of request fields."""
+        blob = json.dumps(fields, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Look `key` up in memory, then on disk; blocks on SQLite, so call get_async() from the event loop."""
+        value = self._get_memory(key)
+        if value is _MISS:
+            value = self._get_disk(key)
+        return value
+
+    async def get_async(self, key: str) -> Optional[Dict[str, Any]]:
+        """Like get(), but memory misses are looked up on disk in a worker thread."""
+        value = self._get_memory(key)
+        if value is _MISS:
+            value = await asyncio.to_thread(self._get_disk, key)
+        return value
+
+    def put(self, key: str, value: Dict[str, Any]):
+        """Store in memory now and queue the disk write for the background writer."""
+        payload = json.dumps(value, separators=(",", ":"))
+        if len(payload) > self.max_bytes:
+            return
+        now = time.time()
+        expires = now + self.ttl
+        with self._lock:
+            self._remember(key, expires, payload)
+        if self._db is not None:
+            self._pending.put((key, expires, now, payload))
+
+    def flush(self):
+        """Block until every queued disk write is committed."""
+        if self._db is not None:
+            self._pending.join()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "disk_hits": self.disk_hits,
+                "entries": len(self._entries),
+                "bytes_used": self._bytes,
+                "max_bytes": self.max_bytes,
+                "evictions": self.evictions,
+                "ttl": self.ttl,
+                "path": self.path,
+            }
+
+    # ----------------------------
+    # Lookups and disk writes
+    # ----------------------------
+    def _get_memory(self, key: str):
+        """The cached value, None on a miss, or _MISS when disk still has to be checked."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, payload = entry
+                if expires > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return json.loads(payload)
+                self._drop(key)
+            if self._db is not None:
+                return _MISS
+            self.misses += 1
+            return None
+
+    def _get_disk(self, key: str) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        with self._db_lock:
+            row = self._db.execute("SELECT expires, value FROM responses WHERE key = ?", (key,)).fetchone()
+        with self._lock:
+            if row is not None and row[0] > now:
+                self._remember(key, row[0], row[1])
+                self.hits += 1
+                self.disk_hits += 1
+                return json.loads(row[1])
+            self.misses += 1
+            return None
+
+    def _write_loop(self):
+        while True:
+            batch = [self._pending.get()]
+            while len(batch) < self.WRITE_BATCH:
+                try:
+                    batch.append(self._pending.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                with self._db_lock:
+                    self._db.executemany(
+                        "INSERT OR REPLACE INTO responses (key, expires, written, value) VALUES (?, ?, ?, ?)", batch
+                    )
+                    before = self._writes
+                    self._writes += len(batch)
+                    if self._writes // self.PRUNE_EVERY > before // self.PRUNE_EVERY:
+                        self._prune_disk(time.time())
+                    self._db.commit()
+            except sqlite3.Error as e:
+                print(f"⚠️ Response cache: failed to write {len(batch)} entries to {self.path}: {e}")
+            finally:
+                for _ in batch:
+                    self._pending.task_done()
+
+    # ----------------------------
+    # Internals (lock held)
+    # ----------------------------
+    def _remember(self, key: str, expires: float, payload: str):
+        if key in self._entries:
+            self._drop(key)
+        self._entries[key] = (expires, payload)
+        self._bytes += len(payload)
+        while self._bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._drop(oldest)
+            self.evictions += 1
+
+    def _drop(self, key: str):
+        _, payload = self._entries.pop(key)
+        self._bytes -= len(payload)
+
+    def _prune_disk(self, now: float):
+        # Called by the writer with _db_lock held
+        self._db.execute("DELETE FROM responses WHERE expires <= ?", (now,))
+        total = self._db.execute("SELECT COALESCE(SUM(LENGTH(value)), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # Oldest writes go first until the file is back under budget
+        excess = total - self.max_bytes
+        freed = 0
+        stale = []
+        rows = self._db.execute("SELECT key, LENGTH(value) FROM responses ORDER BY written").fetchall()
+        for key, size in rows:
+            stale.append((key,))
+            freed += size
+            if freed >= excess:
+                break
+        self._db.executemany("DELETE FROM responses WHERE key = ?", stale)
@@ -0,0 +1,144 @@
+"""
+Batched next-token sampling shared by the local batcher and the HF engine.
+
+Temperature, top-k, top-p and repetition penalty are applied to every row of
+a batch in one vectorized pass, with per-row parameters and scratch buffers
+that are reused from step to step.
+"""
+
+from typing import List, Optional
+
+import torch
+
+
+class Sampler:
+    """
+    Samples one token per row from a (batch, vocab) block of logits.
+
+    One Sampler belongs to one decode loop: its buffers are overwritten on
+    every call, so the returned token tensor is only valid until the next
+    call.
+    """
+
+    def __init__(self, vocab_size: int, max_batch: int = 32, device="cpu"):
+        self.vocab_size = vocab_size
+        self.device = device
+        self._reserve(max(1, int(max_batch)), vocab_size)
+
+    def _reserve(self, batch: int, vocab: int):
+        self.vocab_size = vocab
+        self._weights = torch.empty(batch, vocab, device=self.device)
+        self._tokens = torch.empty(batch, 1, dtype=torch.long, device=self.device)
+
+    def _weights_for(
+        self,
+        logits: torch.Tensor,
+        temperature: torch.Tensor,
+        top_k: torch.Tensor,
+        top_p: Optional[torch.Tensor] = None,
+        repetition_penalty: Optional[torch.Tensor] = None,
+        seen: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        """
+        Apply penalty, temperature, top-k and top-p to a copy of `logits`.
+
+        Args:
+            logits: (batch, vocab) next-token logits
+            temperature: (batch,) temperatures, clamped to at least 1e-6
+            top_k: (batch,) top-k limits, 0 meaning "no limit"
+            top_p: (batch,) nucleus thresholds, 1.0 meaning "no limit"
+            repetition_penalty: (batch,) CTRL-style penalties, 1.0 meaning "off"
+            seen: (batch, vocab) bool mask of tokens already in each sequence
+
+        Returns:
+            (batch, vocab) unnormalized sampling weights, in the scratch buffer
+        """
+        batch, vocab = logits.shape
+        if batch > self._weights.size(0) or vocab != self.vocab_size:
+            self._reserve(max(batch, self._weights.size(0)), vocab)
+        x = self._weights[:batch]
+        x.copy_(logits)
+
+        if repetition_penalty is not None and seen is not None and bool((repetition_penalty != 1.0).any()):
+            penalty = repetition_penalty.unsqueeze(1).to(x.dtype)
+            penalized = torch.where(x > 0, x / penalty, x * penalty)
+            torch.where(seen, penalized, x, out=x)
+
+        x.div_(temperature.clamp_min(1e-6).unsqueeze(1).to(x.dtype))
+
+        k = torch.where(top_k > 0, top_k.clamp(max=vocab), torch.full_like(top_k, vocab))
+        if bool((k < vocab).any()):
+            kth = torch.topk(x, int(k.max()), dim=-1).values.gather(1, (k - 1).unsqueeze(1))
+            x.masked_fill_(x < kth, float("-inf"))
+
+        if top_p is not None and bool((top_p < 1.0).any()):
+            sorted_x, order = torch.sort(x, dim=-1, descending=True)
+            probs = torch.softmax(sorted_x, dim=-1)
+            # Drop a token once the tokens ranked above it already cover top_p
+            drop = (probs.cumsum(-1) - probs) > top_p.unsqueeze(1).to(probs.dtype)
+            sorted_x.masked_fill_(drop, float("-inf"))
+            x.scatter_(1, order, sorted_x)
+
+        # Unnormalized softmax in place: multinomial only needs relative weights
+        return x.sub_(x.max(dim=-1, keepdim=True).values).exp_()
+
+    def sample(
+        self,
+        logits: torch.Tensor,
+        temperature: torch.Tensor,
+        top_k: torch.Tensor,
+        top_p: Optional[torch.Tensor] = None,
+        repetition_penalty: Optional[torch.Tensor] = None,
+        seen: Optional[torch.Tensor] = None,
+        generators: Optional[List[Optional[torch.Generator]]] = None,
+    ) -> torch.Tensor:
+        """
+        Sample one token per row; arguments as for `_weights_for`.
+
+        Rows with an entry in `generators` draw from their own RNG, so a
+        seeded request samples the same tokens whatever it is batched with.
+
+        Returns:
+            (batch,) tensor of sampled token ids
+        """
+        x = self._weights_for(logits, temperature, top_k, top_p, repetition_penalty, seen)
+        batch = x.size(0)
+        tokens = self._tokens[:batch]
+        torch.multinomial(x, 1, out=tokens)
+        if generators is not None:
+            for i, generator in enumerate(generators):
+                if generator is not None:
+                    # Exponential race: argmax(w / E) with E ~ Exp(1) is a draw proportional to w
+                    noise = torch.empty_like(x[i]).exponential_(generator=generator)
+                    tokens[i, 0] = (x[i] / noise).argmax()
+        return tokens.squeeze(1)
+
+    def probs(
+        self,
+        logits: torch.Tensor,
+        temperature: torch.Tensor,
+        top_k: torch.Tensor,
+        top_p: Optional[torch.Tensor] = None,
+        repetition_penalty: Optional[torch.Tensor] = None,
+        seen: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        """
+        The normalized distribution `sample` would draw from, as a new
+        (batch, vocab) tensor that stays valid across calls.
+        """
+        x = self._weights_for(logits, temperature, top_k, top_p, repetition_penalty, seen)
+        return x / x.sum(dim=-1, keepdim=True)
+
+
+def seeded_generator(seed: Optional[int], device="cpu") -> Optional[torch.Generator]:
+    """A private RNG for one request, or None to use the global one."""
+    if seed is None:
+        return None
+    generator = torch.Generator(device=device)
+    generator.manual_seed(int(seed))
+    return generator
+
+
+def mark_seen(seen: torch.Tensor, tokens: torch.Tensor):
+    """Record each row's new token in a (batch, vocab) repetition mask."""
+    seen[torch.arange(tokens.size(0), device=tokens.device), tokens] = True
@@ -0,0 +1,101 @@
+"""
+Helpers shared by the streaming generation paths.
+"""
+
+import asyncio
+import queue
+from typing import AsyncIterator, Callable, Iterator, List, Optional, Sequence
+
+
+class IncrementalDecoder:
+    """
+    Turn a growing list of token ids into text deltas.
+
+    Decoding a single token on its own is wrong for multi-token characters and
+    for tokenizers that drop a leading word-boundary marker, so each step
+    decodes a short window of ids and emits only the text it adds. A delta is
+    held back while it ends in an incomplete character (U+FFFD).
+    """
+
+    def __init__(self, decode: Callable[[List[int]], str], context_ids: Sequence[int] = ()):
+        """
+        Args:
+            decode: Function mapping a list of ids to text
+            context_ids: Ids already shown to the user (e.g. the prompt tail)
+        """
+        self._decode = decode
+        self.ids: List[int] = list(context_ids)
+        self._prefix = 0
+        self._read = len(self.ids)
+
+    def push(self, token_id: int) -> str:
+        """Add one id and return the newly completed text (possibly empty)."""
+        self.ids.append(token_id)
+        prefix_text = self._decode(self.ids[self._prefix:self._read])
+        new_text = self._decode(self.ids[self._prefix:])
+        if len(new_text) > len(prefix_text) and not new_text.endswith("\ufffd"):
+            self._prefix = self._read
+            self._read = len(self.ids)
+            return new_text[len(prefix_text):]
+        return ""
+
+    def flush(self) -> str:
+        """Return whatever text is still held back at the end of generation."""
+        if self._read >= len(self.ids):
+            return ""
+        prefix_text = self._decode(self.ids[self._prefix:self._read])
+        new_text = self._decode(self.ids[self._prefix:])
+        self._prefix = self._read = len(self.ids)
+        return new_text[len(prefix_text):]
+
+
+class TokenStream:
+    """
+    Thread-safe channel from a decode loop to one consumer.
+
+    The producer calls put() for every item and close() once; iterating the
+    stream yields items until close() and re-raises the producer's error.
+    A stream created with an event loop is consumed with `async for`, so the
+    consumer never blocks a thread while waiting for the next item.
+    """
+
+    _DONE = object()
+
+    def __init__(self, loop: Optional[asyncio.AbstractEventLoop] = None):
+        self._loop = loop
+        self._queue = asyncio.Queue() if loop is not None else queue.Queue()
+        self.cancelled = False
+
+    def cancel(self):
+        """Tell the producer the consumer has gone away."""
+        self.cancelled = True
+
+    def put(self, item):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, item)
+        else:
+            self._queue.put(item)
+
+    def close(self, error: Optional[BaseException] = None):
+        self.put((self._DONE, error))
+
+    def _unwrap(self, item):
+        if isinstance(item, tuple) and len(item) == 2 and item[0] is self._DONE:
+            if item[1] is not None:
+                raise item[1]
+            return self._DONE
+        return item
+
+    def __iter__(self) -> Iterator:
+        while True:
+            item = self._unwrap(self._queue.get())
+            if item is self._DONE:
+                return
+            yield item
+
+    async def __aiter__(self) -> AsyncIterator:
+        while True:
+            item = self._unwrap(await self._queue.get())
+            if item is self._DONE:
+                return
+            yield item
@@ -0,0 +1,221 @@
+"""
+Tokenization cache for the serving hot path.
+
+Prompts are split into segments at line boundaries ("...x\\n" | "y..."),
+and every segment's ids are cached under a hash chained from the tokenizer
+identity and all the segments before it. A prompt that shares its leading
+lines with an earlier one (system prompt, template header) reuses those
+segments' ids and only encodes the lines after them; a repeated prompt is a
+full hit. One cache can serve several tokenizers, bounded by the total
+number of cached ids.
+
+Encoding segment by segment is only equal to encoding the whole text when
+the tokenizer never merges across such a boundary. Each tokenizer is
+probed for that when it is registered, and a sample of composed results is
+re-checked against a full encode while serving; on any mismatch the
+tokenizer falls back to whole-text caching.
+"""
+
+import hashlib
+import re
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
+
+# A boundary right after a newline, with no whitespace on either side of it
+SEGMENT_BOUNDARY = re.compile(r"(?<=\S\n)(?=\S)")
+
+# Texts that must encode the same whole and segment by segment
+PROBE_TEXTS = [
+    "Hello world.\nHow are you?\nFine, thanks",
+    "System: answer briefly.\nUser: hi there\nAssistant:",
+    "a\nb",
+    "x  \n\n  y\nz",
+    "1.\n2.\n3",
+    "don't\n'tis\nit's\n",
+    "café\nnaïve\n你好\n!",
+]
+
+EncodeFn = Callable[[str], List[int]]
+EncodeManyFn = Callable[[List[str]], List[List[int]]]
+
+
+class _Tokenizer:
+    def __init__(self, name: str, encode: EncodeFn, encode_pieces: Optional[EncodeManyFn]):
+        self.name = name
+        self.encode = encode
+        self.encode_pieces = encode_pieces
+        self.root = hashlib.blake2b(name.encode("utf-8"), digest_size=16).digest()
+        self.segmented = encode_pieces is not None
+        self.composed = 0
+
+
+class TokenCache:
+    """
+    LRU of token ids keyed by (tokenizer, chained segment hash).
+
+    Usage:
+        cache = TokenCache(max_tokens=1 << 20)
+        encode = cache.register("sp:<sha256>", lambda t: sp.encode(t, out_type=int),
+                                lambda ts: sp.encode(ts, out_type=int))
+        ids = encode(prompt)
+    """
+
+    def __init__(self, max_tokens: int = 1 << 20, verify_every: int = 256):
+        """
+        Args:
+            max_tokens: Budget for cached ids across every tokenizer
+            verify_every: Re-encode every this-many composed prompts whole and
+                compare (0 = never)
+        """
+        self.max_tokens = int(max_tokens)
+        self.verify_every = int(verify_every)
+        self._tokenizers: Dict[str, _Tokenizer] = {}
+        self._entries: "OrderedDict[bytes, array]" = OrderedDict()
+        self._tokens = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.partial_hits = 0
+        self.misses = 0
+        self.tokens_reused = 0
+        self.tokens_encoded = 0
+        self.evictions = 0
+        self.mismatches = 0
+        self._encode_seconds = 0.0
+        self._lookup_seconds = 0.0
+
+    def register(self, name: str, encode: EncodeFn, encode_pieces: Optional[EncodeManyFn] = None) -> EncodeFn:
+        """
+        Put the cache in front of a tokenizer.
+
+        Args:
+            name: Tokenizer identity (e.g. model file hash); part of every key
+            encode: Encodes a whole text, special tokens included
+            encode_pieces: Encodes a list of continuation segments without
+                special tokens; None caches whole texts only
+
+        Returns:
+            A drop-in encode(text) -> ids function that goes through the cache
+        """
+        tokenizer = _Tokenizer(name, encode, encode_pieces)
+        if tokenizer.segmented and not all(_compose_ok(tokenizer, text) for text in PROBE_TEXTS):
+            print(f"⚠️ Token cache: {name} merges across line boundaries; caching whole prompts only")
+            tokenizer.segmented = False
+        with self._lock:
+            self._tokenizers[name] = tokenizer
+        return lambda text: self.encode(name, text)
+
+    def encode(self, name: str, text: str) -> List[int]:
+        tokenizer = self._tokenizers[name]
+        start = time.perf_counter()
+        segments = SEGMENT_BOUNDARY.split(text) if tokenizer.segmented else [text]
+        keys = []
+        key = tokenizer.root
+        for segment in segments:
+            key = hashlib.blake2b(segment.encode("utf-8"), digest_size=16, key=key).digest()
+            keys.append(key)
+
+        ids: List[int] = []
+        with self._lock:
+            known = 0
+            for key in keys:
+                cached = self._entries.get(key)
+                if cached is None:
+                    break
+                ids.extend(cached)
+                known += 1
+            self._lookup_seconds += time.perf_counter() - start
+            if known == len(segments):
+                self._touch(keys)
+                self.hits += 1
+                self.tokens_reused += len(ids)
+                return ids
+
+        reused = len(ids)
+        start = time.perf_counter()
+        rest = segments[known:]
+        if known == 0:
+            first = tokenizer.encode(rest[0])
+            pieces = [first] + (tokenizer.encode_pieces(rest[1:]) if len(rest) > 1 else [])
+        else:
+            pieces = tokenizer.encode_pieces(rest)
+        elapsed = time.perf_counter() - start
+        for piece in pieces:
+            ids.extend(piece)
+
+        if len(segments) > 1 and self.verify_every > 0:
+            tokenizer.composed += 1
+            if (tokenizer.composed - 1) % self.verify_every == 0:
+                whole = tokenizer.encode(text)
+                if whole != ids:
+                    print(f"⚠️ Token cache: segmented encoding differs for {name}; caching whole prompts only")
+                    with self._lock:
+                        self.mismatches += 1
+                        tokenizer.segmented = False
+                    return whole
+
+        with self._lock:
+            if known:
+                self.partial_hits += 1
+                self.tokens_reused += reused
+            else:
+                self.misses += 1
+            self.tokens_encoded += len(ids) - reused
+            self._encode_seconds += elapsed
+            for key, piece in zip(keys[known:], pieces):
+                self._remember(key, array("i", piece))
+            self._touch(keys[:known])
+        return ids
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.partial_hits + self.misses
+            per_token = self._encode_seconds / self.tokens_encoded if self.tokens_encoded else 0.0
+            return {
+                "hits": self.hits,
+                "partial_hits": self.partial_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.partial_hits) / lookups if lookups else 0.0,
+                "tokens_reused": self.tokens_reused,
+                "tokens_encoded": self.tokens_encoded,
+                # Reused tokens at the measured encode cost per token, less the hashing overhead
+                "time_saved_s": max(0.0, self.tokens_reused * per_token - self._lookup_seconds),
+                "entries": len(self._entries),
+                "tokens_cached": self._tokens,
+                "max_tokens": self.max_tokens,
+                "evictions": self.evictions,
+                "mismatches": self.mismatches,
+                "tokenizers": {name: {"segmented": t.segmented} for name, t in self._tokenizers.items()},
+            }
+
+    # ----------------------------
+    # Internals (lock held)
+    # ----------------------------
+    def _touch(self, keys: List[bytes]):
+        # Leading segments end up most recent, so a chain is evicted from its tail
+        for key in reversed(keys):
+            if key in self._entries:
+                self._entries.move_to_end(key)
+
+    def _remember(self, key: bytes, ids: array):
+        if len(ids) > self.max_tokens:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._tokens -= len(old)
+        self._entries[key] = ids
+        self._tokens += len(ids)
+        while self._tokens > self.max_tokens:
+            _, evicted = self._entries.popitem(last=False)
+            self._tokens -= len(evicted)
+            self.evictions += 1
+
+
+def _compose_ok(tokenizer: _Tokenizer, text: str) -> bool:
+    segments = SEGMENT_BOUNDARY.split(text)
+    composed = list(tokenizer.encode(segments[0]))
+    for piece in tokenizer.encode_pieces(segments[1:]) if len(segments) > 1 else []:
+        composed.extend(piece)
+    return composed == list(tokenizer.encode(text))
@@ -0,0 +1,184 @@
+"""
+Compact binary token files.
+
+A token file is a pair:
+
+  <name>.bin  128-byte header (zero padded), then every document's ids back to back
+  <name>.idx  uint64 token offsets, one per document boundary (num_docs + 1)
+
+Header layout (little endian):
+
+  8s  magic "TOKBIN1\\0"
+  I   format version
+  I   bytes per token (2 = uint16, 4 = uint32)
+  I   vocab size
+  Q   number of tokens
+  Q   number of documents
+  32s sha256 of the tokenizer model file the ids came from
+
+Both files are written sequentially and read back with np.memmap, so neither
+side has to hold the corpus in memory.
+"""
+
+import hashlib
+import os
+import struct
+from typing import Iterable, List, Optional, Tuple
+
+import numpy as np
+
+MAGIC = b"TOKBIN1\0"
+VERSION = 1
+HEADER = struct.Struct("<8sIIIQQ32s")
+HEADER_SIZE = 128
+
+
+def sha256_file(path: str) -> str:
+    """Hex sha256 of a file, read in blocks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def token_dtype(vocab_size: int) -> np.dtype:
+    """Smallest unsigned dtype that holds every id of the vocabulary."""
+    return np.dtype(np.uint16) if vocab_size <= 1 << 16 else np.dtype(np.uint32)
+
+
+def index_path(path: str) -> str:
+    return os.path.splitext(path)[0] + ".idx"
+
+
+class TokenFileWriter:
+    """
+    Streams documents into a token file.
+
+    Usage:
+        with TokenFileWriter("encoded_data.bin", vocab_size, sha256_file("mymodel.model")) as out:
+            out.write(ids)
+    """
+
+    def __init__(self, path: str, vocab_size: int, tokenizer_sha256: str):
+        self.path = path
+        self.vocab_size = int(vocab_size)
+        self.tokenizer_sha256 = tokenizer_sha256
+        self.dtype = token_dtype(self.vocab_size)
+        self.num_tokens = 0
+        self.num_docs = 0
+        self._bin = open(path, "wb")
+        self._idx = open(index_path(path), "wb")
+        self._bin.write(b"\0" * HEADER_SIZE)  # rewritten with the final counts on close
+        self._idx.write(np.zeros(1, dtype=np.uint64).tobytes())
+
+    def write(self, ids: Iterable[int]):
+        """Append one document."""
+        arr = np.asarray(ids, dtype=np.int64)
+        if arr.size and (arr.min() < 0 or arr.max() >= self.vocab_size):
+            raise ValueError(f"token id out of range for vocab size {self.vocab_size}")
+        self._bin.write(arr.astype(self.dtype).tobytes())
+        self.num_tokens += int(arr.size)
+        self.num_docs += 1
+        self._idx.write(np.uint64(self.num_tokens).tobytes())
+
+    def write_many(self, docs: Iterable[Iterable[int]]):
+        for ids in docs:
+            self.write(ids)
+
+    def write_flat(self, ids: np.ndarray, offsets: np.ndarray):
+        """Append the documents ids[offsets[i]:offsets[i + 1]] with one write per file."""
+        ids = np.asarray(ids)
+        offsets = np.asarray(offsets, dtype=np.int64)
+        ids = ids[offsets[0]:offsets[-1]]
+        if ids.size and (ids.min() < 0 or ids.max() >= self.vocab_size):
+            raise ValueError(f"token id out of range for vocab size {self.vocab_size}")
+        self._bin.write(ids.astype(self.dtype, copy=False).tobytes())
+        ends = (offsets[1:] - offsets[0] + self.num_tokens).astype(np.uint64)
+        self._idx.write(ends.tobytes())
+        self.num_tokens += int(ids.size)
+        self.num_docs += len(ends)
+
+    def close(self):
+        if self._bin.closed:
+            return
+        self._bin.seek(0)
+        self._bin.write(HEADER.pack(
+            MAGIC,
+            VERSION,
+            self.dtype.itemsize,
+            self.vocab_size,
+            self.num_tokens,
+            self.num_docs,
+            bytes.fromhex(self.tokenizer_sha256),
+        ))
+        self._bin.close()
+        self._idx.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_header(path: str) -> Tuple[np.dtype, int, int, int, str]:
+    """
+    Returns:
+        (dtype, vocab_size, num_tokens, num_docs, tokenizer sha256)
+    """
+    with open(path, "rb") as f:
+        raw = f.read(HEADER.size)
+    if len(raw) < HEADER.size:
+        raise ValueError(f"{path}: file too short for a token file header")
+    magic, version, itemsize, vocab_size, num_tokens, num_docs, sha = HEADER.unpack(raw)
+    if magic != MAGIC:
+        raise ValueError(f"{path}: not a token file")
+    if version != VERSION:
+        raise ValueError(f"{path}: unsupported token file version {version}")
+    dtype = {2: np.dtype(np.uint16), 4: np.dtype(np.uint32)}.get(itemsize)
+    if dtype is None:
+        raise ValueError(f"{path}: unsupported token width {itemsize}")
+    return dtype, vocab_size, num_tokens, num_docs, sha.hex()
+
+
+class TokenFile:
+    """
+    Read-only, memory-mapped view of a token file.
+
+    `tokens` is the flat id array and `offsets[i]:offsets[i + 1]` the span of
+    document i; indexing returns that span as an array view.
+    """
+
+    def __init__(self, path: str, tokenizer_model: Optional[str] = None):
+        """
+        Args:
+            path: The .bin file
+            tokenizer_model: If given, raise ValueError unless the file was
+                encoded with this exact tokenizer model
+        """
+        self.path = path
+        self.dtype, self.vocab_size, self.num_tokens, self.num_docs, self.tokenizer_sha256 = read_header(path)
+        if tokenizer_model is not None and sha256_file(tokenizer_model) != self.tokenizer_sha256:
+            raise ValueError(f"{path} was encoded with a different tokenizer than {tokenizer_model}")
+        if self.num_tokens:
+            self.tokens = np.memmap(path, dtype=self.dtype, mode="r", offset=HEADER_SIZE, shape=(self.num_tokens,))
+        else:
+            self.tokens = np.zeros(0, dtype=self.dtype)
+        self.offsets = np.memmap(index_path(path), dtype=np.uint64, mode="r", shape=(self.num_docs + 1,))
+
+    def __len__(self) -> int:
+        return self.num_docs
+
+    def __getitem__(self, i: int) -> np.ndarray:
+        if not -self.num_docs <= i < self.num_docs:
+            raise IndexError(i)
+        i %= self.num_docs
+        return self.tokens[int(self.offsets[i]):int(self.offsets[i + 1])]
+
+    def lengths(self) -> np.ndarray:
+        return np.diff(self.offsets.astype(np.int64))
+
+    def documents(self) -> List[List[int]]:
+        """Every document as a list of ints (loads the whole file)."""
+        return [self[i].tolist() for i in range(self.num_docs)]
@@ -4,9 +4,16 @@ Advanced Tokenizer Implementation
 A tokenizer with both basic word-based and SentencePiece subword tokenization.
 """
 
+import heapq
+import json
+import multiprocessing as mp
+import os
 import re
-from typing import List, Dict, Any, Optional
-from collections import Counter
+from itertools import chain, islice, repeat
+from typing import List, Dict, Any, Iterable, Iterator, Optional, Sequence, Tuple, Union
+from collections import Counter, deque
+
+import numpy as np
 
 try:
     import sentencepiece as spm
@@ -15,6 +22,98 @@ except ImportError:
     SENTENCEPIECE_AVAILABLE = False
     print("Warning: sentencepiece not available. Install with: pip install sentencepiece")
 
+# Compiled once instead of on every call
+_PUNCTUATION_RE = re.compile(r"[^\w\s']")
+_WHITESPACE_RE = re.compile(r"\s+")
+
+# encode_batch preprocesses a whole batch as one string, with texts separated
+# by a character the punctuation filter leaves alone
+_BATCH_SEP = "\x00"
+_BATCH_PUNCTUATION_RE = re.compile(r"[^\w\s'\x00]")
+
+UNK_TOKEN = '<UNK>'
+
+VOCAB_FORMAT = 'word-vocab-v1'
+
+_worker_tokenizer = None
+
+
+def _init_count_worker(lowercase: bool, remove_punctuation: bool):
+    global _worker_tokenizer
+    _worker_tokenizer = Tokenizer(lowercase, remove_punctuation)
+
+
+def _count_chunk(texts: List[str]) -> Counter:
+    return _worker_tokenizer.count_words(texts)
+
+
+def _iter_chunks(texts: Union[str, os.PathLike, Iterable[str]], chunk_size: int) -> Iterator[List[str]]:
+    """Yield `texts` (an iterable, or a path read one text per line) `chunk_size` at a time."""
+    if isinstance(texts, (str, os.PathLike)):
+        with open(texts, 'r', encoding='utf-8') as f:
+            yield from _iter_chunks(f, chunk_size)
+        return
+    texts = iter(texts)
+    while True:
+        chunk = list(islice(texts, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def unflatten(ids: np.ndarray, offsets: Sequence[int]) -> List[List[int]]:
+    """Split a flat id buffer back into one Python list per sequence."""
+    bounds = np.asarray(offsets).tolist()
+    return [ids[start:end].tolist() for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+class SpaceSavingCounter:
+    """
+    Approximate word counts in bounded memory (space-saving top-K).
+    
+    At most `capacity` words are tracked. When the table overflows, the
+    least frequent words are evicted, and `error` becomes the largest
+    count evicted so far. A word that (re)appears later starts from
+    `error`, so every reported count is an upper bound that exceeds the
+    true count by at most `error`, and every word whose true count is
+    above `error` is still in the table.
+    """
+    
+    def __init__(self, capacity: int):
+        self.capacity = max(1, int(capacity))
+        self.counts = Counter()
+        self.error = 0
+    
+    def update(self, counts: Dict[str, int]) -> None:
+        table = self.counts
+        error = self.error
+        for word, count in counts.items():
+            table[word] = table.get(word, error) + count
+        # Prune to capacity only once the table has doubled, so eviction is amortized
+        if len(table) > 2 * self.capacity:
+            self._prune()
+    
+    def most_common(self, n: Optional[int] = None) -> List[Tuple[str, int]]:
+        if len(self.counts) > self.capacity:
+            self._prune()
+        return self.counts.most_common(n)
+    
+    def _prune(self):
+        keep = heapq.nlargest(self.capacity, self.counts.values())
+        threshold = keep[-1]
+        # Ties at the threshold are evicted in insertion order after the strictly larger words
+        room = self.capacity - sum(1 for c in keep if c > threshold)
+        kept = Counter()
+        for word, count in self.counts.items():
+            if count > threshold:
+                kept[word] = count
+            elif count == threshold and room > 0:
+                kept[word] = count
+                room -= 1
+            else:
+                self.error = max(self.error, count)
+        self.counts = kept
+
 
 class Tokenizer:
     """
@@ -33,6 +132,8 @@ class Tokenizer:
         self.remove_punctuation = remove_punctuation
         self.vocab = {}
         self.vocab_size = 0
+        self._id_to_token = None
+        self._id_to_token_array = None
         
     def preprocess_text(self, text: str) -> str:
         """
@@ -49,10 +150,10 @@ class Tokenizer:
             
         if self.remove_punctuation:
             # Remove punctuation but keep apostrophes for contractions
-            text = re.sub(r'[^\w\s\']', '', text)
+            text = _PUNCTUATION_RE.sub('', text)
             
         # Normalize whitespace
-        text = re.sub(r'\s+', ' ', text).strip()
+        text = _WHITESPACE_RE.sub(' ', text).strip()
         
         return text
     
@@ -66,36 +167,138 @@ class Tokenizer:
         Returns:
             List of tokens (words)
         """
-        text = self.preprocess_text(text)
-        tokens = text.split()
-        return tokens
+        if self.lowercase:
+            text = text.lower()
+        if self.remove_punctuation:
+            text = _PUNCTUATION_RE.sub('', text)
+        # split() already collapses and strips whitespace like preprocess_text does
+        return text.split()
+    
+    def count_words(self, texts: Iterable[str]) -> Counter:
+        """
+        Count the tokens of `texts` in one process.
+        
+        Args:
+            texts: Input text strings
+            
+        Returns:
+            Counter of tokens, in order of first occurrence
+        """
+        counts = Counter()
+        for chunk in _iter_chunks(texts, 4096):
+            counts.update(chain.from_iterable(self._tokenize_batch(chunk)))
+        return counts
     
-    def build_vocab(self, texts: List[str], min_freq: int = 1) -> Dict[str, int]:
+    def build_vocab(self, texts: Union[str, os.PathLike, Iterable[str]], min_freq: int = 1,
+                    max_vocab_size: Optional[int] = None, workers: int = 1,
+                    approximate: bool = False, capacity: int = 1_000_000,
+                    chunk_size: int = 10_000) -> Dict[str, int]:
         """
         Build vocabulary from a list of texts.
         
+        The texts are streamed in chunks of `chunk_size`, so neither the
+        corpus nor (with approximate=True) its full word list has to fit in
+        memory. With several workers, chunks are counted in a process pool
+        and the per-chunk counters are merged in input order, which gives
+        exactly the vocabulary of a single-process run.
+        
         Args:
-            texts: List of text strings
+            texts: Any iterable of text strings, or the path of a UTF-8 file
+                with one text per line
             min_freq: Minimum frequency for a word to be included in vocabulary
+            max_vocab_size: Keep at most this many of the most frequent words
+            workers: Counting processes; 1 counts in this process, 0 uses every core
+            approximate: Count with a SpaceSavingCounter of `capacity` words
+                instead of an exact Counter; counts become upper bounds
+            capacity: Words tracked in approximate mode
+            chunk_size: Texts per chunk sent to a worker
             
         Returns:
             Dictionary mapping words to their indices
         """
-        word_counts = Counter()
+        word_counts = SpaceSavingCounter(capacity) if approximate else Counter()
+        workers = workers or os.cpu_count() or 1
+        chunks = _iter_chunks(texts, chunk_size)
         
-        for text in texts:
-            tokens = self.tokenize(text)
-            word_counts.update(tokens)
+        if workers == 1:
+            for chunk in chunks:
+                word_counts.update(self.count_words(chunk))
+        else:
+            with mp.Pool(workers, initializer=_init_count_worker,
+                         initargs=(self.lowercase, self.remove_punctuation)) as pool:
+                # Bounded window of chunks in flight, merged in input order
+                pending = deque()
+                for chunk in chunks:
+                    pending.append(pool.apply_async(_count_chunk, (chunk,)))
+                    if len(pending) >= 2 * workers:
+                        word_counts.update(pending.popleft().get())
+                while pending:
+                    word_counts.update(pending.popleft().get())
         
-        # Filter by minimum frequency
-        vocab = {word: idx for idx, (word, count) in enumerate(word_counts.most_common()) 
-                if count >= min_freq}
+        # Filter by minimum frequency (most_common keeps first-seen order among ties)
+        ranked = (word for word, count in word_counts.most_common(max_vocab_size) if count >= min_freq)
+        vocab = {word: idx for idx, word in enumerate(ranked)}
         
-        self.vocab = vocab
-        self.vocab_size = len(vocab)
+        self._set_vocab(vocab)
+        return vocab
+    
+    def save_vocab(self, path: str) -> None:
+        """
+        Save the vocabulary: a JSON header line, then one word per line in id order.
+        
+        Words never contain whitespace (tokenize splits on it), so loading is a
+        single read and split.
+        
+        Args:
+            path: Output file path
+        """
+        words = self._reverse_vocab()
+        header = {
+            'format': VOCAB_FORMAT,
+            'size': len(words),
+            'lowercase': self.lowercase,
+            'remove_punctuation': self.remove_punctuation,
+        }
+        tmp = f"{path}.tmp"
+        with open(tmp, 'w', encoding='utf-8', newline='\n') as f:
+            f.write(json.dumps(header) + '\n')
+            f.write('\n'.join(words))
+        os.replace(tmp, path)
+    
+    def load_vocab(self, path: str) -> Dict[str, int]:
+        """
+        Load a vocabulary written by save_vocab.
+        
+        The file's lowercase / remove_punctuation settings replace this
+        tokenizer's, since the vocabulary was built with them.
+        
+        Args:
+            path: Vocabulary file path
+            
+        Returns:
+            Dictionary mapping words to their indices
+        """
+        with open(path, 'r', encoding='utf-8', newline='\n') as f:
+            header = json.loads(f.readline())
+            body = f.read()
+        if header.get('format') != VOCAB_FORMAT:
+            raise ValueError(f"{path} is not a {VOCAB_FORMAT} vocabulary file")
+        words = body.split('\n') if header['size'] else []
+        if len(words) != header['size']:
+            raise ValueError(f"{path} holds {len(words)} words, header says {header['size']}")
         
+        self.lowercase = header['lowercase']
+        self.remove_punctuation = header['remove_punctuation']
+        vocab = dict(zip(words, range(len(words))))
+        self._set_vocab(vocab)
         return vocab
     
+    def _set_vocab(self, vocab: Dict[str, int]) -> None:
+        self.vocab = vocab
+        self.vocab_size = len(vocab)
+        self._id_to_token = None
+        self._id_to_token_array = None
+    
     def encode(self, text: str) -> List[int]:
         """
         Encode text to token indices.
@@ -120,11 +323,111 @@ class Tokenizer:
         Returns:
             Decoded text string
         """
-        # Create reverse mapping
-        reverse_vocab = {idx: word for word, idx in self.vocab.items()}
-        tokens = [reverse_vocab.get(idx, '<UNK>') for idx in indices]
+        id_to_token = self._reverse_vocab()
+        size = len(id_to_token)
+        tokens = [id_to_token[idx] if 0 <= idx < size else UNK_TOKEN for idx in indices]
         return ' '.join(tokens)
     
+    def encode_batch(self, texts: Sequence[str], flat: bool = False, pad_id: int = 0,
+                     dtype=np.int32) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Encode many texts at once.
+        
+        The batch is lowercased and stripped of punctuation as one string
+        (two C-level passes instead of two per text), and all token lookups
+        go through a single np.fromiter.
+        
+        Args:
+            texts: Input text strings
+            flat: Return the ids of all texts back to back instead of padded rows
+            pad_id: Fill value for the padded positions
+            dtype: Integer dtype of the ids
+            
+        Returns:
+            (ids, lengths) with ids of shape (len(texts), longest), or with
+            flat=True, (ids, offsets) where text i is ids[offsets[i]:offsets[i + 1]]
+        """
+        token_lists = self._tokenize_batch(texts)
+        lengths = np.fromiter(map(len, token_lists), dtype=np.int64, count=len(token_lists))
+        ids = np.fromiter(map(self.vocab.get, chain.from_iterable(token_lists), repeat(0)),
+                          dtype=dtype, count=int(lengths.sum()))  # 0 for unknown tokens, as in encode
+        
+        if flat:
+            offsets = np.zeros(len(token_lists) + 1, dtype=np.int64)
+            np.cumsum(lengths, out=offsets[1:])
+            return ids, offsets
+        
+        width = int(lengths.max()) if len(lengths) else 0
+        padded = np.full((len(token_lists), width), pad_id, dtype=dtype)
+        padded[np.arange(width) < lengths[:, None]] = ids
+        return padded, lengths
+    
+    def decode_batch(self, ids, lengths: Optional[Sequence[int]] = None,
+                     offsets: Optional[Sequence[int]] = None) -> List[str]:
+        """
+        Decode many id sequences at once.
+        
+        Args:
+            ids: Padded 2-D array (with lengths), flat 1-D array (with offsets)
+                or a list of id lists
+            lengths: Number of real tokens in each row of a padded array
+            offsets: Start of every sequence in a flat array, plus the end
+            
+        Returns:
+            List of decoded text strings
+        """
+        if offsets is not None:
+            flat = np.asarray(ids)
+            offsets = np.asarray(offsets, dtype=np.int64)
+        else:
+            if lengths is None:
+                if isinstance(ids, np.ndarray) and ids.ndim == 2:
+                    lengths = np.full(len(ids), ids.shape[1], dtype=np.int64)
+                else:
+                    ids = [np.asarray(row) for row in ids]
+                    lengths = [len(row) for row in ids]
+            lengths = np.asarray(lengths, dtype=np.int64)
+            offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+            np.cumsum(lengths, out=offsets[1:])
+            if isinstance(ids, np.ndarray) and ids.ndim == 2:
+                flat = ids[np.arange(ids.shape[1]) < lengths[:, None]]
+            else:
+                flat = np.concatenate(ids) if len(ids) else np.zeros(0, dtype=np.int64)
+        
+        id_to_token = self._reverse_vocab_array()
+        unk = len(id_to_token) - 1
+        flat = flat.astype(np.int64, copy=False)
+        words = id_to_token[np.where((flat >= 0) & (flat < unk), flat, unk)].tolist()
+        bounds = offsets.tolist()
+        return [' '.join(words[start:end]) for start, end in zip(bounds[:-1], bounds[1:])]
+    
+    def _tokenize_batch(self, texts: Sequence[str]) -> List[List[str]]:
+        texts = [str(text) for text in texts]
+        joined = _BATCH_SEP.join(texts)
+        if joined.count(_BATCH_SEP) != max(0, len(texts) - 1):
+            # A text contains the separator itself; fall back to one text at a time
+            return [self.tokenize(text) for text in texts]
+        if self.lowercase:
+            joined = joined.lower()
+        if self.remove_punctuation:
+            joined = _BATCH_PUNCTUATION_RE.sub('', joined)
+        return [part.split() for part in joined.split(_BATCH_SEP)] if texts else []
+    
+    def _reverse_vocab(self) -> List[str]:
+        # id -> token, rebuilt only after the vocabulary changes
+        if self._id_to_token is None:
+            id_to_token = [UNK_TOKEN] * (max(self.vocab.values()) + 1 if self.vocab else 0)
+            for word, idx in self.vocab.items():
+                id_to_token[idx] = word
+            self._id_to_token = id_to_token
+        return self._id_to_token
+    
+    def _reverse_vocab_array(self) -> np.ndarray:
+        # The same table as an object array, with UNK_TOKEN appended for out-of-range ids
+        if self._id_to_token_array is None:
+            self._id_to_token_array = np.array(self._reverse_vocab() + [UNK_TOKEN], dtype=object)
+        return self._id_to_token_array
+    
     def get_stats(self) -> Dict[str, Any]:
         """
         Get tokenizer statistics.
@@ -217,7 +520,61 @@ class SentencePieceTokenizer:
             Decoded text string
         """
         return self.sp.decode(tokens)
-    
+
+    def encode_batch(self, texts: Sequence[str], num_threads: Optional[int] = None,
+                     dtype=np.int32, out: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Encode many texts with SentencePiece's multi-threaded batch encoder.
+
+        Each text comes back from SentencePiece as an int32 array (no Python
+        int per token), and the rows are concatenated into one flat buffer.
+
+        Args:
+            texts: Input text strings
+            num_threads: Encoder threads (default: every core)
+            dtype: Integer dtype of the flat buffer (e.g. np.uint16 for small vocabularies)
+            out: Preallocated 1-D buffer to write into instead (an np.memmap works);
+                it must hold at least the total number of tokens
+
+        Returns:
+            (ids, offsets): text i is ids[offsets[i]:offsets[i + 1]]; with `out`,
+            ids is the filled leading view of it
+        """
+        rows = self.sp.encode(list(texts), out_type='numpy', num_threads=num_threads or os.cpu_count() or 1)
+        offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(np.fromiter(map(len, rows), dtype=np.int64, count=len(rows)), out=offsets[1:])
+        total = int(offsets[-1])
+
+        if out is None:
+            out = np.empty(total, dtype=dtype)
+        elif out.ndim != 1 or len(out) < total:
+            raise ValueError(f"out buffer of shape {out.shape} cannot hold {total} tokens")
+        ids = out[:total]
+        if rows:
+            np.concatenate(rows, out=ids, casting='unsafe')
+        return ids, offsets
+
+    def decode_batch(self, ids: np.ndarray, offsets: Sequence[int],
+                     num_threads: Optional[int] = None) -> List[str]:
+        """
+        Decode a flat id buffer (as returned by encode_batch) with SentencePiece's batch decoder.
+
+        Args:
+            ids: Flat array of token ids
+            offsets: Start of every sequence in ids, plus the end
+            num_threads: Decoder threads (default: every core)
+
+        Returns:
+            List of decoded text strings
+        """
+        # SentencePiece reads 32/64-bit buffers directly; one cast covers the whole batch
+        flat = np.asarray(ids).astype(np.int32, copy=False)
+        offsets = np.asarray(offsets, dtype=np.int64)
+        rows = np.split(flat[offsets[0]:offsets[-1]], offsets[1:-1] - offsets[0]) if len(offsets) > 1 else []
+        if not rows:
+            return []
+        return self.sp.decode(rows, num_threads=num_threads or os.cpu_count() or 1)
+
     def get_vocab_size(self) -> int:
         """
         Get the vocabulary size.
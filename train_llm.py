@@ -1,22 +1,50 @@
 # train_llm.py
-import numpy as np
+"""
+Train MiniLLM on the windows of a binary token file.
+
+Shuffled mini-batches come from a DataLoader whose workers each map the
+token file themselves; gradients can be accumulated over several batches
+before every optimizer step.
+
+Launched with torchrun, every process trains a DistributedDataParallel
+replica on its own shard of the windows (gloo backend, so it runs on CPU
+boxes) and only rank 0 logs and saves the model.
+
+--precision bf16 runs the forward pass under CPU/CUDA bf16 autocast and
+--compile runs it through torch.compile; either falls back to fp32 eager
+if it does not work on this machine.
+
+Checkpoints (model, optimizer, counters, RNG states and the position in the
+epoch) are written every --checkpoint-every steps and at every epoch end;
+--resume continues from the newest one exactly where it stopped.
+--no-checkpoints skips them, e.g. for throughput benchmarks.
+
+Usage:
+    python train_llm.py --batch-size 64 --workers 2 --epochs 20
+    torchrun --standalone --nproc_per_node 4 train_llm.py --workers 1
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import time
+
 import torch
+import torch.distributed as dist
 import torch.nn as nn
 import torch.optim as optim
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader, Dataset, Sampler
 
-# Load data
-inputs = np.load("training_inputs.npy")
-targets = np.load("training_targets.npy")
-
-# Convert to tensors
-x = torch.tensor(inputs, dtype=torch.long)
-y = torch.tensor(targets, dtype=torch.long)
+from checkpoint import CheckpointWriter, latest_checkpoint, load_checkpoint, rng_state, set_rng_state
+from load_encoded_data import TokenWindowDataset
 
 # Hyperparameters
 vocab_size = 100  # Same as sentencepiece vocab size
 embedding_dim = 64
 hidden_dim = 128
-context_length = x.shape[1]
+context_length = 8
 
 # Model definition
 class MiniLLM(nn.Module):
@@ -32,21 +60,321 @@ class MiniLLM(nn.Module):
         out = self.fc(out[:, -1, :])
         return out
 
-model = MiniLLM()
-loss_fn = nn.CrossEntropyLoss()
-optimizer = optim.Adam(model.parameters(), lr=0.001)
+    def step(self, x, state=None):
+        """
+        Run tokens `x` (batch, time) on from an LSTM `state`, for incremental
+        decoding. Returns logits for every position and the new state.
+        """
+        out, state = self.lstm(self.embed(x), state)
+        return self.fc(out), state
+
+
+class WindowBatchDataset(Dataset):
+    """
+    DataLoader view of a TokenWindowDataset.
+
+    The token file is mapped lazily, so each worker process opens its own
+    map instead of receiving a pickled copy. `__getitems__` gathers a whole
+    batch of windows in one vectorized read.
+    """
+
+    def __init__(self, path, context_length=8):
+        self.path = path
+        self.context_length = context_length
+        self._windows = None
+        self._len = len(self.windows)
+
+    @property
+    def windows(self):
+        if self._windows is None:
+            self._windows = TokenWindowDataset(self.path, self.context_length)
+        return self._windows
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_windows"] = None
+        return state
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, i):
+        inputs, targets = self.windows.get_batch([i])
+        return torch.from_numpy(inputs[0]), torch.tensor(targets[0])
+
+    def __getitems__(self, indices):
+        inputs, targets = self.windows.get_batch(indices)
+        return torch.from_numpy(inputs), torch.from_numpy(targets)
+
+
+class ShuffledBatches(Sampler):
+    """
+    Batches of window indices, reshuffled every epoch from (seed, epoch).
+
+    Each rank takes every world_size-th index of the shared permutation
+    (padded by wrapping so every rank gets the same number of batches).
+    Because an epoch's order depends only on the seed and epoch,
+    `set_epoch(epoch, start_batch)` can resume in the middle of an epoch.
+    """
+
+    def __init__(self, num_windows, batch_size, seed=0, rank=0, world_size=1):
+        self.num_windows = num_windows
+        self.batch_size = batch_size
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.per_rank = -(-num_windows // world_size)
+        self.epoch = 0
+        self.start_batch = 0
+
+    def set_epoch(self, epoch, start_batch=0):
+        self.epoch = epoch
+        self.start_batch = start_batch
+
+    def __len__(self):
+        return -(-self.per_rank // self.batch_size)
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        order = torch.randperm(self.num_windows, generator=generator)
+        padded = self.per_rank * self.world_size
+        if padded > self.num_windows:
+            order = torch.cat([order, order[:padded - self.num_windows]])
+        mine = order[self.rank::self.world_size].tolist()
+        for b in range(self.start_batch, len(self)):
+            yield mine[b * self.batch_size:(b + 1) * self.batch_size]
+
+
+def autocast(precision, device):
+    """Autocast context for the forward pass ("fp32" runs without one)."""
+    if precision == "bf16":
+        return torch.autocast(device_type=device.type, dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+
+def training_forward(model, loss_fn, precision, compile_model, sample, device):
+    """
+    Choose how the training step runs `model`: optionally under bf16
+    autocast and/or through torch.compile. Each option is tried on a probe
+    batch (forward and backward, gradients discarded) and dropped with a
+    warning if it fails here.
+
+    Returns:
+        (callable for the forward pass, precision actually used)
+    """
+    x, y = (t.to(device) for t in sample)
+
+    def probe(forward, precision):
+        try:
+            with autocast(precision, device):
+                loss = loss_fn(forward(x), y)
+            loss.backward()
+            return True
+        except Exception as e:
+            print(f"⚠️ {precision}{' + compile' if forward is not model else ''} training "
+                  f"is not supported here: {type(e).__name__}: {e}")
+            return False
+        finally:
+            model.zero_grad(set_to_none=True)
+
+    if precision != "fp32" and not probe(model, precision):
+        precision = "fp32"
+    forward = model
+    if compile_model:
+        compiled = torch.compile(model)
+        if probe(compiled, precision):
+            forward = compiled
+    return forward, precision
+
+
+def _keep_batch(batch):
+    # __getitems__ already returns collated tensors
+    return batch
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Train MiniLLM on a binary token file")
+    parser.add_argument("--data", default="encoded_data.bin", help="token file written by preprocess.py")
+    parser.add_argument("--output", default="mini_llm.pth")
+    parser.add_argument("--epochs", type=int, default=20)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--accum-steps", type=int, default=1, help="batches per optimizer step")
+    parser.add_argument("--lr", type=float, default=0.001)
+    parser.add_argument("--workers", type=int, default=2, help="DataLoader worker processes")
+    parser.add_argument("--prefetch", type=int, default=4, help="batches prefetched per worker")
+    parser.add_argument("--threads", type=int, default=0, help="torch intra-op threads (0 = torch default)")
+    parser.add_argument("--log-every", type=int, default=50, help="optimizer steps between log lines")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--precision", choices=["fp32", "bf16"], default="fp32",
+                        help="bf16 runs forward and loss under autocast (falls back to fp32 if unsupported)")
+    parser.add_argument("--compile", action="store_true", help="torch.compile the model (falls back to eager)")
+    parser.add_argument("--max-steps", type=int, default=0, help="stop after this many optimizer steps (0 = no limit)")
+    parser.add_argument("--summary-json", default="", help="rank 0 writes a throughput summary here")
+    parser.add_argument("--checkpoint-dir", default="checkpoints")
+    parser.add_argument("--checkpoint-every", type=int, default=0,
+                        help="optimizer steps between checkpoints (0 = once per epoch)")
+    parser.add_argument("--keep-last", type=int, default=3, help="checkpoints to keep")
+    parser.add_argument("--no-checkpoints", action="store_true", help="never write checkpoints")
+    parser.add_argument("--resume", nargs="?", const="latest", default=None,
+                        help="continue from a checkpoint file, or the newest one in --checkpoint-dir")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    # torchrun sets WORLD_SIZE / RANK / LOCAL_WORLD_SIZE for every process it starts
+    world_size = int(os.environ.get("WORLD_SIZE", "1"))
+    distributed = world_size > 1
+    if distributed:
+        dist.init_process_group("gloo")
+    rank = dist.get_rank() if distributed else 0
+    log = print if rank == 0 else (lambda *a, **k: None)
+
+    threads = args.threads
+    if threads <= 0 and distributed:
+        # Split the cores between the local processes instead of oversubscribing them
+        threads = max(1, (os.cpu_count() or 1) // int(os.environ.get("LOCAL_WORLD_SIZE", world_size)))
+    if threads > 0:
+        torch.set_num_threads(threads)
+    torch.manual_seed(args.seed)
+    device = torch.device("cuda" if torch.cuda.is_available() and not distributed else "cpu")
+
+    dataset = WindowBatchDataset(args.data, context_length)
+    batches = ShuffledBatches(len(dataset), args.batch_size, seed=args.seed, rank=rank, world_size=world_size)
+    loader = DataLoader(
+        dataset,
+        batch_sampler=batches,
+        num_workers=args.workers,
+        collate_fn=_keep_batch,
+        pin_memory=device.type == "cuda",
+        prefetch_factor=args.prefetch if args.workers > 0 else None,
+        persistent_workers=args.workers > 0,
+    )
+    log(f"📚 {len(dataset)} training windows, {len(loader)} batches per epoch per rank, {world_size} ranks, "
+        f"{args.workers} loader workers, {torch.get_num_threads()} torch threads")
+
+    model = MiniLLM().to(device)
+    if distributed:
+        model = DistributedDataParallel(model)
+    plain_model = model.module if distributed else model
+    loss_fn = nn.CrossEntropyLoss()
+    forward, precision = training_forward(
+        model, loss_fn, args.precision, args.compile,
+        dataset.__getitems__(list(range(min(args.batch_size, len(dataset))))), device,
+    )
+    log(f"🧮 Precision {precision}, {'compiled' if forward is not model else 'eager'}")
+    optimizer = optim.Adam(model.parameters(), lr=args.lr)
+    accum = max(1, args.accum_steps)
+    # Resuming is only exact if the data order and step boundaries are unchanged
+    run_config = {"seed": args.seed, "batch_size": args.batch_size, "accum_steps": accum,
+                  "world_size": world_size, "num_windows": len(dataset)}
+
+    start_epoch, start_batch, step = 0, 0, 0
+    epoch_loss, epoch_batches = 0.0, 0
+    if args.resume:
+        path = latest_checkpoint(args.checkpoint_dir) if args.resume == "latest" else args.resume
+        if path is None:
+            raise FileNotFoundError(f"no checkpoint to resume from in {args.checkpoint_dir}")
+        ckpt = load_checkpoint(path)
+        if ckpt["config"] != run_config:
+            raise ValueError(f"{path} was written with {ckpt['config']}, this run uses {run_config}")
+        plain_model.load_state_dict(ckpt["model"])
+        optimizer.load_state_dict(ckpt["optimizer"])
+        set_rng_state(ckpt["rng"])
+        start_epoch, start_batch, step = ckpt["epoch"], ckpt["batch"], ckpt["step"]
+        epoch_loss, epoch_batches = ckpt["epoch_loss"], ckpt["epoch_batches"]
+        log(f"♻️ Resumed from {path}: epoch {start_epoch + 1}, batch {start_batch}, step {step}")
+
+    writer = None
+    if rank == 0 and not args.no_checkpoints:
+        writer = CheckpointWriter(args.checkpoint_dir, keep_last=args.keep_last)
+
+    def checkpoint(epoch, batch):
+        # Rank 0 snapshots the state; the write happens on the writer thread
+        if writer is None:
+            return
+        writer.save({
+            "model": plain_model.state_dict(),
+            "optimizer": optimizer.state_dict(),
+            "epoch": epoch,
+            "batch": batch,
+            "step": step,
+            "epoch_loss": epoch_loss,
+            "epoch_batches": epoch_batches,
+            "rng": rng_state(),
+            "config": run_config,
+        }, step)
+
+    total_tokens, train_start = 0, time.perf_counter()
+    done = False
+    for epoch in range(start_epoch, args.epochs):
+        first = start_batch if epoch == start_epoch else 0
+        batches.set_epoch(epoch, first)
+        model.train()
+        interval_tokens, interval_steps, interval_start = 0, 0, time.perf_counter()
+        optimizer.zero_grad()
+
+        for i, (x, y) in enumerate(loader, start=first):
+            x = x.to(device, non_blocking=True)
+            y = y.to(device, non_blocking=True)
+            stepping = (i + 1) % accum == 0 or i + 1 == len(loader)
+            # Only the last micro-batch of an accumulation window all-reduces gradients
+            sync = model.no_sync() if distributed and not stepping else contextlib.nullcontext()
+            with sync:
+                with autocast(precision, device):
+                    loss = loss_fn(forward(x), y)
+                (loss / accum).backward()
+            epoch_loss += loss.item()
+            epoch_batches += 1
+            interval_tokens += x.numel() * world_size
+            total_tokens += x.numel() * world_size
+
+            if not stepping:
+                continue
+            optimizer.step()
+            optimizer.zero_grad()
+            step += 1
+            interval_steps += 1
+
+            if step % args.log_every == 0:
+                elapsed = time.perf_counter() - interval_start
+                log(f"  step {step}: loss {loss.item():.4f}, "
+                    f"{interval_tokens / elapsed:.0f} tok/s, {1000 * elapsed / interval_steps:.1f} ms/step")
+                interval_tokens, interval_steps, interval_start = 0, 0, time.perf_counter()
+            if args.max_steps and step >= args.max_steps:
+                done = True
+                checkpoint(epoch, i + 1)
+                break
+            if args.checkpoint_every and step % args.checkpoint_every == 0 and i + 1 < len(loader):
+                checkpoint(epoch, i + 1)
+
+        log(f"Epoch {epoch+1}/{args.epochs}, Loss: {epoch_loss / max(1, epoch_batches):.4f}")
+        if done:
+            break
+        epoch_loss, epoch_batches = 0.0, 0
+        checkpoint(epoch + 1, 0)
+
+    elapsed = time.perf_counter() - train_start
+    if rank == 0:
+        if writer is not None:
+            writer.close()
+        if args.summary_json:
+            with open(args.summary_json, "w") as f:
+                json.dump({
+                    "world_size": world_size,
+                    "steps": step,
+                    "tokens": total_tokens,
+                    "seconds": elapsed,
+                    "tokens_per_sec": total_tokens / elapsed if elapsed else 0.0,
+                }, f)
+        # Save model (unwrapped, so the checkpoint loads into a plain MiniLLM)
+        torch.save(plain_model.state_dict(), args.output)
+        print(f"Model trained and saved as {args.output}")
 
-# Training
-epochs = 20
-for epoch in range(epochs):
-    optimizer.zero_grad()
-    logits = model(x)
-    loss = loss_fn(logits, y)
-    loss.backward()
-    optimizer.step()
-    print(f"Epoch {epoch+1}/{epochs}, Loss: {loss.item():.4f}")
+    if distributed:
+        dist.destroy_process_group()
 
-# Save model
-torch.save(model.state_dict(), "mini_llm.pth")
-print("Model trained and saved as mini_llm.pth")
 
+if __name__ == "__main__":
+    main()
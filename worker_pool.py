@@ -0,0 +1,299 @@
+"""
+Pre-forked model worker pool.
+
+The parent loads the weights once and moves them into shared memory, then
+forks workers that each own a disjoint set of cores, their own torch thread
+count and their own decode loops. A dispatcher in the parent routes every
+request to the least-loaded worker and relays results back over a queue.
+"""
+
+import asyncio
+import itertools
+import multiprocessing as mp
+import os
+import queue
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+import torch
+
+from metrics import REGISTRY
+from streaming import TokenStream
+
+
+def split_cores(num_workers: int) -> List[List[int]]:
+    """Partition the cores this process may run on into `num_workers` disjoint sets."""
+    if hasattr(os, "sched_getaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count() or 1))
+    if len(cores) < num_workers:
+        # Not enough cores to go round: workers share them one each
+        return [[cores[i % len(cores)]] for i in range(num_workers)]
+    per_worker, extra = divmod(len(cores), num_workers)
+    sets, start = [], 0
+    for i in range(num_workers):
+        size = per_worker + (1 if i < extra else 0)
+        sets.append(cores[start:start + size])
+        start += size
+    return sets
+
+
+def _serve(backends, kind: str, args: tuple, stream: bool, emit: Callable[[Any], None],
+           cancelled: Callable[[], bool]):
+    """Run one request against a worker's (local, hf) backends and return its final result."""
+    local, hf = backends
+    if kind == "stats":
+        cache = local.prefix_cache
+        return {
+            "pid": os.getpid(),
+            "prefix_cache": cache.stats() if cache is not None else None,
+            "speculative": hf.stats() if hasattr(hf, "stats") else None,
+        }
+    if kind == "metrics":
+        # Gauge callbacks belong to the parent; only this worker's own counts are sent back
+        return REGISTRY.snapshot(collect=False)
+
+    if kind == "local":
+        if not stream:
+            return local.generate(*args)
+        tokens = local.stream(*args)
+        generated = []
+        for token in tokens:
+            generated.append(token)
+            emit(token)
+            if cancelled():
+                tokens.cancel()
+        return generated
+
+    if kind == "hf":
+        if hf is None:
+            raise RuntimeError("HF backend is not enabled")
+        if not hasattr(hf, "submit"):
+            # Plain HFTextGen: one model.generate call per request
+            if not stream:
+                return hf.generate_once(*args)
+            for piece in hf.stream(*args):
+                emit(piece)
+            return None
+        req = hf.submit(*args, stream=stream)
+        if stream:
+            for piece in req.stream:
+                emit(piece)
+                if cancelled():
+                    req.stream.cancel()
+        return req.future.result()
+
+    raise ValueError(f"unknown request kind: {kind}")
+
+
+def _worker_main(index: int, cores: Sequence[int], build_backends: Callable, requests, responses):
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+    backends = build_backends()
+
+    cancelled = set()
+
+    def handle(rid, kind, args, stream):
+        def emit(item):
+            responses.put(("item", rid, item))
+        try:
+            result = _serve(backends, kind, args, stream, emit, lambda: rid in cancelled)
+            responses.put(("done", rid, result))
+        except Exception as e:
+            responses.put(("error", rid, f"{type(e).__name__}: {e}"))
+        finally:
+            cancelled.discard(rid)
+
+    while True:
+        msg = requests.get()
+        if msg is None:
+            return
+        if msg[0] == "cancel":
+            cancelled.add(msg[1])
+            continue
+        _, rid, kind, args, stream = msg
+        threading.Thread(target=handle, args=(rid, kind, args, stream), daemon=True).start()
+
+
+class PoolRequest:
+    """Parent-side handle: `future` gets the final result, `stream` the streamed items."""
+
+    def __init__(self, worker: int, stream: Optional[TokenStream]):
+        self.worker = worker
+        self.stream = stream
+        self.future: Future = Future()
+        self.cancel_sent = False
+
+
+class WorkerPool:
+    """
+    Forks `num_workers` processes that serve requests with their own backends.
+
+    `build_backends()` is called inside each worker after the fork and must
+    return a `(LocalBatcher, hf_backend_or_None)` pair. Modules passed in
+    `shared_modules` are moved to shared memory first so every worker maps
+    the same weights instead of holding a private copy.
+    """
+
+    def __init__(self, num_workers: int, build_backends: Callable, shared_modules: Sequence[torch.nn.Module] = ()):
+        for module in shared_modules:
+            if module is not None:
+                module.share_memory()
+
+        ctx = mp.get_context("fork")
+        self.cores = split_cores(num_workers)
+        self._responses = ctx.Queue()
+        self._requests = []
+        self._procs = []
+        for i, cores in enumerate(self.cores):
+            requests = ctx.Queue()
+            proc = ctx.Process(
+                target=_worker_main,
+                args=(i, cores, build_backends, requests, self._responses),
+                name=f"model-worker-{i}",
+                daemon=True,
+            )
+            proc.start()
+            self._requests.append(requests)
+            self._procs.append(proc)
+
+        self._ids = itertools.count()
+        self._pending: Dict[int, PoolRequest] = {}
+        self._load = [0] * len(self._procs)
+        self._lock = threading.Lock()
+        self._reader = threading.Thread(target=self._read_responses, name="worker-pool-reader", daemon=True)
+        self._reader.start()
+
+    def call(self, kind: str, args: tuple = (), stream: bool = False, worker: Optional[int] = None,
+             loop=None) -> PoolRequest:
+        """Send a request to the least-loaded worker (or to `worker`)."""
+        with self._lock:
+            if worker is None:
+                worker = min(range(len(self._load)), key=self._load.__getitem__)
+            rid = next(self._ids)
+            req = PoolRequest(worker, TokenStream(loop) if stream else None)
+            self._pending[rid] = req
+            self._load[worker] += 1
+        self._requests[worker].put(("run", rid, kind, args, stream))
+        return req
+
+    async def worker_stats(self, timeout: float = 1.0) -> List[Dict[str, Any]]:
+        """Ask every worker for its cache counters (awaitable, so /health never blocks a thread)."""
+        stats = []
+        for i, req in enumerate([self.call("stats", worker=i) for i in range(len(self._procs))]):
+            try:
+                worker = await asyncio.wait_for(asyncio.wrap_future(req.future), timeout)
+            except Exception as e:
+                worker = {"error": str(e) or type(e).__name__}
+            worker.update({"worker": i, "cores": self.cores[i], "in_flight": self._load[i]})
+            stats.append(worker)
+        return stats
+
+    async def worker_metrics(self, timeout: float = 1.0) -> List[Dict[str, Any]]:
+        """Every worker's metrics snapshot, for merging into the parent's /metrics output."""
+        snapshots = []
+        for req in [self.call("metrics", worker=i) for i in range(len(self._procs))]:
+            try:
+                snapshots.append(await asyncio.wait_for(asyncio.wrap_future(req.future), timeout))
+            except Exception as e:
+                print(f"⚠️ Worker metrics unavailable: {e}")
+        return snapshots
+
+    def _finish(self, rid: int) -> Optional[PoolRequest]:
+        with self._lock:
+            req = self._pending.pop(rid, None)
+            if req is not None:
+                self._load[req.worker] -= 1
+            return req
+
+    def _fail_dead_workers(self):
+        for i, proc in enumerate(self._procs):
+            if proc.is_alive():
+                continue
+            with self._lock:
+                dead = [rid for rid, req in self._pending.items() if req.worker == i]
+            for rid in dead:
+                req = self._finish(rid)
+                error = RuntimeError(f"model worker {i} exited with code {proc.exitcode}")
+                if req.stream is not None:
+                    req.stream.close(error)
+                req.future.set_exception(error)
+
+    def _read_responses(self):
+        while True:
+            try:
+                status, rid, payload = self._responses.get(timeout=1.0)
+            except queue.Empty:
+                self._fail_dead_workers()
+                continue
+
+            if status == "item":
+                req = self._pending.get(rid)
+                if req is None:
+                    continue
+                req.stream.put(payload)
+                if req.stream.cancelled and not req.cancel_sent:
+                    req.cancel_sent = True
+                    self._requests[req.worker].put(("cancel", rid))
+                continue
+
+            req = self._finish(rid)
+            if req is None:
+                continue
+            if status == "done":
+                if req.stream is not None:
+                    req.stream.close()
+                req.future.set_result(payload)
+            else:
+                error = RuntimeError(payload)
+                if req.stream is not None:
+                    req.stream.close(error)
+                req.future.set_exception(error)
+
+
+class PooledLocalBatcher:
+    """LocalBatcher interface served by the worker pool."""
+
+    prefix_cache = None
+
+    def __init__(self, pool: WorkerPool):
+        self.pool = pool
+
+    def submit(self, input_ids, max_tokens, temperature, top_k, top_p=1.0, repetition_penalty=1.0,
+               seed=None, worker=None) -> Future:
+        """`worker` pins the request to one process, e.g. to keep a bucket in one decode batch."""
+        args = (list(input_ids), max_tokens, temperature, top_k, top_p, repetition_penalty, seed)
+        return self.pool.call("local", args, worker=worker).future
+
+    def generate(self, input_ids, max_tokens, temperature, top_k, top_p=1.0, repetition_penalty=1.0, seed=None):
+        return self.submit(input_ids, max_tokens, temperature, top_k, top_p, repetition_penalty, seed).result()
+
+    def stream(self, input_ids, max_tokens, temperature, top_k, top_p=1.0, repetition_penalty=1.0, seed=None,
+               loop=None) -> TokenStream:
+        args = (list(input_ids), max_tokens, temperature, top_k, top_p, repetition_penalty, seed)
+        return self.pool.call("local", args, stream=True, loop=loop).stream
+
+
+class PooledHFEngine:
+    """HFBatchEngine interface served by the worker pool."""
+
+    def __init__(self, pool: WorkerPool):
+        self.pool = pool
+
+    def submit(self, prompt, max_tokens=60, temperature=0.8, top_k=50, top_p=1.0, repetition_penalty=1.0,
+               seed=None, stream=False, loop=None, worker=None) -> PoolRequest:
+        args = (prompt, max_tokens, temperature, top_k, top_p, repetition_penalty, seed)
+        return self.pool.call("hf", args, stream=stream, worker=worker, loop=loop)
+
+    def generate_once(self, prompt, max_tokens=60, temperature=0.8, top_k=50, top_p=1.0, repetition_penalty=1.0,
+                      seed=None) -> str:
+        return self.submit(prompt, max_tokens, temperature, top_k, top_p, repetition_penalty, seed).future.result()
+
+    def stream(self, prompt, max_tokens=60, temperature=0.8, top_k=50, top_p=1.0, repetition_penalty=1.0,
+               seed=None):
+        req = self.submit(prompt, max_tokens, temperature, top_k, top_p, repetition_penalty, seed, stream=True)
+        for piece in req.stream:
+            yield piece